@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # optional: gzip variants only
+    brotli = None
+
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+ETAG_SUFFIX = {"gzip": "-gz", "br": "-br"}
+
+
+class Asset:
+    """One file held in memory with its validators and compressed variants."""
+
+    def __init__(self, path, rel):
+        self.path = path
+        self.rel = rel
+        with open(path, "rb") as f:
+            self.body = f.read()
+        self.mtime = os.stat(path).st_mtime
+        self.media_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/"):
+            self.media_type += "; charset=utf-8"
+        digest = hashlib.sha1(self.body).hexdigest()[:20]
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.variants = {}
+        if self.media_type.startswith(COMPRESSIBLE) and len(self.body) > 512:
+            self.variants["gzip"] = gzip.compress(self.body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(self.body, quality=11)
+        # strong validators: each encoding is its own representation
+        self.etags = {None: f'"{digest}"', **{e: f'"{digest}{ETAG_SUFFIX[e]}"' for e in self.variants}}
+
+
+class AssetCache:
+    """index.html and static/ loaded once into memory and served with
+    ETag / Last-Modified, 304s and pre-compressed variants.
+
+    With hot_reload (dev), every request stats its file and reloads it if
+    it changed, and responses are no-cache."""
+
+    def __init__(self, root, files=(), dirs=(), hot_reload=False):
+        self.root = os.path.realpath(root)
+        self.hot_reload = hot_reload
+        self.files = set(files)
+        self.dirs = [os.path.join(self.root, d) + os.sep for d in dirs]
+        self._assets = {}
+        for rel in files:
+            self._load(rel)
+        for d in dirs:
+            for dirpath, _, names in os.walk(os.path.join(self.root, d)):
+                for name in names:
+                    self._load(os.path.relpath(os.path.join(dirpath, name), self.root))
+
+    def _load(self, rel):
+        rel = rel.replace(os.sep, "/")
+        path = os.path.join(self.root, rel)
+        try:
+            self._assets[rel] = Asset(path, rel)
+        except OSError:
+            self._assets.pop(rel, None)
+        return self._assets.get(rel)
+
+    def get(self, rel):
+        asset = self._assets.get(rel)
+        if not self.hot_reload:
+            return asset
+        if asset is None:
+            # new files show up in dev, but only inside the served dirs
+            path = os.path.realpath(os.path.join(self.root, rel))
+            if rel not in self.files and not any(path.startswith(d) for d in self.dirs):
+                return None
+            if not os.path.isfile(path):
+                return None
+            return self._load(os.path.relpath(path, self.root))
+        try:
+            if os.stat(asset.path).st_mtime != asset.mtime:
+                return self._load(rel)
+        except OSError:
+            self._assets.pop(rel, None)
+            return None
+        return asset
+
+    @staticmethod
+    def _not_modified(request, asset, etag):
+        inm = request.headers.get("If-None-Match")
+        if inm is not None:
+            return etag in [t.strip().removeprefix("W/") for t in inm.split(",")] or inm.strip() == "*"
+        ims = request.headers.get("If-Modified-Since")
+        if ims:
+            try:
+                return int(asset.mtime) <= parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def respond(self, request, rel, cache_control):
+        asset = self.get(rel)
+        if asset is None:
+            return None
+        accepted = {e.split(";")[0].strip() for e in request.headers.get("Accept-Encoding", "").split(",")}
+        encoding = next((e for e in ("br", "gzip") if e in accepted and e in asset.variants), None)
+        headers = {
+            "ETag": asset.etags[encoding],
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": "no-cache" if self.hot_reload else cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if self._not_modified(request, asset, asset.etags[encoding]):
+            return Response(status_code=304, headers=headers)
+        if encoding is None:
+            return Response(asset.body, media_type=asset.media_type, headers=headers)
+        headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+    def stats(self):
+        return {
+            "files": len(self._assets),
+            "bytes": sum(len(a.body) for a in self._assets.values()),
+            "hot_reload": self.hot_reload,
+        }
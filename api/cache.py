@@ -0,0 +1,112 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._expire(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                old_key, (_, old_value) = self._data.popitem(last=False)
+                self._on_remove(old_key, old_value)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            self._on_remove(key, entry[1])
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            for key, (_, value) in self._data.items():
+                self._on_remove(key, value)
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expire(self, key):
+        _, value = self._data.pop(key)
+        self._on_remove(key, value)
+
+    def _on_remove(self, key, value):
+        pass
+
+
+class SessionCache(TTLCache):
+    """token -> user row, with a user_id -> tokens index so writes to a
+    user row can patch or drop every cached session for that user."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        super().__init__(maxsize, ttl)
+        self._tokens_by_user = {}
+
+    def set(self, key, value):
+        user_id = value.get("id")
+        if user_id:
+            with self._lock:
+                self._tokens_by_user.setdefault(user_id, set()).add(key)
+        super().set(key, value)
+
+    def update_user(self, user_id, fields):
+        """Merge freshly written columns into every cached row for user_id."""
+        with self._lock:
+            for token in self._tokens_by_user.get(user_id, ()):
+                entry = self._data.get(token)
+                if entry:
+                    entry[1].update(fields)
+
+    def drop_user(self, user_id):
+        with self._lock:
+            for token in self._tokens_by_user.pop(user_id, set()):
+                self._data.pop(token, None)
+
+    def _on_remove(self, key, value):
+        user_id = value.get("id")
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(key)
+            if not tokens:
+                del self._tokens_by_user[user_id]
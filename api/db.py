@@ -0,0 +1,103 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BlockingPool:
+    """Runs blocking calls (the sync supabase client, urllib) on a bounded
+    thread pool so they never stall the event loop. At most `size` calls are
+    in flight; the rest wait on a semaphore, and that wait is measured."""
+
+    def __init__(self, size=16, name="db"):
+        self.size = size
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"spazz-{name}")
+        self._slots = None
+        self._loop = None
+        self.calls = 0
+        self.errors = 0
+        self.waiting = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    def _semaphore(self):
+        # asyncio primitives bind to the loop that first uses them
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.size)
+        return self._slots
+
+    async def run(self, fn, *args):
+        slots = self._semaphore()
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.perf_counter()
+        wait = started - queued
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.calls += 1
+        self.in_flight += 1
+        try:
+            return await self._loop.run_in_executor(self._executor, fn, *args)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.run_total += time.perf_counter() - started
+            slots.release()
+
+    async def execute(self, query):
+        """await pool.execute(supabase.table(...).select(...)) -> APIResponse"""
+        return await self.run(query.execute)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "calls": self.calls,
+            "errors": self.errors,
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "queue_wait_avg_ms": round(self.wait_total / self.calls * 1000, 3) if self.calls else 0.0,
+            "queue_wait_max_ms": round(self.wait_max * 1000, 3),
+            "run_avg_ms": round(self.run_total / self.calls * 1000, 3) if self.calls else 0.0,
+        }
+
+
+class SqliteFile:
+    """A SQLite file (WAL mode) queried through a BlockingPool, so a worker
+    waiting on another worker's write lock (up to `timeout` seconds) blocks
+    a pool thread, not the event loop. Each pool thread keeps its own
+    connection, which lets readers run beside the writer."""
+
+    def __init__(self, path, schema, pool=None, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.pool = pool or BlockingPool(size=4, name="sqlite")
+        self._local = threading.local()
+        self._connect().executescript(schema)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql, args):
+        return self._connect().execute(sql, args).fetchall()
+
+    async def query(self, sql, args=()):
+        """Rows of one statement, run on the pool."""
+        return await self.pool.run(self._execute, sql, args)
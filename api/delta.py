@@ -0,0 +1,88 @@
+import itertools
+import uuid
+
+from api.cache import TTLCache
+from api.geo import equirect
+
+POSITION_KEYS = ("lat", "lng", "lon")
+
+
+class SnapshotLog:
+    """What each client last received from a map endpoint, so the next
+    call can send only what changed.
+
+    Every response gets a version; the log remembers, per (client,
+    version), the entities that client now holds. A call with since=<that
+    version> is diffed against it into added / changed / removed. Moves
+    under move_m are left out, and the log keeps the position the client
+    actually has, so small drifts add up until they cross the threshold.
+    Old versions fall out of the bounded cache, and unknown versions
+    (expired, or issued by another instance) get a full resync."""
+
+    def __init__(self, maxsize=8192, ttl=120, move_m=5.0):
+        self.move_m = move_m
+        self._snapshots = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._prefix = uuid.uuid4().hex[:6]
+        self._seq = itertools.count(1)
+        self.full = 0
+        self.deltas = 0
+        self.unchanged = 0
+
+    def _mint(self):
+        return f"{self._prefix}.{next(self._seq)}"
+
+    def _differs(self, old, new):
+        if any(old.get(k) != v for k, v in new.items() if k not in POSITION_KEYS):
+            return True
+        lat0, lng0 = old.get("lat"), old.get("lng", old.get("lon"))
+        lat1, lng1 = new.get("lat"), new.get("lng", new.get("lon"))
+        if None in (lat0, lng0, lat1, lng1):
+            return (lat0, lng0) != (lat1, lng1)
+        return equirect(lat0, lng0, lat1, lng1) > self.move_m
+
+    def diff(self, owner, since, sections):
+        """sections: {"users": [entity, ...], ...}, entities keyed by "id".
+        Returns the payload to send: everything (full=True) or a delta."""
+        base = self._snapshots.get((owner, since)) if since else None
+        if base is None:
+            held = {name: {e["id"]: e for e in rows} for name, rows in sections.items()}
+            # an identical full snapshot keeps its version, so its ETag holds
+            version = self._snapshots.get((owner, "latest"))
+            if version is None or self._snapshots.get((owner, version)) != held:
+                version = self._mint()
+                self._snapshots.set((owner, version), held)
+                self._snapshots.set((owner, "latest"), version)
+            self.full += 1
+            return {"version": version, "full": True, **sections}
+
+        held, out, dirty = {}, {}, False
+        for name, rows in sections.items():
+            old = base.get(name, {})
+            now = {}
+            added, changed = [], []
+            for e in rows:
+                prev = old.get(e["id"])
+                if prev is None:
+                    added.append(e)
+                    now[e["id"]] = e
+                elif self._differs(prev, e):
+                    changed.append(e)
+                    now[e["id"]] = e
+                else:
+                    now[e["id"]] = prev
+            removed = [k for k in old if k not in now]
+            held[name] = now
+            out[name] = {"added": added, "changed": changed, "removed": removed}
+            dirty = dirty or bool(added or changed or removed)
+
+        if not dirty:
+            self.unchanged += 1
+            return {"version": since, "full": False, **out}
+        version = self._mint()
+        self._snapshots.set((owner, version), held)
+        self._snapshots.set((owner, "latest"), version)
+        self.deltas += 1
+        return {"version": version, "full": False, **out}
+
+    def stats(self):
+        return {"full": self.full, "deltas": self.deltas, "unchanged": self.unchanged, "snapshots": self._snapshots.stats()}
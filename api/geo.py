@@ -0,0 +1,222 @@
+import math
+import numpy as np
+
+R = 6371e3
+M_PER_DEG = math.pi * R / 180  # metres per degree of latitude
+SCALAR_CUTOFF = 32  # below this many candidates numpy call overhead loses to plain math
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Scalar reference implementation; haversine_many must agree with it."""
+    dLat = (lat2 - lat1) * math.pi / 180
+    dLon = (lon2 - lon1) * math.pi / 180
+    a = math.sin(dLat/2)**2 + math.cos(lat1*math.pi/180)*math.cos(lat2*math.pi/180)*math.sin(dLon/2)**2
+    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+
+
+def equirect(lat1, lon1, lat2, lon2):
+    """Flat-earth approximation, within a fraction of a percent of
+    haversine at the few-km scale the map works at. One cos, no atan2."""
+    x = ((lon2 - lon1 + 180) % 360 - 180) * math.cos((lat1 + lat2) * math.pi / 360)
+    y = lat2 - lat1
+    return M_PER_DEG * math.sqrt(x*x + y*y)
+
+
+def bbox(lat, lon, radius_m):
+    """(lat0, lat1, [(lon0, lon1), ...]) bounding a radius_m circle, with
+    the longitude span split in two where it crosses the antimeridian, and
+    the whole [-180, 180] when the circle reaches a pole."""
+    dlat = radius_m / M_PER_DEG
+    lat0, lat1 = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    if lat0 <= -90 or lat1 >= 90:
+        return lat0, lat1, [(-180.0, 180.0)]
+    # widest longitude offset on the circle, exact on the sphere
+    dlon = math.degrees(math.asin(min(1.0, math.sin(radius_m / R) / math.cos(math.radians(lat)))))
+    lon0, lon1 = lon - dlon, lon + dlon
+    if lon1 - lon0 >= 360:
+        return lat0, lat1, [(-180.0, 180.0)]
+    if lon0 < -180:
+        return lat0, lat1, [(lon0 + 360, 180.0), (-180.0, lon1)]
+    if lon1 > 180:
+        return lat0, lat1, [(lon0, 180.0), (-180.0, lon1 - 360)]
+    return lat0, lat1, [(lon0, lon1)]
+
+
+def within(lat1, lon1, lat2, lon2, radius_m):
+    """Exact haversine distance if (lat2, lon2) is within radius_m, else None.
+    The equirectangular pass rejects the obvious misses first."""
+    if equirect(lat1, lon1, lat2, lon2) > radius_m * 1.01 + 1:
+        return None
+    d = haversine(lat1, lon1, lat2, lon2)
+    return d if d <= radius_m else None
+
+
+def haversine_many(lat, lon, lats, lons):
+    """Distances in metres from one point to arrays of points, in one pass."""
+    lat1 = np.radians(lat)
+    lat2 = np.radians(lats)
+    dLat = lat2 - lat1
+    dLon = np.radians(lons) - np.radians(lon)
+    a = np.sin(dLat/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dLon/2)**2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+
+def within_many(lat, lon, lats, lons, radius_m):
+    """(mask, distances) for arrays of points against one query point."""
+    d = haversine_many(lat, lon, np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+    return d <= radius_m, d
+
+
+def decode_polyline(encoded, precision=5):
+    """Google encoded polyline -> [(lat, lng), ...]."""
+    points, index, lat, lng = [], 0, 0, 0
+    scale = 10 ** precision
+    try:
+        while index < len(encoded):
+            deltas = []
+            for _ in range(2):
+                shift = result = 0
+                while True:
+                    b = ord(encoded[index]) - 63
+                    index += 1
+                    result |= (b & 0x1f) << shift
+                    shift += 5
+                    if b < 0x20:
+                        break
+                deltas.append(~(result >> 1) if result & 1 else result >> 1)
+            lat += deltas[0]
+            lng += deltas[1]
+            points.append((lat / scale, lng / scale))
+    except IndexError:
+        raise ValueError("truncated polyline")
+    return points
+
+
+class PointArray:
+    """Coordinates kept in contiguous float64 arrays next to the entity
+    dicts, addressed by slot. Removal swaps the last slot into the hole so
+    the live range stays dense."""
+
+    def __init__(self, capacity=256):
+        self.lats = np.empty(capacity, dtype=np.float64)
+        self.lons = np.empty(capacity, dtype=np.float64)
+        self.keys = []
+        self.slots = {}
+
+    def set(self, key, lat, lon):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = len(self.keys)
+            if slot == len(self.lats):
+                self.lats = np.resize(self.lats, slot * 2)
+                self.lons = np.resize(self.lons, slot * 2)
+            self.keys.append(key)
+            self.slots[key] = slot
+        self.lats[slot] = lat
+        self.lons[slot] = lon
+
+    def get(self, key):
+        slot = self.slots[key]
+        return self.lats[slot], self.lons[slot]
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        last = len(self.keys) - 1
+        if slot != last:
+            moved = self.keys[last]
+            self.keys[slot] = moved
+            self.slots[moved] = slot
+            self.lats[slot] = self.lats[last]
+            self.lons[slot] = self.lons[last]
+        self.keys.pop()
+
+    def within(self, lat, lon, radius_m, slots=None):
+        """[(key, distance_m)] for the given slots (default: all) in radius."""
+        if slots is None:
+            slots = slice(0, len(self.keys))
+            keys = self.keys
+        else:
+            keys = [self.keys[i] for i in slots]
+        mask, d = within_many(lat, lon, self.lats[slots], self.lons[slots], radius_m)
+        return [(keys[i], float(d[i])) for i in np.flatnonzero(mask)]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class GridIndex:
+    """Fixed-size lat/lon cell buckets. Radius queries only visit the cells
+    overlapping the query's bounding box instead of every point."""
+
+    def __init__(self, cell_m=500):
+        self.cell_deg = cell_m / M_PER_DEG
+        self._cells = {}   # (row, col) -> set of ids
+        self._cell_of = {}  # id -> (row, col)
+        self.points = PointArray()
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def insert(self, key, lat, lon):
+        cell = self._cell(lat, lon)
+        old = self._cell_of.get(key)
+        if old != cell:
+            if old is not None:
+                self._drop_from_cell(key, old)
+            self._cells.setdefault(cell, set()).add(key)
+            self._cell_of[key] = cell
+        self.points.set(key, lat, lon)
+
+    move = insert
+
+    def remove(self, key):
+        cell = self._cell_of.pop(key, None)
+        if cell is None:
+            return
+        self._drop_from_cell(key, cell)
+        self.points.remove(key)
+
+    def _drop_from_cell(self, key, cell):
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self._cells[cell]
+
+    def query(self, lat, lon, radius_m):
+        """[(id, distance_m)] for every point within radius_m."""
+        if not (math.isfinite(lat) and math.isfinite(lon)):
+            return []
+        lat0, lat1, lon_spans = bbox(lat, lon, radius_m)
+        r0, r1 = self._cell(lat0, 0)[0], self._cell(lat1, 0)[0]
+        cols = [(self._cell(0, a)[1], self._cell(0, b)[1]) for a, b in lon_spans]
+        n_cells = (r1 - r0 + 1) * sum(c1 - c0 + 1 for c0, c1 in cols)
+        candidates = []
+        if n_cells > len(self._cells):
+            # near the poles the box spans more cells than are occupied
+            for (r, c), keys in self._cells.items():
+                if r0 <= r <= r1 and any(c0 <= c <= c1 for c0, c1 in cols):
+                    candidates.extend(keys)
+        else:
+            for r in range(r0, r1 + 1):
+                for c0, c1 in cols:
+                    for c in range(c0, c1 + 1):
+                        candidates.extend(self._cells.get((r, c), ()))
+        if len(candidates) < SCALAR_CUTOFF:
+            hits = []
+            for key in candidates:
+                plat, plon = self.points.get(key)
+                d = within(lat, lon, float(plat), float(plon), radius_m)
+                if d is not None:
+                    hits.append((key, d))
+            return hits
+        slots = np.fromiter((self.points.slots[k] for k in candidates), dtype=np.intp, count=len(candidates))
+        return self.points.within(lat, lon, radius_m, slots)
+
+    def __contains__(self, key):
+        return key in self._cell_of
+
+    def __len__(self):
+        return len(self._cell_of)
@@ -0,0 +1,121 @@
+import asyncio
+import base64
+import json
+import re
+import time
+import urllib.request
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+CLOCK_SKEW_S = 60
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _int(text):
+    return int.from_bytes(_unb64(text), "big")
+
+
+def fetch_google_certs(url=GOOGLE_CERTS_URL, timeout=5):
+    """Blocking: (jwks, max_age_s or None) from Google's certs endpoint."""
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        jwks = json.loads(resp.read().decode())
+        match = re.search(r"max-age=(\d+)", resp.headers.get("Cache-Control", ""))
+    return jwks, int(match.group(1)) if match else None
+
+
+class GoogleKeys:
+    """Google's ID-token signing keys, cached for as long as the certs
+    response says (Cache-Control max-age) or refresh_s otherwise.
+
+    fetch is an async callable returning (jwks, max_age_s or None), so
+    tests can hand in locally generated keys. A token signed with a kid we
+    don't have triggers one early refresh (keys rotate), at most every
+    min_refresh_s."""
+
+    def __init__(self, fetch, refresh_s=3600, min_refresh_s=60):
+        self.fetch = fetch
+        self.refresh_s = refresh_s
+        self.min_refresh_s = min_refresh_s
+        self._keys = {}  # kid -> RSAPublicKey
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self.refreshes = 0
+        self._lock = asyncio.Lock()
+
+    def load(self, jwks, max_age_s=None):
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("kty") == "RSA" and jwk.get("kid"):
+                keys[jwk["kid"]] = rsa.RSAPublicNumbers(_int(jwk["e"]), _int(jwk["n"])).public_key()
+        self._keys = keys
+        self.fetched_at = time.monotonic()
+        self.expires_at = self.fetched_at + (max_age_s or self.refresh_s)
+
+    async def refresh(self):
+        seen = self.fetched_at
+        async with self._lock:
+            if self.fetched_at != seen:
+                return  # a concurrent caller just did it
+            jwks, max_age_s = await self.fetch()
+            self.load(jwks, max_age_s)
+            self.refreshes += 1
+
+    async def refresh_if_stale(self):
+        if time.monotonic() >= self.expires_at:
+            await self.refresh()
+
+    async def get(self, kid):
+        await self.refresh_if_stale()
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self.fetched_at >= self.min_refresh_s:
+            await self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def stats(self):
+        return {"keys": len(self._keys), "refreshes": self.refreshes,
+                "expires_in_s": round(max(0.0, self.expires_at - time.monotonic()))}
+
+
+async def verify_id_token(token, keys, audiences=(), now=None):
+    """Claims of a Google ID token (RS256 JWT) checked locally: signature,
+    issuer, audience (when audiences is non-empty), expiry and a verified
+    email. Raises ValueError saying what failed."""
+    try:
+        header_part, claims_part, signature_part = token.split(".")
+        header = json.loads(_unb64(header_part))
+        claims = json.loads(_unb64(claims_part))
+        signature = _unb64(signature_part)
+    except ValueError:
+        raise ValueError("malformed token")
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise ValueError("malformed token")
+    if header.get("alg") != "RS256":
+        raise ValueError("unexpected algorithm")
+    key = await keys.get(header.get("kid"))
+    if key is None:
+        raise ValueError("unknown signing key")
+    try:
+        key.verify(signature, f"{header_part}.{claims_part}".encode(), padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        raise ValueError("bad signature")
+
+    now = time.time() if now is None else now
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError("wrong issuer")
+    if audiences and claims.get("aud") not in audiences:
+        raise ValueError("wrong audience")
+    if claims.get("exp", 0) < now - CLOCK_SKEW_S:
+        raise ValueError("token expired")
+    if claims.get("iat", 0) > now + CLOCK_SKEW_S:
+        raise ValueError("token issued in the future")
+    if not claims.get("email") or claims.get("email_verified") not in (True, "true"):
+        raise ValueError("email not verified")
+    return claims
@@ -1,22 +1,54 @@
 import json
 import random
+import re
+import itertools
 import os
 import uuid
 import hashlib
-import hmac
 import base64
 import time
 import math
+import asyncio
+import logging
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 from supabase import create_client, Client
-
-app = FastAPI()
+from api.cache import SessionCache, TTLCache
+from api.leaderboard import Leaderboard
+from api.ingest import LocationBuffer
+from api.payload import respond, dumps, FastJSONResponse, RawJSONResponse
+from api.delta import SnapshotLog
+from api.assets import AssetCache
+from api.ratelimit import Limit, RateLimiter, open_bucket_store
+from api.presence import Presence, PRESENCE_TTL_S
+from api.metrics import Metrics, MetricsMiddleware, query_target
+from api.tokens import TokenSigner, TOKEN_TTL_S
+from api.google import GoogleKeys, fetch_google_certs, verify_id_token
+from api.geo import haversine, decode_polyline, GridIndex, M_PER_DEG
+from api.world import open_world_store
+from api.stream import StreamHub, NEARBY_RADIUS_M, PING_RADIUS_M
+from api.db import BlockingPool
+from api.tasks import Periodic
+from api.pings import PingSync, PING_TTL_S, format_ts
+
+log = logging.getLogger("spazz.api")
+
+# background loops (ping sync, ...) start and stop with the app
+_periodic = Periodic()
+app = FastAPI(lifespan=_periodic.lifespan, default_response_class=FastJSONResponse)
 
 SECRET_KEY = os.environ.get("SPAZZ_SECRET", "spazz-dev-secret-change-in-prod")
+# Anyone holding the token secret can sign in as any user, so it has no
+# committed fallback: set SPAZZ_TOKEN_SECRET, or SPAZZ_DEV=1 for a local one.
+DEV_TOKEN_SECRET = "spazz-dev-token-secret"
+TOKEN_SECRET = os.environ.get("SPAZZ_TOKEN_SECRET", "")
+if os.environ.get("SPAZZ_DEV") == "1":
+    TOKEN_SECRET = TOKEN_SECRET or DEV_TOKEN_SECRET
+elif not TOKEN_SECRET or TOKEN_SECRET in (DEV_TOKEN_SECRET, "spazz-dev-secret-change-in-prod"):
+    raise RuntimeError("SPAZZ_TOKEN_SECRET must be set to a private value (SPAZZ_DEV=1 allows a dev key)")
 ADMIN_IDS = {"user_ben"}
 
 # ── SUPABASE ─────────────────────────────
@@ -27,6 +59,35 @@ supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 # Use the variables you just defined
 supabase: Client = create_client(SUPABASE_URL, supabase_key)
 
+# The supabase client is synchronous; every query goes through db() so it runs
+# on a bounded thread pool instead of blocking the event loop.
+_db_pool = BlockingPool(size=int(os.environ.get("SPAZZ_DB_CONCURRENCY", "16")), name="db")
+_http_pool = BlockingPool(size=int(os.environ.get("SPAZZ_HTTP_CONCURRENCY", "4")), name="http")
+# the sqlite: world and rate limit stores, whose lock waits must stay off the loop
+_sqlite_pool = BlockingPool(size=int(os.environ.get("SPAZZ_SQLITE_CONCURRENCY", "4")), name="sqlite")
+
+# per-route latency and Supabase calls, scraped from /api/admin/metrics
+_metrics = Metrics()
+
+async def db(query):
+    started = time.perf_counter()
+    try:
+        return await _db_pool.execute(query)
+    finally:
+        _metrics.observe_db(query_target(query), time.perf_counter() - started)
+
+# user id (or a legacy token) -> users row, so polling endpoints don't hit
+# Supabase for auth every call
+_sessions = SessionCache(
+    maxsize=int(os.environ.get("SPAZZ_SESSION_CACHE_SIZE", "4096")),
+    ttl=int(os.environ.get("SPAZZ_SESSION_CACHE_TTL", "60")),
+)
+
+# every user ranked by xp; kept current by update_user(), re-read from the
+# table every LEADERBOARD_REFRESH_S to pick up other instances' writes
+LEADERBOARD_REFRESH_S = float(os.environ.get("SPAZZ_LEADERBOARD_REFRESH_S", "300"))
+_leaderboard = Leaderboard(size=20)
+
 COACH_TIPS_LAZY = [
     "You've been still for a while. Wisps don't come to you.",
     "Every step is a chance. Get moving.",
@@ -51,6 +112,7 @@ COACH_TIPS_GENERAL = [
 ]
 
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(MetricsMiddleware, metrics=_metrics)
 
 # ── MODELS ──────────────────────────────
 class RegisterRequest(BaseModel):
@@ -68,6 +130,14 @@ class LocationUpdate(BaseModel):
     lat: float
     lon: float
 
+class LocationTrace(BaseModel):
+    # either a Google encoded polyline with delta-encoded times...
+    polyline: Optional[str] = None
+    t0: Optional[float] = None  # epoch seconds of the first point
+    dt: Optional[List[float]] = None  # seconds since the previous point
+    # ...or plain [[lat, lng, epoch_s], ...]
+    points: Optional[List[List[float]]] = None
+
 class ChatMessage(BaseModel):
     to_user_id: str
     message: str
@@ -76,39 +146,358 @@ class ChatMessage(BaseModel):
 def hash_password(p):
     return hashlib.sha256((p + SECRET_KEY).encode()).hexdigest()
 
-def make_token(user_id):
-    payload = f"{user_id}:{time.time()}:{random.random()}"
-    return base64.b64encode(hmac.new(SECRET_KEY.encode(), payload.encode(), hashlib.sha256).digest()).decode()
+# Session tokens are signed (api/tokens.py), so get_current_user checks
+# them without a query and every device of an account shares one cached
+# row. Bumping users.token_version revokes a user's tokens: at once on this
+# instance, within SPAZZ_SESSION_CACHE_TTL on the others. Tokens from
+# before the signed format are still looked up by users.token.
+_tokens = TokenSigner(TOKEN_SECRET, ttl_s=int(os.environ.get("SPAZZ_TOKEN_TTL_S", str(TOKEN_TTL_S))))
+
+def make_token(user):
+    return _tokens.issue(user["id"], user.get("token_version") or 0)
+
+async def load_user(user_id, fresh=False):
+    cached = None if fresh else _sessions.get(user_id)
+    if cached:
+        return cached
+    result = await db(supabase.table("users").select("*").eq("id", user_id).limit(1))
+    if not result.data:
+        return None
+    user = {**result.data[0], **_locations.latest(user_id)}
+    _sessions.set(user_id, user)
+    return user
 
-def get_auth_by_token(token):
+async def get_auth_by_token(token):
+    if not _tokens.is_signed(token):
+        return await get_auth_by_legacy_token(token)
+    claims = _tokens.verify(token)
+    if claims is None:
+        return None
     try:
-        result = supabase.table("users").select("*").eq("token", token).limit(1).execute()
+        user = await load_user(claims["uid"])
+        if user is not None and (user.get("token_version") or 0) < claims["ver"]:
+            # issued after a bump this instance hasn't seen yet
+            user = await load_user(claims["uid"], fresh=True)
+    except:
+        return None
+    if user is None or (user.get("token_version") or 0) != claims["ver"]:
+        return None
+    return user
+
+async def get_auth_by_legacy_token(token):
+    cached = _sessions.get(token)
+    if cached:
+        return cached
+    try:
+        result = await db(supabase.table("users").select("*").eq("token", token).limit(1))
         if result.data:
-            return result.data[0]
+            user = {**result.data[0], **_locations.latest(result.data[0]["id"])}
+            _sessions.set(token, user)
+            return user
         return None
     except:
         return None
 
-def get_current_user(request: Request):
+async def start_session(user):
+    """Cache the row for the new token; a legacy users.token is retired
+    since the client now holds a signed one."""
+    if user.get("token"):
+        _sessions.pop(user["token"])
+        await db(supabase.table("users").update({"token": None}).eq("id", user["id"]))
+        user = {**user, "token": None}
+    _sessions.set(user["id"], {**user, **_locations.latest(user["id"])})
+    _leaderboard.put(user["id"], user)
+    return make_token(user)
+
+async def revoke_sessions(user_id):
+    """Every token issued to user_id so far stops working."""
+    version = (await db(supabase.rpc("bump_token_version", {"p_user_id": user_id}))).data
+    _sessions.drop_user(user_id)
+    return version
+
+async def update_user(user_id, fields):
+    """Write columns to the users row and patch cached sessions to match."""
+    await db(supabase.table("users").update(fields).eq("id", user_id))
+    _sessions.update_user(user_id, fields)
+    _leaderboard.put(user_id, fields)
+
+async def get_current_user(request: Request):
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
     if not token:
         raise HTTPException(401, "No token")
-    user = get_auth_by_token(token)
+    user = await get_auth_by_token(token)
     if not user:
         raise HTTPException(401, "Invalid token")
     return user
 
+# ── RATE LIMITS ──────────────────────────
+# Token buckets per user and route, (basic, premium). Checked right after
+# auth, which is served from the session cache, so a throttled request
+# costs no DB call. SPAZZ_RATELIMIT_STORE=sqlite:/path shares the buckets
+# between workers on one host.
+RATE_LIMITS = {
+    "ping": (Limit.per_minute(6, burst=3), Limit.per_minute(20, burst=5)),
+    "location": (Limit.per_minute(60, burst=10), None),
+    "location_batch": (Limit.per_minute(6, burst=3), None),
+    "chat": (Limit.per_minute(30, burst=10), Limit.per_minute(60, burst=20)),
+    "collect": (Limit.per_minute(120, burst=20), None),
+}
+_limiter = RateLimiter(open_bucket_store(os.environ.get("SPAZZ_RATELIMIT_STORE", "memory"), _sqlite_pool), RATE_LIMITS)
+
+def rate_limited(name):
+    """Depends(rate_limited("ping")) in place of Depends(get_current_user)."""
+    async def check(auth=Depends(get_current_user)):
+        retry_after = await _limiter.check(name, auth["id"], auth.get("is_premium", False))
+        if retry_after is not None:
+            raise HTTPException(429, "Too many requests", headers={"Retry-After": str(math.ceil(retry_after))})
+        return auth
+    return check
+
 # ── GEO ──────────────────────────────────
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371e3
-    dLat = (lat2 - lat1) * math.pi / 180
-    dLon = (lon2 - lon1) * math.pi / 180
-    a = math.sin(dLat/2)**2 + math.cos(lat1*math.pi/180)*math.cos(lat2*math.pi/180)*math.sin(dLon/2)**2
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+def check_coords(lat, lng):
+    """(lat, lng) as floats, or 400 for anything that isn't a finite point
+    on the map (nan/inf parse fine as floats and would poison the indexes)."""
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        raise HTTPException(400, "lat and lng must be numbers")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise HTTPException(400, "lat must be within [-90, 90] and lng within [-180, 180]")
+    return lat, lng
+
+def user_view(u, lat, lng):
+    """Map-screen shape of another hunter."""
+    return {
+        "id": u["id"],
+        "username": u["username"],
+        "lat": lat,
+        "lng": lng,
+        "is_premium": u.get("is_premium", False),
+    }
 
 def meters_to_steps(m): return int(m / 0.762)
 def meters_to_calories(m, age=25): return m * 0.06
 
+# ── LOCATION INGEST ──────────────────────
+# Location pings only change a handful of columns and only the newest value
+# matters, so they are coalesced per user and written in bulk. A write is
+# persisted within LOCATION_FLUSH_S (or max_age_s if the timer stalls);
+# this instance's caches see it immediately.
+LOCATION_FLUSH_S = float(os.environ.get("SPAZZ_LOCATION_FLUSH_S", "5"))
+_locations = LocationBuffer(
+    max_batch=int(os.environ.get("SPAZZ_LOCATION_BATCH", "500")),
+    max_age_s=LOCATION_FLUSH_S * 3,
+)
+
+def buffer_user(user_id, fields):
+    """update_user() for location columns: caches now, the row on the next flush."""
+    _locations.put(user_id, fields)
+    _sessions.update_user(user_id, fields)
+    _leaderboard.put(user_id, fields)
+
+@_periodic.every(LOCATION_FLUSH_S, final=True)
+async def flush_locations():
+    while len(_locations):
+        rows = _locations.take()
+        started = time.perf_counter()
+        try:
+            await db(supabase.rpc("apply_location_batch", {"updates": rows}))
+        except Exception:
+            _locations.restore(rows)
+            raise
+        _locations.done(rows, time.perf_counter() - started)
+
+def location_fields(user, lat, lng):
+    """Columns for a move to (lat, lng), measured from the newest position
+    we know of: the unflushed buffer first, then the session row."""
+    last = {**user, **_locations.latest(user["id"])}
+    last_lat = last.get("last_lat")
+    last_lon = last.get("last_lon")
+    distance_m = last.get("distance_m", 0) or 0
+
+    if last_lat and last_lon:
+        dist = haversine(float(last_lat), float(last_lon), lat, lng)
+        if 3 < dist < 500:
+            distance_m += dist
+
+    return {
+        "lat": lat,
+        "lon": lng,
+        "last_lat": lat,
+        "last_lon": lng,
+        "distance_m": distance_m,
+        "steps": meters_to_steps(distance_m),
+        "calories": round(meters_to_calories(distance_m, user.get("age", 25)), 1),
+        "online": True,
+        "last_seen": time.time()
+    }
+
+TRACE_MAX_POINTS = 5000
+TRACE_MAX_SPEED_MS = 12.0  # faster than a sprint between two fixes = GPS jump
+
+def trace_points(trace):
+    """[(lat, lng, t), ...] from either encoding of a LocationTrace."""
+    if trace.points is not None:
+        if any(len(p) != 3 for p in trace.points):
+            raise HTTPException(400, "points must be [lat, lng, t]")
+        if not all(math.isfinite(x) for p in trace.points for x in p):
+            raise HTTPException(400, "points must be finite numbers")
+        return [tuple(p) for p in trace.points]
+    if trace.polyline is None or trace.t0 is None or trace.dt is None:
+        raise HTTPException(400, "Send points, or polyline with t0 and dt")
+    # NaN would slip past every comparison below and poison last_seen
+    if not (math.isfinite(trace.t0) and all(math.isfinite(dt) for dt in trace.dt)):
+        raise HTTPException(400, "t0 and dt must be finite numbers")
+    try:
+        coords = decode_polyline(trace.polyline)
+    except ValueError:
+        raise HTTPException(400, "Bad polyline")
+    if len(coords) != len(trace.dt):
+        raise HTTPException(400, "dt needs one entry per point")
+    t, points = trace.t0, []
+    for (lat, lng), dt in zip(coords, trace.dt):
+        t += dt
+        points.append((lat, lng, t))
+    return points
+
+def trace_fields(user, points):
+    """Columns after walking a recorded trace in one pass, with the same
+    3-500m hop rule as a live update. Hops faster than TRACE_MAX_SPEED_MS
+    are dropped as GPS jumps, and jitter under 3m accumulates against the
+    last counted fix instead of being thrown away. Points at or before
+    last_seen were already covered by live updates, and last_seen moves
+    to the newest fix so the next upload picks up where this one ended."""
+    last = {**user, **_locations.latest(user["id"])}
+    prev_lat = float(last["last_lat"]) if last.get("last_lat") else None
+    prev_lon = float(last["last_lon"]) if last.get("last_lon") else None
+    prev_t = float(last.get("last_seen") or 0)
+    if not math.isfinite(prev_t):
+        prev_t = 0.0
+    distance_m = last.get("distance_m", 0) or 0
+    horizon = time.time() + 60  # tolerate a little client clock skew
+    finite = [p for p in points if all(math.isfinite(x) for x in p)]
+    accepted, rejected = 0, len(points) - len(finite)
+    added = 0.0
+    jump = None
+    newest = prev_t
+
+    for lat, lng, t in sorted(finite, key=lambda p: p[2]):
+        if t <= prev_t or t > horizon or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            rejected += 1
+            continue
+        if prev_lat is None:
+            prev_lat, prev_lon, prev_t = lat, lng, t
+            newest = t
+            accepted += 1
+            continue
+        dist = haversine(prev_lat, prev_lon, lat, lng)
+        if dist > TRACE_MAX_SPEED_MS * (t - prev_t):
+            # one spike is a GPS jump; two fixes that agree with each other
+            # mean we really moved (or the start was stale): re-anchor there
+            if jump and haversine(jump[0], jump[1], lat, lng) <= TRACE_MAX_SPEED_MS * max(t - jump[2], 1):
+                prev_lat, prev_lon, prev_t = jump
+                dist = haversine(prev_lat, prev_lon, lat, lng)
+                accepted, rejected = accepted + 1, rejected - 1
+            else:
+                jump = (lat, lng, t)
+                rejected += 1
+                continue
+        jump = None
+        accepted += 1
+        newest = t
+        if dist <= 3:
+            continue
+        if dist < 500:
+            added += dist
+        prev_lat, prev_lon, prev_t = lat, lng, t
+
+    distance_m += added
+    return {
+        "lat": prev_lat,
+        "lon": prev_lon,
+        "last_lat": prev_lat,
+        "last_lon": prev_lon,
+        "distance_m": distance_m,
+        "steps": meters_to_steps(distance_m),
+        "calories": round(meters_to_calories(distance_m, user.get("age", 25)), 1),
+        "online": True,
+        "last_seen": newest,
+    }, accepted, rejected, added
+
+async def store_location(user, fields):
+    buffer_user(user["id"], fields)
+    heartbeat(user, fields["lat"], fields["lon"])
+    if _locations.due():
+        # the update is already buffered: a failed flush restored its rows
+        # for the timer, so it must not turn this request into a 500
+        try:
+            await flush_locations()
+        except Exception:
+            log.exception("inline location flush failed")
+
+# ── PRESENCE ─────────────────────────────
+# Online users are held in memory, fed by the location endpoints, so the
+# map endpoints answer "who is online near X" without a users scan. Every
+# PRESENCE_SYNC_S each instance reads back the rows whose last_seen moved
+# (users heartbeating on other instances) and writes online=false for its
+# own expired users in one UPDATE. The read re-covers the location buffer's
+# max age, since other instances persist last_seen that late.
+PRESENCE_SYNC_S = float(os.environ.get("SPAZZ_PRESENCE_SYNC_S", "15"))
+PRESENCE_PAGE = 1000
+PRESENCE_COLUMNS = "id,username,lat,lon,gender,age,is_premium,last_seen"
+_presence = Presence(ttl_s=PRESENCE_TTL_S)
+_presence_pulled = [0.0]  # wall time of the last pull; 0 = never
+
+def presence_info(u):
+    return {"id": u["id"], "username": u["username"], "gender": u.get("gender", "other"),
+            "age": u.get("age", 25), "is_premium": u.get("is_premium", False)}
+
+def heartbeat(user, lat, lng):
+    if lat is not None and lng is not None:
+        _presence.beat(user["id"], float(lat), float(lng), presence_info(user))
+
+async def pull_presence():
+    """Merge heartbeats other instances have persisted since the last pull."""
+    started = time.time()
+    last = _presence_pulled[0] or started - PRESENCE_TTL_S
+    since = last - _locations.max_age_s - PRESENCE_SYNC_S
+    while True:
+        res = await db(supabase.table("users").select(PRESENCE_COLUMNS)
+                       .gte("last_seen", since).order("last_seen").limit(PRESENCE_PAGE))
+        rows = res.data or []
+        for u in rows:
+            if u.get("lat") is not None and u.get("lon") is not None:
+                _presence.beat(u["id"], float(u["lat"]), float(u["lon"]), presence_info(u),
+                               seen_at=float(u["last_seen"]), local=False)
+        if len(rows) < PRESENCE_PAGE or float(rows[-1]["last_seen"]) <= since:
+            break
+        since = float(rows[-1]["last_seen"])
+    _presence_pulled[0] = started
+
+async def ensure_presence():
+    """A fresh instance fills in everyone online before its first answer."""
+    if not _presence_pulled[0]:
+        await pull_presence()
+
+@_periodic.every(PRESENCE_SYNC_S)
+async def sync_presence():
+    await pull_presence()
+
+@_periodic.every(PRESENCE_SYNC_S, final=True)
+async def persist_offline():
+    """online=false for this instance's expired users, unless they have
+    since been seen somewhere else."""
+    _presence.expire()
+    offline = _presence.take_offline()
+    cutoff = time.time() - PRESENCE_TTL_S
+    for i in range(0, len(offline), PRESENCE_PAGE):
+        try:
+            await db(supabase.table("users").update({"online": False})
+                     .in_("id", offline[i:i + PRESENCE_PAGE]).lt("last_seen", cutoff))
+        except Exception:
+            _presence.restore_offline(offline[i:])
+            raise
+
 def smart_coach_tip(user) -> str:
     steps = user.get("steps", 0) if isinstance(user, dict) else 0
     if steps < 100:
@@ -117,40 +506,282 @@ def smart_coach_tip(user) -> str:
         return random.choice(COACH_TIPS_ACTIVE)
     return random.choice(COACH_TIPS_GENERAL)
 
-# ── WISPS (in-memory per instance, Vercel ephemeral) ──────────────
-_wisps = {}
+# ── LEDGER (atomic coin / xp / premium changes) ─────────────────
+# Every balance change is one ledger_apply RPC: the database locks the row,
+# checks funds/ownership, applies deltas and records the entry, so there is
+# no read-modify-write from a stale session row. A repeated Idempotency-Key
+# returns the first result instead of paying out twice; the same key on a
+# different kind of change (a buy's key sent to subscribe) is a 409.
+LEDGER_ERRORS = {
+    "no_user": (404, "User not found"),
+    "premium_required": (403, "Premium required"),
+    "already_owned": (400, "Already owned"),
+    "insufficient_funds": (400, "Not enough coins"),
+    "key_reused": (409, "Idempotency-Key already used for a different request"),
+}
 
-def get_wisps():
-    return list(_wisps.values())
+def idempotency_key(request):
+    key = request.headers.get("Idempotency-Key", "").strip()
+    return key[:200] or None
+
+async def ledger_apply(user_id, kind, key=None, **change):
+    """Apply one change (coins, xp, xp_per_level, item_id, premium_required,
+    set_premium, extra) atomically. Failed checks come back with ok=False
+    and an error code from LEDGER_ERRORS."""
+    params = {"p_user_id": user_id, "p_kind": kind, "p_key": key}
+    params.update({f"p_{k}": v for k, v in change.items()})
+    res = (await db(supabase.rpc("ledger_apply", params))).data
+    # a replay returns the balances as they were then, which may be stale now
+    if res.get("ok") and not res.get("replayed"):
+        fields = {k: res[k] for k in ("wisp_coins", "xp", "level", "is_premium")}
+        _sessions.update_user(user_id, fields)
+        _leaderboard.put(user_id, fields)
+    return res
+
+async def ledger_replay(user_id, kind, key):
+    """Result of an earlier `kind` call with this key, for retries that can
+    no longer reach ledger_apply (e.g. the wisp is already gone)."""
+    if not key:
+        return None
+    rows = (await db(supabase.table("ledger").select("result")
+                     .eq("user_id", user_id).eq("idempotency_key", key).eq("kind", kind).limit(1))).data
+    return {**rows[0]["result"], "replayed": True} if rows else None
 
-def add_wisp(wisp):
-    _wisps[wisp["id"]] = wisp
+def ledger_error(res, detail=None):
+    status, message = LEDGER_ERRORS.get(res.get("error"), (400, "Transaction failed"))
+    return HTTPException(status, detail or message)
 
-def remove_wisp(wisp_id):
-    _wisps.pop(wisp_id, None)
+async def collect_wisp_reward(wisp, user_id, key, **change):
+    """Pay out for a wisp already taken from the world; put it back if the
+    payout never happened."""
+    try:
+        res = await ledger_apply(user_id, "collect", key, **change)
+    except Exception:
+        await add_wisp(wisp)
+        raise
+    if not res.get("ok"):
+        await add_wisp(wisp)
+        raise ledger_error(res)
+    if res.get("replayed"):  # this key already paid out for another wisp
+        await add_wisp(wisp)
+    return res
+
+# ── LIVE STREAM HUB (server-push deltas, see /api/stream) ──────────
+# reads who is online from _presence, so streams and /api/nearby agree
+_hub = StreamHub(_presence, queue_size=int(os.environ.get("SPAZZ_STREAM_QUEUE", "100")), view=user_view)
+
+# ── WORLD STATE (wisps + pings) ───────────────────────────────────
+# "memory" keeps them per instance (Vercel ephemeral); "sqlite:/path" shares
+# them between workers on one host so collects don't 404 across workers.
+_world = open_world_store(os.environ.get("SPAZZ_WORLD_STORE", "memory"), _sqlite_pool)
+
+# ── WISPS ─────────────────────────────────────────────────────────
+async def get_wisps():
+    return await _world.all_wisps()
+
+async def wisps_near(lat, lng, radius_m):
+    return await _world.wisps_near(lat, lng, radius_m)
+
+def wisp_view(w):
+    """Map-screen shape of a wisp."""
+    return {
+        "id": w["id"],
+        "lat": w["lat"],
+        "lng": w.get("lon", w.get("lng", 0)),
+        "xp": w.get("wisp_reward", 10),
+    }
+
+async def add_wisp(wisp):
+    # streams hear about it from publish_wisp_moves on the next tick
+    await _world.add_wisp(wisp)
+
+async def take_wisp(wisp_id):
+    """Atomically claim a wisp; None if it's gone (or another worker got it)."""
+    wisp = await _world.take_wisp(wisp_id) if wisp_id else None
+    if wisp:
+        _hub.remove_wisp(wisp_id, wisp["lat"], wisp["lon"])
+    return wisp
+
+async def spawn_wisp(lat, lng, spread=0.01):
+    wisp = {
+        "id": f"wisp_{uuid.uuid4().hex[:6]}",
+        "username": "Wisp",
+        "type": "wisp",
+        "lat": lat + random.uniform(-spread, spread),
+        "lon": lng + random.uniform(-spread, spread),
+        "wisp_class": "whisp-cyan",
+        "wisp_reward": random.choices([3, 5, 7, 10, 15, 20, 25], weights=[30, 25, 20, 12, 7, 4, 2])[0],
+        "spawned_at": time.time(),
+    }
+    await add_wisp(wisp)
+    return wisp
+
+async def publish_wisp_moves():
+    # every worker diffs its own streams against the (possibly shared) world
+    for sub in _hub.subscribers():
+        _hub.sync_wisps(sub, [wisp_view(w) for w, _ in await wisps_near(sub.lat, sub.lng, NEARBY_RADIUS_M)])
+
+# ── WORLD TICK (wisp movement, spawning, expiry) ──────────────────
+# Runs at a fixed rate so wisp speed no longer depends on request rate and
+# read handlers never mutate the world.
+WORLD_TICK_S = float(os.environ.get("SPAZZ_WORLD_TICK_S", "1"))
+WISP_DRIFT_DEG = 0.0001  # max drift per axis per tick
+WISP_TTL_S = 600
+WISPS_PER_HUNTER = 5
+REGION_M = 2000
+REGION_MAX_WISPS = 50
+HUNTER_TTL_S = 300
+WORLD_CATCHUP_TICKS = 3  # a loop this many ticks late is frozen (serverless); tick inline
+
+HUNTER_NOTE_S = 30  # how stale a hunter's stored position may get
+
+_instance_id = uuid.uuid4().hex
+_hunters_noted = {}  # user_id -> wall time this worker last stored their position
+_last_tick = [time.monotonic()]
+
+async def note_hunter(user_id, lat, lng):
+    """Hunters live in the world store, so the worker holding the tick lease
+    stocks wisps around hunters whose requests land on any worker."""
+    if not (lat and lng):
+        return
+    now = time.time()
+    if now - _hunters_noted.get(user_id, 0) >= HUNTER_NOTE_S:
+        _hunters_noted[user_id] = now
+        await _world.note_hunter(user_id, float(lat), float(lng), now)
+
+async def spawn_for_regions(now):
+    """Top every 2km region with active hunters up to WISPS_PER_HUNTER each."""
+    cell_deg = REGION_M / M_PER_DEG
+    regions = {}
+    for lat, lng in await _world.hunters(now - HUNTER_TTL_S):
+        regions.setdefault((math.floor(lat / cell_deg), math.floor(lng / cell_deg)), []).append((lat, lng))
+    for members in regions.values():
+        center_lat = sum(m[0] for m in members) / len(members)
+        center_lng = sum(m[1] for m in members) / len(members)
+        target = min(REGION_MAX_WISPS, WISPS_PER_HUNTER * len(members))
+        missing = target - len(await wisps_near(center_lat, center_lng, REGION_M))
+        for _ in range(missing):
+            anchor = random.choice(members)
+            await spawn_wisp(anchor[0], anchor[1])
+
+@_periodic.every(WORLD_TICK_S)
+async def world_tick():
+    mono = time.monotonic()
+    dt = mono - _last_tick[0]
+    _last_tick[0] = mono
+    now = time.time()
+    # with a shared store only one worker advances the world per tick; every
+    # worker then diffs it into its own streams
+    if await _world.try_lease("world_tick", _instance_id, WORLD_TICK_S * 3):
+        await _world.move_wisps(WISP_DRIFT_DEG * min(dt / WORLD_TICK_S, 5))
+        await _world.expire_wisps(now - WISP_TTL_S)
+        await spawn_for_regions(now)
+    for user_id in [k for k, t in _hunters_noted.items() if t < now - HUNTER_NOTE_S]:
+        del _hunters_noted[user_id]
+    await publish_wisp_moves()
+    _hub.prune_users()  # every worker's hub, so user_left goes out without a new subscriber
+
+async def ensure_world_fresh():
+    """Catch up inline if world_tick hasn't run lately, like
+    _ping_sync.ensure_fresh(); one tick, whose drift is capped anyway."""
+    if time.monotonic() - _last_tick[0] > WORLD_TICK_S * WORLD_CATCHUP_TICKS:
+        await world_tick()
+
+# ── HOTSPOTS (rows mirrored into a grid index) ──────────────
+# Loaded once and refreshed every HOTSPOT_TTL_S (or right away by
+# add_hotspot) instead of a full select per location update / map fetch.
+HOTSPOT_TTL_S = float(os.environ.get("SPAZZ_HOTSPOT_TTL_S", "60"))
+HOTSPOT_FLUSH_S = float(os.environ.get("SPAZZ_HOTSPOT_FLUSH_S", "30"))
+VISIT_GAP_S = 600  # must be outside a hotspot this long before a return counts again
+
+_hotspots = {}
+_hotspot_index = GridIndex(cell_m=1000)
+_hotspot_max_radius = [50]  # widest hotspot radius seen, bounds containment queries
+_hotspots_loaded = [0.0]
+_pending_visits = {}  # hotspot id -> visits not yet written
+_inside_since = {}  # (user_id, hotspot id) -> last time the user was seen inside
+
+def put_hotspot(hs):
+    hs = {**hs, "visit_count": (hs.get("visit_count") or 0) + _pending_visits.get(hs["id"], 0)}
+    _hotspots[hs["id"]] = hs
+    if not hs.get("lat") or not hs.get("lng"):
+        _hotspot_index.remove(hs["id"])
+        return
+    _hotspot_index.move(hs["id"], hs["lat"], hs["lng"])
+    _hotspot_max_radius[0] = max(_hotspot_max_radius[0], hs.get("radius") or 50)
+
+def sync_hotspots(rows):
+    """Bring the index in line with a fresh hotspots select, touching only
+    rows that were added, moved or dropped."""
+    seen = set()
+    for hs in rows:
+        seen.add(hs["id"])
+        put_hotspot(hs)
+    for hs_id in [k for k in _hotspots if k not in seen]:
+        _hotspots.pop(hs_id)
+        _hotspot_index.remove(hs_id)
+
+async def ensure_hotspots():
+    if time.monotonic() - _hotspots_loaded[0] < HOTSPOT_TTL_S:
+        return
+    result = await db(supabase.table("hotspots").select("*"))
+    sync_hotspots(result.data or [])
+    _hotspots_loaded[0] = time.monotonic()
+
+def record_visits(user_id, lat, lng, now):
+    """Count a visit when a user enters a hotspot, not on every location
+    update while they stay inside."""
+    for hs in hotspots_containing(lat, lng):
+        key = (user_id, hs["id"])
+        if _inside_since.get(key, 0) < now - VISIT_GAP_S:
+            _pending_visits[hs["id"]] = _pending_visits.get(hs["id"], 0) + 1
+            hs["visit_count"] = (hs.get("visit_count") or 0) + 1
+        _inside_since[key] = now
+
+@_periodic.every(HOTSPOT_FLUSH_S, final=True)
+async def flush_hotspot_visits():
+    """One atomic batched increment for everything counted since last flush."""
+    cutoff = time.time() - VISIT_GAP_S
+    for key in [k for k, t in _inside_since.items() if t < cutoff]:
+        del _inside_since[key]
+    if not _pending_visits:
+        return
+    batch = dict(_pending_visits)
+    _pending_visits.clear()
+    try:
+        await db(supabase.rpc("increment_hotspot_visits", {
+            "visits": [{"id": str(k), "n": n} for k, n in batch.items()],
+        }))
+    except Exception:
+        for k, n in batch.items():  # keep them for the next flush
+            _pending_visits[k] = _pending_visits.get(k, 0) + n
+        raise
 
-def move_wisps():
-    for w in _wisps.values():
-        w["lat"] += random.uniform(-0.0001, 0.0001)
-        w["lon"] += random.uniform(-0.0001, 0.0001)
+@_periodic.every(HOTSPOT_TTL_S)
+async def refresh_hotspots():
+    await ensure_hotspots()
+
+def hotspots_near(lat, lng, radius_m):
+    return [(_hotspots[k], d) for k, d in _hotspot_index.query(lat, lng, radius_m)]
+
+def hotspots_containing(lat, lng):
+    return [hs for hs, d in hotspots_near(lat, lng, _hotspot_max_radius[0]) if d < (hs.get("radius") or 50)]
 
 # ── ENDPOINTS ────────────────────────────
 
 @app.post("/api/register")
 async def register(req: RegisterRequest):
     # Check username taken
-    existing = supabase.table("users").select("id").eq("username", req.username).execute()
+    existing = await db(supabase.table("users").select("id").eq("username", req.username))
     if existing.data:
         raise HTTPException(400, "Username taken")
 
     user_id = f"user_{uuid.uuid4().hex[:8]}"
-    token = make_token(user_id)
 
-    supabase.table("users").insert({
+    row = {
         "id": user_id,
         "username": req.username,
         "password_hash": hash_password(req.password),
-        "token": token,
         "age": req.age,
         "gender": req.gender,
         "seeking": req.seeking,
@@ -160,97 +791,96 @@ async def register(req: RegisterRequest):
         "xp": 0,
         "is_admin": False,
         "is_premium": False,
-    }).execute()
+    }
+    await db(supabase.table("users").insert(row))
+    token = await start_session(row)
 
     return {"token": token, "user_id": user_id, "username": req.username, "is_admin": False}
 
 @app.post("/api/login")
 async def login(req: LoginRequest):
-    result = supabase.table("users").select("*").eq("username", req.username).limit(1).execute()
+    result = await db(supabase.table("users").select("*").eq("username", req.username).limit(1))
     if not result.data:
         raise HTTPException(401, "Bad credentials")
     user = result.data[0]
     if user["password_hash"] != hash_password(req.password):
         raise HTTPException(401, "Bad credentials")
 
-    token = make_token(user["id"])
-    supabase.table("users").update({"token": token}).eq("id", user["id"]).execute()
+    token = await start_session(user)
 
     is_admin = user["id"] in ADMIN_IDS or user["username"].lower() == "ben"
     return {"token": token, "user_id": user["id"], "username": user["username"], "is_admin": is_admin}
 
+@app.post("/api/logout")
+async def logout(auth=Depends(get_current_user)):
+    """Signs the account out on every device."""
+    await revoke_sessions(auth["id"])
+    return {"status": "logged_out"}
+
 @app.post("/api/location")
-async def update_location(loc: LocationUpdate, auth=Depends(get_current_user)):
+async def update_location(loc: LocationUpdate, auth=Depends(rate_limited("location"))):
     user = auth
-    last_lat = user.get("last_lat")
-    last_lon = user.get("last_lon")
-    distance_m = user.get("distance_m", 0) or 0
-
-    if last_lat and last_lon:
-        dist = haversine(float(last_lat), float(last_lon), loc.lat, loc.lon)
-        if 3 < dist < 500:
-            distance_m += dist
+    lat, lon = check_coords(loc.lat, loc.lon)
+    fields = location_fields(user, lat, lon)
+    await store_location(user, fields)
+    _hub.publish_user(user_view(user, lat, lon))
+    await note_hunter(user["id"], lat, lon)
+
+    return {"status": "ok", "steps": fields["steps"], "calories": fields["calories"]}
+
+@app.post("/api/location/batch")
+async def upload_trace(trace: LocationTrace, auth=Depends(rate_limited("location_batch"))):
+    """Background/offline GPS trace in one request instead of one per fix."""
+    points = trace_points(trace)
+    if len(points) > TRACE_MAX_POINTS:
+        raise HTTPException(413, f"At most {TRACE_MAX_POINTS} points per upload")
+    user = auth
+    fields, accepted, rejected, added = trace_fields(user, points)
+    if not accepted:
+        return {"status": "empty", "accepted": 0, "rejected": rejected}
 
-    steps = meters_to_steps(distance_m)
-    calories = round(meters_to_calories(distance_m, user.get("age", 25)), 1)
+    lat, lng = fields["lat"], fields["lon"]
+    try:
+        await ensure_hotspots()
+        record_visits(user["id"], lat, lng, time.time())
+    except:
+        pass
 
-    supabase.table("users").update({
-        "lat": loc.lat,
-        "lon": loc.lon,
-        "last_lat": loc.lat,
-        "last_lon": loc.lon,
-        "distance_m": distance_m,
-        "steps": steps,
-        "calories": calories,
-        "online": True,
-        "last_seen": time.time()
-    }).eq("id", user["id"]).execute()
+    await store_location(user, fields)
+    _hub.publish_user(user_view(user, lat, lng))
+    await note_hunter(user["id"], lat, lng)
 
-    return {"status": "ok", "steps": steps, "calories": calories}
+    return {
+        "status": "ok", "accepted": accepted, "rejected": rejected,
+        "distance_added": round(added, 1), "steps": fields["steps"], "calories": fields["calories"],
+    }
 
 @app.get("/api/users")
-async def get_users(auth=Depends(get_current_user)):
+async def get_users(request: Request, auth=Depends(get_current_user)):
     is_admin = auth["id"] in ADMIN_IDS or auth["username"].lower() == "ben"
 
-    # Get online users from Supabase
-    result = supabase.table("users").select("*").eq("online", True).execute()
-    online_users = result.data or []
-
-    # Manage wisps in memory
-    move_wisps()
-    wisps = get_wisps()
-    target_wisps = max(10, len(online_users) * 5)
-
-    if len(wisps) < target_wisps and online_users:
-        for _ in range(target_wisps - len(wisps)):
-            anchor = random.choice(online_users)
-            wisp = {
-                "id": f"wisp_{uuid.uuid4().hex[:6]}",
-                "username": "Wisp",
-                "type": "wisp",
-                "lat": anchor["lat"] + random.uniform(-0.02, 0.02) if anchor.get("lat") else 39.333 + random.uniform(-0.02, 0.02),
-                "lon": anchor["lon"] + random.uniform(-0.02, 0.02) if anchor.get("lon") else -82.982 + random.uniform(-0.02, 0.02),
-                "wisp_class": "whisp-cyan",
-                "wisp_reward": random.choices([3, 5, 7, 10, 15, 20, 25], weights=[30, 25, 20, 12, 7, 4, 2])[0]
-            }
-            add_wisp(wisp)
+    await ensure_presence()
+
+    # Wisps are moved and spawned by world_tick, which only runs here when
+    # the loop has stalled (ensure_world_fresh); otherwise this is a read
+    await note_hunter(auth["id"], auth.get("lat"), auth.get("lon"))
+    await ensure_world_fresh()
 
     current_user = auth
     coach_tip = smart_coach_tip(current_user)
 
     entities = []
-    for u in online_users:
-        if u["id"] != auth["id"]:
-            entities.append({
-                "id": u["id"], "username": u["username"], "type": "user",
-                "lat": u.get("lat", 0), "lon": u.get("lon", 0),
-                "gender": u.get("gender", "other"), "age": u.get("age", 25),
-                "is_premium": u.get("is_premium", False)
-            })
+    for u, lat, lng in _presence.online(exclude=auth["id"]):
+        entities.append({
+            "id": u["id"], "username": u["username"], "type": "user",
+            "lat": lat, "lon": lng,
+            "gender": u["gender"], "age": u["age"],
+            "is_premium": u["is_premium"]
+        })
 
-    entities += get_wisps()
+    entities += await get_wisps()
 
-    return {
+    payload = {
         "entities": entities,
         "me": {
             "id": current_user["id"],
@@ -266,10 +896,12 @@ async def get_users(auth=Depends(get_current_user)):
         "coach_tip": coach_tip,
         "is_admin": is_admin,
     }
+    # a fresh coach tip alone isn't worth re-sending the map
+    return respond(request, payload, version_of=[entities, payload["me"], is_admin])
 
 @app.get("/api/me")
 async def get_me(auth=Depends(get_current_user)):
-    return {
+    return FastJSONResponse({
         "id": auth["id"],
         "username": auth["username"],
         "steps": auth.get("steps", 0),
@@ -279,74 +911,161 @@ async def get_me(auth=Depends(get_current_user)):
         "credits": auth.get("wisp_coins", 0),
         "level": auth.get("level", 1),
         "is_premium": auth.get("is_premium", False),
-    }
+    })
+
+async def ensure_leaderboard():
+    if _leaderboard.loaded_at and time.monotonic() - _leaderboard.loaded_at < LEADERBOARD_REFRESH_S:
+        return
+    rows, last = [], ""
+    while True:  # PostgREST caps a select at 1000 rows
+        page = (await db(supabase.table("users").select("id,username,xp,steps,wisp_coins")
+                         .gt("id", last).order("id").limit(1000))).data or []
+        rows += page
+        if len(page) < 1000:
+            break
+        last = page[-1]["id"]
+    _leaderboard.load(rows)
+    _leaderboard.loaded_at = time.monotonic()
+
+@_periodic.every(LEADERBOARD_REFRESH_S)
+async def refresh_leaderboard():
+    if _leaderboard.loaded_at:  # nobody has asked for it yet
+        await ensure_leaderboard()
 
 @app.get("/api/leaderboard")
-async def leaderboard(auth=Depends(get_current_user)):
-    result = supabase.table("users").select("id,username,xp,steps,wisp_coins").order("xp", desc=True).limit(20).execute()
-    users = result.data or []
-    return {"leaderboard": [
-        {"rank": i+1, "username": u["username"], "wisps": u.get("xp", 0),
-         "steps": u.get("steps", 0), "credits": u.get("wisp_coins", 0),
+async def leaderboard(request: Request, auth=Depends(get_current_user)):
+    await ensure_leaderboard()
+    if _leaderboard.rank(auth["id"]) is None:
+        _leaderboard.put(auth["id"], auth)
+    my_rank = _leaderboard.rank(auth["id"])
+    # the board is shared, but my_rank / is_me make the body per-user
+    etag = f'W/"lb-{_leaderboard.version}-{my_rank}-{auth["id"]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse({"leaderboard": [
+        {"rank": u["rank"], "username": u["username"], "wisps": u.get("xp") or 0,
+         "steps": u.get("steps") or 0, "credits": u.get("wisp_coins") or 0,
          "is_me": u["id"] == auth["id"]}
-        for i, u in enumerate(users)
-    ]}
+        for u in _leaderboard.top()
+    ], "my_rank": my_rank, "total": len(_leaderboard)}, headers=headers)
 
 @app.post("/api/collect/{target_id}")
-async def collect_target(target_id: str, auth=Depends(get_current_user)):
-    wisp = _wisps.get(target_id)
+async def collect_target(target_id: str, request: Request, auth=Depends(rate_limited("collect"))):
+    key = idempotency_key(request)
+    wisp = await take_wisp(target_id)
     if not wisp:
-        raise HTTPException(404, "Wisp not found or already collected")
-
-    reward = wisp.get("wisp_reward", random.randint(3, 10))
-    remove_wisp(target_id)
-
-    # Update user stats in Supabase
-    user = auth
-    new_coins = (user.get("wisp_coins", 0) or 0) + reward
-    new_xp = (user.get("xp", 0) or 0) + 1
-    new_level = max(1, new_xp // 10 + 1)
-
-    supabase.table("users").update({
-        "wisp_coins": new_coins,
-        "xp": new_xp,
-        "level": new_level
-    }).eq("id", auth["id"]).execute()
+        res = await ledger_replay(auth["id"], "collect", key)
+        if not res:
+            raise HTTPException(404, "Wisp not found or already collected")
+    else:
+        reward = wisp.get("wisp_reward", random.randint(3, 10))
+        res = await collect_wisp_reward(wisp, auth["id"], key, coins=reward, xp=1, xp_per_level=10,
+                                        extra={"reward": reward})
 
-    return {"new_balance": new_coins, "reward": reward, "wisps_collected": new_xp, "status": "success"}
+    return {"new_balance": res["wisp_coins"], "reward": res.get("reward", 0), "wisps_collected": res["xp"], "status": "success"}
 
 @app.post("/api/chat/send")
-async def send_message(msg: ChatMessage, auth=Depends(get_current_user)):
-    supabase.table("chat_messages").insert({
+async def send_message(msg: ChatMessage, auth=Depends(rate_limited("chat"))):
+    await db(supabase.table("chat_messages").insert({
         "user_id": auth["id"],
         "username": auth["username"],
         "to_user_id": msg.to_user_id,
         "message": msg.message
-    }).execute()
+    }))
     return {"status": "sent"}
 
+CHAT_PAGE_MAX = 100
+
+def chat_cursor(m):
+    """Opaque keyset cursor: the (created_at, id) of the oldest message shown."""
+    raw = json.dumps([m["created_at"], m["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def parse_chat_cursor(cursor):
+    try:
+        created_at, msg_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return created_at, msg_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Bad cursor")
+
 @app.get("/api/chat/inbox")
-async def get_inbox(auth=Depends(get_current_user)):
-    sent = supabase.table("chat_messages").select("*").eq("user_id", auth["id"]).execute().data or []
-    received = supabase.table("chat_messages").select("*").eq("to_user_id", auth["id"]).execute().data or []
-    all_msgs = sent + received
+async def get_inbox(per_conversation: int = 20, limit: int = 30, auth=Depends(get_current_user)):
+    per_conversation = max(1, min(per_conversation, CHAT_PAGE_MAX))
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+    rows = (await db(supabase.rpc("chat_inbox", {
+        "p_user_id": auth["id"], "p_per_partner": per_conversation, "p_partners": limit,
+    }))).data or []
+    # rows come grouped by conversation (most recent first), newest message first
     convos = {}
-    for m in all_msgs:
-        partner_id = m["to_user_id"] if m["user_id"] == auth["id"] else m["user_id"]
-        if partner_id not in convos:
-            convos[partner_id] = {"partner_id": partner_id, "messages": []}
-        convos[partner_id]["messages"].append(m)
+    for r in rows:
+        c = convos.get(r["partner_id"])
+        if c is None:
+            c = convos[r["partner_id"]] = {
+                "partner_id": r["partner_id"],
+                "last_message_at": r["last_message_at"],
+                "unread": r["unread"],
+                "total": r["total"],
+                "messages": [],
+                "next_cursor": None,
+            }
+        c["messages"].append({k: v for k, v in r.items() if k not in ("partner_id", "rn", "unread", "total", "last_message_at")})
+    for c in convos.values():
+        c["messages"].reverse()
+        if c["total"] > len(c["messages"]):
+            c["next_cursor"] = chat_cursor(c["messages"][0])
     return {"conversations": list(convos.values())}
 
+@app.get("/api/chat/conversation/{partner_id}")
+async def get_conversation(partner_id: str, before: Optional[str] = None, limit: int = 50, auth=Depends(get_current_user)):
+    """One conversation, oldest first; pass next_cursor back as `before` for older messages."""
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+    before_ts, before_id = parse_chat_cursor(before) if before else (None, None)
+    rows = (await db(supabase.rpc("chat_history", {
+        "p_user_id": auth["id"], "p_partner_id": partner_id,
+        "p_before": before_ts, "p_before_id": before_id, "p_limit": limit + 1,
+    }))).data or []
+    more = len(rows) > limit
+    messages = rows[:limit][::-1]
+    return {
+        "partner_id": partner_id,
+        "messages": messages,
+        "next_cursor": chat_cursor(messages[0]) if more else None,
+    }
+
+@app.get("/api/chat/summary")
+async def get_chat_summary(auth=Depends(get_current_user)):
+    """Unread/total counts per conversation without any message bodies."""
+    rows = (await db(supabase.rpc("chat_summary", {"p_user_id": auth["id"]}))).data or []
+    return {"conversations": rows, "unread": sum(r["unread"] for r in rows)}
+
+@app.post("/api/chat/read/{partner_id}")
+async def mark_chat_read(partner_id: str, auth=Depends(get_current_user)):
+    await db(supabase.table("chat_messages").update({"read_at": format_ts(time.time())})
+             .eq("to_user_id", auth["id"]).eq("user_id", partner_id).is_("read_at", "null"))
+    return {"status": "read"}
+
+# index.html and static/ are read once at startup (SPAZZ_DEV_RELOAD=1 re-reads
+# changed files per request instead)
+_assets = AssetCache(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."),
+    files=["index.html"], dirs=["static"],
+    hot_reload=os.environ.get("SPAZZ_DEV_RELOAD") == "1",
+)
+STATIC_CACHE_CONTROL = os.environ.get("SPAZZ_STATIC_CACHE_CONTROL", "public, max-age=3600, stale-while-revalidate=86400")
+
 @app.get("/", response_class=HTMLResponse)
-async def read_index():
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    root_index = os.path.join(BASE_DIR, "..", "index.html")
-    try:
-        with open(root_index, "r", encoding="utf-8") as f:
-            return f.read()
-    except:
-        return "Error: index.html not found."
+async def read_index(request: Request):
+    # no-cache: browsers revalidate every load, which costs a 304
+    res = _assets.respond(request, "index.html", "no-cache")
+    return res or HTMLResponse("Error: index.html not found.")
+
+@app.get("/static/{path:path}")
+async def read_static(path: str, request: Request):
+    res = _assets.respond(request, f"static/{path}", STATIC_CACHE_CONTROL)
+    if res is None:
+        raise HTTPException(404, "Not found")
+    return res
 
 # ─────────────────────────────────────────
 # 🛍️ SHOP CATALOG
@@ -368,6 +1087,35 @@ SHOP_ITEMS = [
     {"id":"flash_galaxy",   "type":"flash","name":"Galaxy Spin",  "desc":"Spiral star explosion",     "price":450, "preview":"🌀","premium":True},
     {"id":"flash_glitch",   "type":"flash","name":"Glitch",       "desc":"Digital distortion",        "price":350, "preview":"📺","premium":True},
 ]
+SHOP_BY_ID = {i["id"]: i for i in SHOP_ITEMS}
+SHOP_BY_TYPE = {}
+for _item in SHOP_ITEMS:
+    SHOP_BY_TYPE.setdefault(_item["type"], []).append(_item)
+
+# the catalog only changes on deploy: serialize it once, serve it cacheable
+_catalog_body = dumps({"items": SHOP_ITEMS, "types": list(SHOP_BY_TYPE)})
+# each item's JSON minus the closing brace, so /api/shop only appends flags
+_shop_item_heads = [dumps(item)[:-1] for item in SHOP_ITEMS]
+_catalog_etag = f'"{hashlib.sha1(_catalog_body).hexdigest()[:16]}"'
+
+# user_id -> {"owned": set of item ids, "equipped": {category: item id}}
+_inventories = TTLCache(
+    maxsize=int(os.environ.get("SPAZZ_INVENTORY_CACHE_SIZE", "4096")),
+    ttl=int(os.environ.get("SPAZZ_INVENTORY_CACHE_TTL", "300")),
+)
+
+async def get_inventory(user_id):
+    """Owned and equipped items from one inventory read, cached per user
+    and dropped on buy/equip."""
+    inv = _inventories.get(user_id)
+    if inv is None:
+        rows = (await db(supabase.table("inventory").select("item_name,item_type,item_category").eq("user_id", user_id))).data or []
+        inv = {
+            "owned": {r["item_name"] for r in rows},
+            "equipped": {r.get("item_category", ""): r["item_name"] for r in rows if r.get("item_type") == "equipped"},
+        }
+        _inventories.set(user_id, inv)
+    return inv
 
 PREMIUM_COACH_TIPS = {
     "dating": [
@@ -393,121 +1141,206 @@ PREMIUM_COACH_TIPS = {
     ]
 }
 
+_premium_tips_body = dumps({"tips": PREMIUM_COACH_TIPS})
+
+@app.get("/api/shop/catalog")
+async def shop_catalog(request: Request):
+    """Public and immutable per deploy; clients can cache it and only fetch
+    their inventory from /api/shop."""
+    headers = {"ETag": _catalog_etag, "Cache-Control": "public, max-age=86400, stale-while-revalidate=604800"}
+    if request.headers.get("If-None-Match") == _catalog_etag:
+        return Response(status_code=304, headers=headers)
+    return Response(_catalog_body, media_type="application/json", headers=headers)
+
+def shop_body(inv, is_premium):
+    """/api/shop JSON: the pre-serialized item heads plus this user's flags."""
+    owned_ids = inv["owned"]
+    equipped = inv["equipped"]
+    items = []
+    for item, head in zip(SHOP_ITEMS, _shop_item_heads):
+        owned = b"true" if item["id"] in owned_ids else b"false"
+        on = b"true" if equipped.get(item["type"]) == item["id"] else b"false"
+        items.append(head + b',"owned":' + owned + b',"equipped":' + on + b"}")
+    return (
+        b'{"items":[' + b",".join(items) + b'],"equipped":' + dumps(equipped) + b',"owned":' + dumps(sorted(owned_ids))
+        + b',"is_premium":' + dumps(is_premium) + b"}"
+    )
+
 @app.get("/api/shop")
 async def get_shop(auth=Depends(get_current_user)):
-    inv_result = supabase.table("inventory").select("*").eq("user_id", auth["id"]).execute()
-    owned_ids = [r["item_name"] for r in (inv_result.data or [])]
-    equipped_result = supabase.table("inventory").select("*").eq("user_id", auth["id"]).eq("item_type", "equipped").execute()
-    equipped = {}
-    for r in (equipped_result.data or []):
-        equipped[r.get("item_category", "")] = r["item_name"]
-
-    items = []
-    for item in SHOP_ITEMS:
-        i = dict(item)
-        i["owned"] = item["id"] in owned_ids
-        i["equipped"] = equipped.get(item["type"]) == item["id"]
-        items.append(i)
-    return {"items": items, "equipped": equipped, "is_premium": auth.get("is_premium", False)}
+    inv = await get_inventory(auth["id"])
+    return RawJSONResponse(shop_body(inv, auth.get("is_premium", False)))
 
 @app.post("/api/shop/buy/{item_id}")
-async def buy_item(item_id: str, auth=Depends(get_current_user)):
-    item = next((i for i in SHOP_ITEMS if i["id"] == item_id), None)
+async def buy_item(item_id: str, request: Request, auth=Depends(get_current_user)):
+    item = SHOP_BY_ID.get(item_id)
     if not item:
         raise HTTPException(404, "Item not found")
-
-    inv_result = supabase.table("inventory").select("item_name").eq("user_id", auth["id"]).execute()
-    owned_ids = [r["item_name"] for r in (inv_result.data or [])]
-    if item_id in owned_ids:
+    # items are never taken away, so a cached "owned" can't be stale; a
+    # keyed retry goes through so it gets the first purchase replayed
+    key = idempotency_key(request)
+    if not key and item_id in (await get_inventory(auth["id"]))["owned"]:
         raise HTTPException(400, "Already owned")
 
-    if item.get("premium") and not auth.get("is_premium"):
-        raise HTTPException(403, "Premium required")
-
-    user_result = supabase.table("users").select("wisp_coins").eq("id", auth["id"]).execute()
-    coins = user_result.data[0]["wisp_coins"] if user_result.data else 0
-    if coins < item["price"]:
-        raise HTTPException(400, f"Need {item['price']} coins, you have {coins}")
-
-    supabase.table("users").update({"wisp_coins": coins - item["price"]}).eq("id", auth["id"]).execute()
-    supabase.table("inventory").insert({
-        "user_id": auth["id"],
-        "item_name": item_id,
-        "item_type": "owned"
-    }).execute()
+    res = await ledger_apply(auth["id"], "buy", key, coins=-item["price"],
+                             item_id=item_id, premium_required=bool(item.get("premium")))
+    _inventories.pop(auth["id"])
+    if not res.get("ok"):
+        if res.get("error") == "insufficient_funds":
+            raise ledger_error(res, f"Need {item['price']} coins, you have {res['wisp_coins']}")
+        raise ledger_error(res)
 
-    return {"status": "purchased", "new_balance": coins - item["price"], "item": item}
+    return {"status": "purchased", "new_balance": res["wisp_coins"], "item": item}
 
 @app.post("/api/shop/equip/{item_id}")
 async def equip_item(item_id: str, auth=Depends(get_current_user)):
-    item = next((i for i in SHOP_ITEMS if i["id"] == item_id), None)
+    item = SHOP_BY_ID.get(item_id)
     if not item:
         raise HTTPException(404, "Item not found")
 
-    inv_result = supabase.table("inventory").select("item_name").eq("user_id", auth["id"]).execute()
-    owned_ids = [r["item_name"] for r in (inv_result.data or [])]
-    if item_id not in owned_ids:
-        raise HTTPException(403, "Not owned")
+    if item_id not in (await get_inventory(auth["id"]))["owned"]:
+        _inventories.pop(auth["id"])  # maybe bought through another instance
+        if item_id not in (await get_inventory(auth["id"]))["owned"]:
+            raise HTTPException(403, "Not owned")
 
-    # Remove old equipped of same type
-    supabase.table("inventory").delete().eq("user_id", auth["id"]).eq("item_type", "equipped").eq("item_category", item["type"]).execute()
-    supabase.table("inventory").insert({
+    # one equipped row per (user, category), replaced in place
+    await db(supabase.table("inventory").upsert({
         "user_id": auth["id"],
         "item_name": item_id,
         "item_type": "equipped",
         "item_category": item["type"]
-    }).execute()
+    }, on_conflict="user_id,item_type,item_category"))
+    _inventories.pop(auth["id"])
 
     return {"status": "equipped", "item_id": item_id}
 
 @app.post("/api/premium/subscribe")
-async def subscribe_premium(auth=Depends(get_current_user)):
-    user_result = supabase.table("users").select("wisp_coins,is_premium").eq("id", auth["id"]).execute()
-    if not user_result.data:
-        raise HTTPException(404, "User not found")
-    user = user_result.data[0]
+async def subscribe_premium(request: Request, auth=Depends(get_current_user)):
     SUBSCRIPTION_PRICE = 299
-    if user["wisp_coins"] < SUBSCRIPTION_PRICE:
-        raise HTTPException(400, f"Need {SUBSCRIPTION_PRICE} coins")
-    supabase.table("users").update({
-        "wisp_coins": user["wisp_coins"] - SUBSCRIPTION_PRICE,
-        "is_premium": True
-    }).eq("id", auth["id"]).execute()
-    return {"status": "subscribed", "new_balance": user["wisp_coins"] - SUBSCRIPTION_PRICE}
+    res = await ledger_apply(auth["id"], "subscribe", idempotency_key(request),
+                             coins=-SUBSCRIPTION_PRICE, set_premium=True)
+    if not res.get("ok"):
+        if res.get("error") == "insufficient_funds":
+            raise ledger_error(res, f"Need {SUBSCRIPTION_PRICE} coins")
+        raise ledger_error(res)
+    return {"status": "subscribed", "new_balance": res["wisp_coins"]}
 
 @app.get("/api/premium/tips")
 async def premium_tips(auth=Depends(get_current_user)):
     if not auth.get("is_premium"):
         raise HTTPException(403, "Premium only")
-    return {"tips": PREMIUM_COACH_TIPS}
+    return RawJSONResponse(_premium_tips_body)
 
 @app.get("/api/hotspots")
 async def get_hotspots(auth=Depends(get_current_user)):
-    result = supabase.table("hotspots").select("*").execute()
-    return {"hotspots": result.data or []}
+    await ensure_hotspots()
+    return {"hotspots": list(_hotspots.values())}
 
 @app.post("/api/hotspots/add")
 async def add_hotspot(request: Request, auth=Depends(get_current_user)):
     if auth["id"] not in ADMIN_IDS and auth["username"].lower() != "ben":
         raise HTTPException(403, "Admin only")
     body = await request.json()
-    supabase.table("hotspots").insert({
+    lat, lng = check_coords(body.get("lat"), body.get("lng"))
+    result = await db(supabase.table("hotspots").insert({
         "name": body.get("name", "Hotspot"),
-        "lat": body["lat"],
-        "lng": body["lng"],
+        "lat": lat,
+        "lng": lng,
         "radius": body.get("radius", 50),
         "wisp_reward": body.get("wisp_reward", 10)
-    }).execute()
+    }))
+    for hs in (result.data or []):
+        put_hotspot(hs)
     return {"status": "added"}
 
 @app.post("/api/admin/shadow-ban/{target_id}")
 async def shadow_ban(target_id: str, auth=Depends(get_current_user)):
     if auth["id"] not in ADMIN_IDS and auth["username"].lower() != "ben":
         raise HTTPException(403, "Admin only")
-    supabase.table("users").update({"is_admin": False}).eq("id", target_id).execute()
+    await update_user(target_id, {"is_admin": False})
     return {"status": "banned", "target": target_id}
 
+@app.post("/api/admin/revoke-sessions/{target_id}")
+async def admin_revoke_sessions(target_id: str, auth=Depends(get_current_user)):
+    if auth["id"] not in ADMIN_IDS and auth["username"].lower() != "ben":
+        raise HTTPException(403, "Admin only")
+    await revoke_sessions(target_id)
+    return {"status": "revoked", "target": target_id}
+
+@app.get("/api/admin/cache-stats")
+async def cache_stats(auth=Depends(get_current_user)):
+    if auth["id"] not in ADMIN_IDS and auth["username"].lower() != "ben":
+        raise HTTPException(403, "Admin only")
+    return {"sessions": _sessions.stats(), "inventories": _inventories.stats(), "nearby": _nearby_log.stats(),
+            "assets": _assets.stats(), "presence": _presence.stats(), "google_keys": _google_keys.stats(),
+            "leaderboard": {"users": len(_leaderboard), "version": _leaderboard.version}}
+
+@app.get("/api/admin/rate-stats")
+async def rate_stats(auth=Depends(get_current_user)):
+    if auth["id"] not in ADMIN_IDS and auth["username"].lower() != "ben":
+        raise HTTPException(403, "Admin only")
+    return {"limits": _limiter.stats()}
+
+# world store counts are async, so they are read just before each scrape
+_world_counts = {"wisps": 0, "pings": 0}
+_metrics.gauge("wisps", "Live wisps in the world store.", lambda: _world_counts["wisps"])
+_metrics.gauge("pings", "Live pings in the world store.", lambda: _world_counts["pings"])
+_metrics.gauge("stream_clients", "Open /api/stream connections.", lambda: len(_hub))
+_metrics.gauge("online_users", "Users with a heartbeat inside the presence window.", lambda: len(_presence))
+_metrics.gauge("sessions", "Cached sessions.", lambda: len(_sessions))
+_metrics.gauge("locations_pending", "Buffered location writes not yet flushed.", lambda: len(_locations))
+_metrics.gauge("db_in_flight", "Supabase calls running.", lambda: _db_pool.in_flight)
+_metrics.gauge("db_waiting", "Supabase calls queued for a pool slot.", lambda: _db_pool.waiting)
+
+@app.get("/api/admin/metrics")
+async def metrics(auth=Depends(get_current_user)):
+    """Prometheus text format."""
+    if auth["id"] not in ADMIN_IDS and auth["username"].lower() != "ben":
+        raise HTTPException(403, "Admin only")
+    _world_counts["wisps"], _world_counts["pings"] = await _world.wisp_count(), await _world.ping_count()
+    return Response(_metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/admin/db-stats")
+async def db_stats(auth=Depends(get_current_user)):
+    if auth["id"] not in ADMIN_IDS and auth["username"].lower() != "ben":
+        raise HTTPException(403, "Admin only")
+    return {"db": _db_pool.stats(), "http": _http_pool.stats(), "sqlite": _sqlite_pool.stats(),
+            "locations": _locations.stats()}
+
 # ── GOOGLE AUTH ───────────────────────────────────────
+# ID tokens are verified locally against Google's signing keys, cached per
+# the certs response's max-age and refreshed in the background, so sign-in
+# makes no call to Google. SPAZZ_GOOGLE_CLIENT_IDS (comma-separated) pins
+# the accepted audiences; without it any app's Google token for an email
+# would sign in as that account, so sign-in is refused unless SPAZZ_DEV=1.
+GOOGLE_CLIENT_IDS = tuple(c.strip() for c in os.environ.get("SPAZZ_GOOGLE_CLIENT_IDS", "").split(",") if c.strip())
+GOOGLE_ANY_AUDIENCE = os.environ.get("SPAZZ_DEV") == "1"
+GOOGLE_KEYS_CHECK_S = 600
+
+async def fetch_google_keys():
+    return await _http_pool.run(fetch_google_certs)
+
+_google_keys = GoogleKeys(fetch_google_keys)
+
+@_periodic.every(GOOGLE_KEYS_CHECK_S)
+async def refresh_google_keys():
+    if _google_keys.fetched_at:  # nobody has signed in with Google yet
+        await _google_keys.refresh_if_stale()
+
+def username_base(email):
+    return email.split("@")[0].replace(".", "_").replace("+", "_")[:20]
+
+async def allocate_username(base):
+    """base, or base<n> with the smallest free n, from one query for every
+    username of that shape."""
+    pattern = "^" + re.escape(base) + "[0-9]*$"
+    rows = (await db(supabase.table("users").select("username").filter("username", "match", pattern))).data or []
+    taken = {r["username"] for r in rows}
+    if base not in taken:
+        return base
+    suffixes = {int(name[len(base):]) for name in taken if name[len(base):].isdigit()}
+    return f"{base}{next(n for n in itertools.count(1) if n not in suffixes)}"
+
 class GoogleAuthRequest(BaseModel):
     id_token: str
     email: str
@@ -517,37 +1350,29 @@ class GoogleAuthRequest(BaseModel):
 async def google_auth(req: GoogleAuthRequest):
     """
     Accepts a Google ID token from the Flutter app,
-    verifies it via Google's tokeninfo endpoint,
-    then creates or finds the user in Supabase and returns a Spazz JWT.
+    verifies it against Google's cached signing keys,
+    then creates or finds the user in Supabase and returns a signed Spazz session token.
     """
-    import urllib.request
-    import urllib.parse
-
-    # Verify token with Google
+    if not GOOGLE_CLIENT_IDS and not GOOGLE_ANY_AUDIENCE:
+        raise HTTPException(503, "Google sign-in is not configured")
     try:
-        url = f"https://oauth2.googleapis.com/tokeninfo?id_token={req.id_token}"
-        with urllib.request.urlopen(url, timeout=5) as resp:
-            token_info = json.loads(resp.read().decode())
+        token_info = await verify_id_token(req.id_token, _google_keys, GOOGLE_CLIENT_IDS)
+    except ValueError as e:
+        raise HTTPException(401, f"Invalid Google token: {e}")
     except Exception as e:
-        raise HTTPException(401, f"Google token verification failed: {str(e)}")
-
-    if token_info.get("error"):
-        raise HTTPException(401, "Invalid Google token")
+        raise HTTPException(503, f"Google signing keys unavailable: {e}")
 
-    google_email = token_info.get("email")
-    if not google_email:
-        raise HTTPException(401, "No email in Google token")
+    google_email = token_info["email"]
 
     # Normalize email to a safe username
-    base_username = google_email.split("@")[0].replace(".", "_").replace("+", "_")[:20]
+    base_username = username_base(google_email)
 
     # Check if user already exists by email
-    existing = supabase.table("users").select("*").eq("email", google_email).limit(1).execute()
+    existing = await db(supabase.table("users").select("*").eq("email", google_email).limit(1))
 
     if existing.data:
         user = existing.data[0]
-        token = make_token(user["id"])
-        supabase.table("users").update({"token": token}).eq("id", user["id"]).execute()
+        token = await start_session(user)
         is_admin = user["id"] in ADMIN_IDS or user.get("username", "").lower() == "ben"
         return {
             "token": token,
@@ -560,22 +1385,13 @@ async def google_auth(req: GoogleAuthRequest):
     user_id = "user_" + str(uuid.uuid4())[:8]
 
     # Make sure username is unique
-    username = base_username
-    suffix = 1
-    while True:
-        check = supabase.table("users").select("id").eq("username", username).limit(1).execute()
-        if not check.data:
-            break
-        username = f"{base_username}{suffix}"
-        suffix += 1
+    username = await allocate_username(base_username)
 
-    token = make_token(user_id)
-    supabase.table("users").insert({
+    row = {
         "id": user_id,
         "username": username,
         "email": google_email,
         "password_hash": "",  # no password for Google users
-        "token": token,
         "xp": 0,
         "level": 1,
         "wisp_coins": 50,
@@ -583,7 +1399,9 @@ async def google_auth(req: GoogleAuthRequest):
         "calories": 0,
         "distance_m": 0,
         "is_premium": False,
-    }).execute()
+    }
+    await db(supabase.table("users").insert(row))
+    token = await start_session(row)
 
     return {
         "token": token,
@@ -595,170 +1413,101 @@ async def google_auth(req: GoogleAuthRequest):
 # ── FLUTTER MAP ENDPOINTS ─────────────────────────────────────────
 
 @app.post("/api/location/update")
-async def location_update_flutter(request: Request, auth=Depends(get_current_user)):
+async def location_update_flutter(request: Request, auth=Depends(rate_limited("location"))):
     """Flutter map screen pings this every 30s with lat/lng."""
     body = await request.json()
     lat = body.get("lat")
     lng = body.get("lng")
     if lat is None or lng is None:
         raise HTTPException(400, "lat and lng required")
+    lat, lng = check_coords(lat, lng)
 
     user = auth
-    last_lat = user.get("last_lat")
-    last_lon = user.get("last_lon")
-    distance_m = user.get("distance_m", 0) or 0
-
-    if last_lat and last_lon:
-        dist = haversine(float(last_lat), float(last_lon), lat, lng)
-        if 3 < dist < 500:
-            distance_m += dist
+    fields = location_fields(user, lat, lng)
 
-    steps = meters_to_steps(distance_m)
-    calories = round(meters_to_calories(distance_m, user.get("age", 25)), 1)
-
-    # Track hotspot visits — increment visit count for nearby hotspots
+    # Track hotspot visits — counted in memory, flushed in batches
     try:
-        hotspots_res = supabase.table("hotspots").select("*").execute()
-        for hs in (hotspots_res.data or []):
-            d = haversine(lat, lng, hs.get("lat", 0), hs.get("lng", 0))
-            if d < hs.get("radius", 50):
-                supabase.table("hotspots").update({
-                    "visit_count": (hs.get("visit_count") or 0) + 1
-                }).eq("id", hs["id"]).execute()
+        await ensure_hotspots()
+        record_visits(user["id"], lat, lng, time.time())
     except:
         pass
 
-    supabase.table("users").update({
-        "lat": lat,
-        "lon": lng,
-        "last_lat": lat,
-        "last_lon": lng,
-        "distance_m": distance_m,
-        "steps": steps,
-        "calories": calories,
-        "online": True,
-        "last_seen": time.time()
-    }).eq("id", user["id"]).execute()
+    await store_location(user, fields)
+    _hub.publish_user(user_view(user, lat, lng))
+    await note_hunter(user["id"], lat, lng)
+
+    return {"status": "ok", "steps": fields["steps"], "calories": fields["calories"]}
 
-    return {"status": "ok", "steps": steps, "calories": calories}
 
+# what each client last got from /api/nearby, for ?since= deltas
+_nearby_log = SnapshotLog(
+    maxsize=int(os.environ.get("SPAZZ_NEARBY_SNAPSHOTS", "8192")),
+    ttl=int(os.environ.get("SPAZZ_NEARBY_SNAPSHOT_TTL", "120")),
+    move_m=float(os.environ.get("SPAZZ_NEARBY_MOVE_M", "5")),
+)
 
 @app.get("/api/nearby")
-async def get_nearby(lat: float, lng: float, user_id: str, auth=Depends(get_current_user)):
-    """Returns nearby users, wisps, and hotspots for the map screen."""
+async def get_nearby(request: Request, lat: float, lng: float, user_id: str, since: Optional[str] = None,
+                     auth=Depends(get_current_user)):
+    """Returns nearby users, wisps, and hotspots for the map screen.
+    Pass the previous response's version as ?since= to get only what was
+    added/changed/removed (full=false); ?format=compact|msgpack for columnar
+    payloads; honours If-None-Match."""
     RADIUS_M = 2000  # 2km radius
+    lat, lng = check_coords(lat, lng)
 
-    # Nearby users (online in last 5 minutes)
-    cutoff = time.time() - 300
-    all_users_res = supabase.table("users").select(
-        "id,username,lat,lon,is_premium,last_seen"
-    ).eq("online", True).execute()
+    # Nearby users (online in last 5 minutes), from presence
+    await ensure_presence()
+    nearby_users = [user_view(u, ulat, ulng) for u, ulat, ulng, _ in _presence.near(lat, lng, RADIUS_M, exclude=auth["id"])]
 
-    nearby_users = []
-    for u in (all_users_res.data or []):
-        if u["id"] == auth["id"]:
-            continue
-        if not u.get("lat") or not u.get("lon"):
-            continue
-        if (u.get("last_seen") or 0) < cutoff:
-            continue
-        dist = haversine(lat, lng, u["lat"], u["lon"])
-        if dist <= RADIUS_M:
-            nearby_users.append({
-                "id": u["id"],
-                "username": u["username"],
-                "lat": u["lat"],
-                "lng": u["lon"],
-                "is_premium": u.get("is_premium", False),
-            })
-
-    # Wisps near the user (from in-memory + random generation)
-    move_wisps()
-    wisps_raw = get_wisps()
-    nearby_wisps = []
-    for w in wisps_raw:
-        dist = haversine(lat, lng, w.get("lat", 0), w.get("lon", 0))
-        if dist <= RADIUS_M:
-            nearby_wisps.append({
-                "id": w["id"],
-                "lat": w["lat"],
-                "lng": w.get("lon", w.get("lng", 0)),
-                "xp": w.get("wisp_reward", 10),
-            })
-
-    # Spawn some wisps near the user if none exist
-    if len(nearby_wisps) < 5:
-        for _ in range(5 - len(nearby_wisps)):
-            wisp = {
-                "id": f"wisp_{uuid.uuid4().hex[:6]}",
-                "username": "Wisp",
-                "type": "wisp",
-                "lat": lat + random.uniform(-0.01, 0.01),
-                "lon": lng + random.uniform(-0.01, 0.01),
-                "wisp_reward": random.choices([5, 10, 15, 20], weights=[40, 30, 20, 10])[0],
-            }
-            add_wisp(wisp)
-            nearby_wisps.append({
-                "id": wisp["id"],
-                "lat": wisp["lat"],
-                "lng": wisp["lon"],
-                "xp": wisp["wisp_reward"],
-            })
+    # Wisps near the user; world_tick keeps this area stocked
+    await note_hunter(auth["id"], lat, lng)
+    await ensure_world_fresh()
+    nearby_wisps = [wisp_view(w) for w, _ in await wisps_near(lat, lng, RADIUS_M)]
 
     # Hotspots (heatmap data — returned for all, filtered on frontend by premium)
-    hotspots_res = supabase.table("hotspots").select("*").execute()
+    await ensure_hotspots()
     nearby_hotspots = []
-    for hs in (hotspots_res.data or []):
-        if not hs.get("lat") or not hs.get("lng"):
-            continue
-        dist = haversine(lat, lng, hs["lat"], hs["lng"])
-        if dist <= RADIUS_M * 2:
-            nearby_hotspots.append({
-                "id": hs["id"],
-                "lat": hs["lat"],
-                "lng": hs["lng"],
-                "visit_count": hs.get("visit_count", 1),
-                "name": hs.get("name", "Hotspot"),
-            })
-
-    return {
+    for hs, _ in hotspots_near(lat, lng, RADIUS_M * 2):
+        nearby_hotspots.append({
+            "id": hs["id"],
+            "lat": hs["lat"],
+            "lng": hs["lng"],
+            "visit_count": hs.get("visit_count", 1),
+            "name": hs.get("name", "Hotspot"),
+        })
+
+    return respond(request, _nearby_log.diff(auth["id"], since, {
         "users": nearby_users,
         "wisps": nearby_wisps,
         "hotspots": nearby_hotspots,
-    }
+    }))
 
 
 @app.post("/api/wisp/collect")
-async def collect_wisp(request: Request, auth=Depends(get_current_user)):
+async def collect_wisp(request: Request, auth=Depends(rate_limited("collect"))):
     """Called when user taps a wisp on the map."""
     body = await request.json()
     wisp_id = body.get("wisp_id")
+    key = idempotency_key(request)
 
-    wisp = _wisps.get(wisp_id)
-    xp_reward = wisp.get("wisp_reward", 10) if wisp else 10
-
-    # Remove wisp
-    remove_wisp(wisp_id)
-
-    # Update user XP + wisp coins
-    user = auth
-    new_xp = (user.get("xp") or 0) + xp_reward
-    new_level = max(1, new_xp // 100 + 1)
-    new_coins = (user.get("wisp_coins") or 0) + random.randint(1, 3)
-
-    supabase.table("users").update({
-        "xp": new_xp,
-        "level": new_level,
-        "wisp_coins": new_coins,
-    }).eq("id", auth["id"]).execute()
+    wisp = await take_wisp(wisp_id)
+    if not wisp:
+        res = await ledger_replay(auth["id"], "collect", key)
+        if not res:
+            raise HTTPException(404, "Wisp not found or already collected")
+    else:
+        xp_reward = wisp.get("wisp_reward", 10)
+        res = await collect_wisp_reward(wisp, auth["id"], key, coins=random.randint(1, 3), xp=xp_reward,
+                                        xp_per_level=100, extra={"xp_earned": xp_reward})
 
-    return {"status": "collected", "xp_earned": xp_reward, "new_xp": new_xp, "new_level": new_level}
+    return {"status": "collected", "xp_earned": res.get("xp_earned", 0), "new_xp": res["xp"], "new_level": res["level"]}
 
 
 @app.get("/api/user/{user_id}")
 async def get_user(user_id: str, auth=Depends(get_current_user)):
     """Get a user's profile by ID."""
-    result = supabase.table("users").select("*").eq("id", user_id).limit(1).execute()
+    result = await db(supabase.table("users").select("*").eq("id", user_id).limit(1))
     if not result.data:
         raise HTTPException(404, "User not found")
     u = result.data[0]
@@ -781,30 +1530,44 @@ async def subscribe(request: Request, auth=Depends(get_current_user)):
     """Mark a user as premium."""
     body = await request.json()
     plan = body.get("plan", "monthly")
-    supabase.table("users").update({
+    await update_user(auth["id"], {
         "is_premium": True,
         "subscription_plan": plan,
-    }).eq("id", auth["id"]).execute()
+    })
     return {"status": "subscribed", "plan": plan}
 
 # ── PING SYSTEM ───────────────────────────────────────────────────
 
-# In-memory ping queue (Vercel ephemeral, good enough for real-time)
-_active_pings = {}  # ping_id -> ping data
+# Live pings sit in the world store next to the wisps
+
+async def add_ping(ping):
+    if await _world.add_ping(ping):
+        _hub.publish_ping(ping)
+
+async def fetch_pings_since(cursor, limit):
+    result = await db(supabase.table("pings").select("*").gte("created_at", cursor).order("created_at").limit(limit))
+    return result.data or []
+
+# Pings sent through other instances arrive by tailing the pings table once
+# per instance, instead of every poll re-reading the last 30s.
+_ping_sync = PingSync(fetch_pings_since, add_ping, interval_s=float(os.environ.get("SPAZZ_PING_SYNC_S", "2")))
+
+@_periodic.every(_ping_sync.interval_s)
+async def sync_pings():
+    await _ping_sync.run()
+    await _world.expire_pings()
 
 @app.post("/api/ping/send")
-async def send_ping(request: Request, auth=Depends(get_current_user)):
+async def send_ping(request: Request, auth=Depends(rate_limited("ping"))):
     """Send a ping that broadcasts to nearby users."""
     body = await request.json()
 
     priority = body.get("priority", 1)
     is_premium = body.get("is_premium", False)
-    lat = body.get("lat", 0)
-    lng = body.get("lng", 0)
+    lat, lng = check_coords(body.get("lat", 0), body.get("lng", 0))
 
-    # Premium pings have shorter cooldown enforced server-side
+    # premium senders get a shorter cooldown via RATE_LIMITS["ping"]
     user_id = auth["id"]
-    cooldown_key = f"ping_cooldown_{user_id}"
 
     ping_id = f"ping_{uuid.uuid4().hex[:8]}"
     ping_data = {
@@ -821,14 +1584,14 @@ async def send_ping(request: Request, auth=Depends(get_current_user)):
         "lng": lng,
         "is_premium": is_premium,
         "sent_at": time.time(),
-        "expires_at": time.time() + 30,  # pings expire after 30s
+        "expires_at": time.time() + PING_TTL_S,  # pings expire after 30s
     }
 
-    _active_pings[ping_id] = ping_data
+    await add_ping(ping_data)
 
     # Also persist to Supabase so users who poll get it
     try:
-        supabase.table("pings").insert({
+        await db(supabase.table("pings").insert({
             "id": ping_id,
             "user_id": user_id,
             "username": auth.get("username", "Hunter"),
@@ -839,7 +1602,7 @@ async def send_ping(request: Request, auth=Depends(get_current_user)):
             "lat": lat,
             "lng": lng,
             "is_premium": is_premium,
-        }).execute()
+        }))
     except:
         pass
 
@@ -853,50 +1616,75 @@ async def get_nearby_pings(lat: float, lng: float, auth=Depends(get_current_user
     Higher priority (paid) pings surface first — they push through free ones.
     """
     PING_RADIUS_M = 1000  # 1km
-    now = time.time()
-
-    # Clean expired pings
-    expired = [k for k, v in _active_pings.items() if v.get("expires_at", 0) < now]
-    for k in expired:
-        del _active_pings[k]
+    lat, lng = check_coords(lat, lng)
 
-    # Get pings from Supabase too (other instances)
+    # Pings from other instances come in through the background sync, which
+    # also expires old ones
     try:
-        cutoff_time = now - 30
-        db_pings = supabase.table("pings").select("*").gt("created_at", 
-            __import__('datetime').datetime.utcfromtimestamp(cutoff_time).isoformat()
-        ).execute()
-        for p in (db_pings.data or []):
-            if p["id"] not in _active_pings:
-                _active_pings[p["id"]] = {
-                    "id": p["id"],
-                    "user_id": p["user_id"],
-                    "username": p.get("username", "Hunter"),
-                    "ping_id": p.get("ping_type", "ping_default"),
-                    "emoji": p.get("emoji", "📡"),
-                    "name": p.get("name", "Ping"),
-                    "sound": "beep",
-                    "haptic": "light",
-                    "priority": p.get("priority", 1),
-                    "lat": p.get("lat", 0),
-                    "lng": p.get("lng", 0),
-                    "is_premium": p.get("is_premium", False),
-                    "sent_at": now,
-                    "expires_at": now + 30,
-                }
+        await _ping_sync.ensure_fresh()
     except:
         pass
 
     # Filter to nearby, exclude own pings
     nearby = []
-    for ping in _active_pings.values():
+    for ping, dist in await _world.pings_near(lat, lng, PING_RADIUS_M):
         if ping["user_id"] == auth["id"]:
             continue
-        dist = haversine(lat, lng, ping.get("lat", 0), ping.get("lng", 0))
-        if dist <= PING_RADIUS_M:
-            nearby.append({**ping, "distance_m": round(dist)})
+        nearby.append({**ping, "distance_m": round(dist)})
 
     # Sort by priority DESC — paid pings always surface first
     nearby.sort(key=lambda p: p["priority"], reverse=True)
 
-    return {"pings": nearby[:10]}  # max 10 pings at once
+    return FastJSONResponse({"pings": nearby[:10]})  # max 10 pings at once
+
+
+# ── LIVE STREAM ───────────────────────────────────────────────────
+
+@app.get("/api/stream")
+async def stream(request: Request, lat: float, lng: float, token: Optional[str] = None):
+    """
+    Server-Sent Events replacement for the ping/nearby polling timers.
+    Sends a snapshot first, then only deltas: ping, wisp_spawned,
+    wisp_removed, wisps_moved, user_entered, user_moved, user_left.
+    A `resync` event means events were dropped and the client should
+    refetch /api/nearby. EventSource can't set headers, so the token may
+    also come as ?token=.
+    """
+    lat, lng = check_coords(lat, lng)
+    token = request.headers.get("Authorization", "").replace("Bearer ", "") or token
+    if not token:
+        raise HTTPException(401, "No token")
+    auth = await get_auth_by_token(token)
+    if not auth:
+        raise HTTPException(401, "Invalid token")
+
+    await ensure_presence()
+    sub = _hub.subscribe(auth["id"], lat, lng)
+    snapshot = {
+        "wisps": [wisp_view(w) for w, _ in await wisps_near(lat, lng, NEARBY_RADIUS_M)],
+        "pings": [
+            {**p, "distance_m": round(d)}
+            for p, d in await _world.pings_near(lat, lng, PING_RADIUS_M)
+            if p["user_id"] != auth["id"]
+        ],
+    }
+
+    sub.wisps_in_range = {w["id"] for w in snapshot["wisps"]}
+
+    async def events():
+        try:
+            yield b"event: snapshot\ndata: " + dumps(snapshot) + b"\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event, data = await sub.next(timeout=15)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                yield b"event: " + event.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+        finally:
+            _hub.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
@@ -0,0 +1,105 @@
+import threading
+import time
+
+
+class LocationBuffer:
+    """Latest location columns per user, waiting to be written in bulk.
+
+    Location pings only need their last value persisted, so put() merges
+    into one pending row per user and a flush writes them all in one call.
+    take() hands the pending rows to a flush and keeps them visible through
+    latest() until done()/restore(), so distance is always measured from the
+    newest position even while the write is in flight."""
+
+    def __init__(self, max_batch=500, max_age_s=10):
+        self.max_batch = max_batch
+        self.max_age_s = max_age_s
+        self._pending = {}  # user_id -> columns not yet handed to a flush
+        self._since = {}  # user_id -> monotonic time of its oldest pending write
+        self._in_flight = {}  # user_id -> columns being written right now
+        self._lock = threading.Lock()
+        self.puts = 0
+        self.flushes = 0
+        self.failures = 0
+        self.rows_written = 0
+        self.last_batch = 0
+        self.max_batch_seen = 0
+        self.flush_total = 0.0
+        self.flush_max = 0.0
+        self.max_staleness = 0.0
+
+    def put(self, user_id, fields):
+        with self._lock:
+            self._pending[user_id] = {**self._pending.get(user_id, {}), **fields}
+            self._since.setdefault(user_id, time.monotonic())
+            self.puts += 1
+
+    def latest(self, user_id):
+        """Columns written since the last completed flush ({} if none)."""
+        with self._lock:
+            return {**self._in_flight.get(user_id, {}), **self._pending.get(user_id, {})}
+
+    def due(self):
+        """Flush now rather than wait for the timer: the batch is full, or the
+        oldest write has waited past max_age_s (e.g. the timer isn't running)."""
+        if len(self._pending) >= self.max_batch:
+            return True
+        oldest = min(self._since.values(), default=None)
+        return oldest is not None and time.monotonic() - oldest > self.max_age_s
+
+    def take(self):
+        """Hand up to max_batch pending rows to a flush as [{"id", ...}]."""
+        with self._lock:
+            ids = list(self._pending)[:self.max_batch]
+            now = time.monotonic()
+            rows = []
+            for uid in ids:
+                fields = self._pending.pop(uid)
+                self.max_staleness = max(self.max_staleness, now - self._since.pop(uid))
+                self._in_flight[uid] = {**self._in_flight.get(uid, {}), **fields}
+                rows.append({**fields, "id": uid})
+            return rows
+
+    def done(self, rows, seconds):
+        with self._lock:
+            for row in rows:
+                self._in_flight.pop(row["id"], None)
+            self.flushes += 1
+            self.rows_written += len(rows)
+            self.last_batch = len(rows)
+            self.max_batch_seen = max(self.max_batch_seen, len(rows))
+            self.flush_total += seconds
+            self.flush_max = max(self.flush_max, seconds)
+
+    def restore(self, rows):
+        """A flush failed: put its rows back under anything newer."""
+        with self._lock:
+            now = time.monotonic()
+            for row in rows:
+                uid = row["id"]
+                fields = self._in_flight.pop(uid, {})
+                self._pending[uid] = {**fields, **self._pending.get(uid, {})}
+                self._since[uid] = min(self._since.get(uid, now), now)
+            self.failures += 1
+
+    def __len__(self):
+        return len(self._pending)
+
+    def stats(self):
+        oldest = min(self._since.values(), default=None)
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "oldest_pending_s": round(time.monotonic() - oldest, 3) if oldest is not None else 0,
+            "puts": self.puts,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "rows_written": self.rows_written,
+            "writes_saved": self.puts - self.rows_written,
+            "last_batch": self.last_batch,
+            "max_batch": self.max_batch_seen,
+            "avg_batch": round(self.rows_written / self.flushes, 1) if self.flushes else 0,
+            "flush_avg_ms": round(self.flush_total / self.flushes * 1000, 2) if self.flushes else 0,
+            "flush_max_ms": round(self.flush_max * 1000, 2),
+            "max_staleness_s": round(self.max_staleness, 3),
+        }
@@ -0,0 +1,109 @@
+import threading
+from bisect import bisect_left, insort
+
+FIELDS = ("username", "xp", "steps", "wisp_coins")
+
+
+class Leaderboard:
+    """Every user ranked by xp, kept in memory so the board isn't an ORDER BY
+    over the users table per request.
+
+    `_order` is a sorted list of (-xp, user_id): rank lookups are a bisect,
+    and an xp change is one remove + insort (a memmove, cheap at our sizes).
+    `version` only moves when the top `size` rows would render differently,
+    so it doubles as the board's ETag."""
+
+    def __init__(self, size=20):
+        self.size = size
+        self.version = 0
+        self.loaded_at = 0.0
+        self._rows = {}  # user_id -> {"id", "username", "xp", "steps", "wisp_coins"}
+        self._order = []
+        self._top = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(row):
+        return (-(row.get("xp") or 0), row["id"])
+
+    def _in_top(self, key):
+        return bisect_left(self._order, key) < self.size
+
+    def _changed(self):
+        self.version += 1
+        self._top = None
+
+    def load(self, rows):
+        """Replace the whole board with a fresh read of the users table."""
+        with self._lock:
+            before = self._render()
+            self._rows = {r["id"]: {"id": r["id"], **{f: r.get(f) for f in FIELDS}} for r in rows}
+            self._order = sorted(self._key(r) for r in self._rows.values())
+            self._top = None
+            if self._render() != before:
+                self.version += 1
+
+    def put(self, user_id, fields):
+        """Apply a users-row write. Unknown users are added once we know
+        their name; everything else is ignored."""
+        fields = {f: fields[f] for f in FIELDS if f in fields}
+        if not fields:
+            return
+        with self._lock:
+            row = self._rows.get(user_id)
+            if row is None:
+                if "username" not in fields:
+                    return
+                row = self._rows[user_id] = {"id": user_id, **{f: fields.get(f) for f in FIELDS}}
+                key = self._key(row)
+                insort(self._order, key)
+                if self._in_top(key):
+                    self._changed()
+                return
+            if all(row.get(f) == v for f, v in fields.items()):
+                return
+            old = self._key(row)
+            was_top = self._in_top(old)
+            row.update(fields)
+            new = self._key(row)
+            if new != old:
+                del self._order[bisect_left(self._order, old)]
+                insort(self._order, new)
+            if was_top or self._in_top(new):
+                self._changed()
+
+    def remove(self, user_id):
+        with self._lock:
+            row = self._rows.pop(user_id, None)
+            if row is None:
+                return
+            key = self._key(row)
+            was_top = self._in_top(key)
+            del self._order[bisect_left(self._order, key)]
+            if was_top:
+                self._changed()
+
+    def rank(self, user_id):
+        """1-based rank, ties sharing the better rank; None if unknown."""
+        row = self._rows.get(user_id)
+        if row is None:
+            return None
+        return bisect_left(self._order, (-(row.get("xp") or 0),)) + 1
+
+    def _render(self):
+        if self._top is None:
+            top, rank, prev = [], 0, None
+            for i, (neg_xp, uid) in enumerate(self._order[:self.size]):
+                if neg_xp != prev:
+                    rank, prev = i + 1, neg_xp
+                top.append({**self._rows[uid], "rank": rank})
+            self._top = top
+        return self._top
+
+    def top(self):
+        """The top `size` rows with their ranks, rebuilt only after a change."""
+        with self._lock:
+            return self._render()
+
+    def __len__(self):
+        return len(self._rows)
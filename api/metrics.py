@@ -0,0 +1,149 @@
+import bisect
+import contextvars
+import time
+from collections import Counter
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_CALL_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+# per-request record the middleware opens and db() appends to
+_current = contextvars.ContextVar("spazz_request_metrics", default=None)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in Prometheus' shape (le is inclusive)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        running = 0
+        for le, n in zip(self.buckets, self.counts):
+            running += n
+            yield f'{name}_bucket{{{labels},le="{le:g}"}} {running}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum:.6f}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+def query_target(query):
+    """'users' or 'rpc/ledger_apply' for a postgrest request builder."""
+    path = getattr(getattr(query, "request", None), "path", None)
+    if path:
+        return str(path).rsplit("/rest/v1/", 1)[-1]
+    return getattr(query, "table", None) or "unknown"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Per-route request latency, status counts and Supabase calls, plus
+    gauges read at scrape time, rendered as Prometheus text.
+
+    Routes are labelled by their template (/api/collect/{target_id}), and
+    anything that matched no route is "unmatched", so label cardinality is
+    bounded by the app's routes. DB calls made outside a request (the
+    periodic jobs) are labelled route="background"."""
+
+    def __init__(self, prefix="spazz"):
+        self.prefix = prefix
+        self.latency = {}  # (method, route) -> Histogram of seconds to response start
+        self.db_per_request = {}  # (method, route) -> Histogram of calls
+        self.statuses = Counter()  # (method, route, status) -> responses
+        self.db_latency = {}  # (route, target) -> Histogram
+        self.gauges = {}  # name -> (help, fn)
+
+    def gauge(self, name, help, fn):
+        self.gauges[name] = (help, fn)
+
+    def observe_db(self, target, seconds):
+        record = _current.get()
+        if record is None:
+            self._db_histogram("background", target).observe(seconds)
+        else:
+            record["db"].append((target, seconds))
+
+    def _db_histogram(self, route, target):
+        key = (route, target)
+        if key not in self.db_latency:
+            self.db_latency[key] = Histogram()
+        return self.db_latency[key]
+
+    def observe_request(self, method, route, status, seconds, db_calls):
+        key = (method, route)
+        if key not in self.latency:
+            self.latency[key] = Histogram()
+            self.db_per_request[key] = Histogram(DB_CALL_BUCKETS)
+        self.latency[key].observe(seconds)
+        self.db_per_request[key].observe(len(db_calls))
+        self.statuses[(method, route, status)] += 1
+        for target, db_seconds in db_calls:
+            self._db_histogram(route, target).observe(db_seconds)
+
+    def render(self):
+        p = self.prefix
+        out = [
+            f"# HELP {p}_request_duration_seconds Time from request to response start, per route.",
+            f"# TYPE {p}_request_duration_seconds histogram",
+        ]
+        for (method, route), h in sorted(self.latency.items()):
+            out.extend(h.lines(f"{p}_request_duration_seconds", f'method="{method}",route="{_escape(route)}"'))
+        out += [f"# HELP {p}_requests_total Responses per route and status.", f"# TYPE {p}_requests_total counter"]
+        for (method, route, status), n in sorted(self.statuses.items()):
+            out.append(f'{p}_requests_total{{method="{method}",route="{_escape(route)}",status="{status}"}} {n}')
+        out += [f"# HELP {p}_request_db_calls Supabase calls made by one request.", f"# TYPE {p}_request_db_calls histogram"]
+        for (method, route), h in sorted(self.db_per_request.items()):
+            out.extend(h.lines(f"{p}_request_db_calls", f'method="{method}",route="{_escape(route)}"'))
+        out += [f"# HELP {p}_db_call_duration_seconds Supabase call time per route and table/RPC.",
+                f"# TYPE {p}_db_call_duration_seconds histogram"]
+        for (route, target), h in sorted(self.db_latency.items()):
+            out.extend(h.lines(f"{p}_db_call_duration_seconds", f'route="{_escape(route)}",target="{_escape(target)}"'))
+        for name, (help, fn) in sorted(self.gauges.items()):
+            try:
+                value = float(fn())
+            except Exception:
+                continue  # a store that can't answer right now just skips this scrape
+            out += [f"# HELP {p}_{name} {help}", f"# TYPE {p}_{name} gauge", f"{p}_{name} {value:g}"]
+        return "\n".join(out) + "\n"
+
+
+class MetricsMiddleware:
+    """Pure ASGI, so streaming responses pass straight through and the
+    handler runs in the context that holds this request's record. Latency
+    is measured to the response start, so an SSE stream counts its setup,
+    not how long the client stayed connected."""
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        record = {"db": [], "status": 500, "first_byte": None}
+        token = _current.set(record)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                record["status"] = message["status"]
+                record["first_byte"] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            seconds = (record["first_byte"] or time.perf_counter()) - started
+            self.metrics.observe_request(scope["method"], route, record["status"], seconds, record["db"])
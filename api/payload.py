@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import json
+from fastapi.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json fallback
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+try:
+    import msgpack
+except ImportError:  # optional: ?format=msgpack answers 406
+    msgpack = None
+
+COMPRESS_MIN_BYTES = 512
+COORD_KEYS = ("lat", "lng", "lon")
+COORD_DIGITS = 6  # ~0.1m, far below GPS error
+
+
+
+def _default(obj):
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if hasattr(obj, "item"):  # numpy scalar
+        return obj.item()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=_OPTS)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_default).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """The app's default response class: orjson instead of stdlib json.
+    FastAPI still runs jsonable_encoder over plain dict returns, so hot
+    handlers return one of these (or respond()) directly to skip it."""
+
+    def render(self, content):
+        return dumps(content)
+
+
+class RawJSONResponse(Response):
+    """Body that is already JSON bytes, e.g. assembled from fragments
+    serialized once at import."""
+
+    media_type = "application/json"
+
+def columnar(rows):
+    """[{...}, ...] -> {"n": len, col: [values]} with keys in first-seen
+    order and missing values as null. A column holding the same value in
+    every row is sent once as a scalar ("type": "wisp" instead of n copies);
+    clients broadcast any non-list column. Coordinates are rounded to
+    COORD_DIGITS."""
+    cols = {}
+    for r in rows:
+        for k in r:
+            cols.setdefault(k, None)
+    out = {"n": len(rows)}
+    for k in cols:
+        values = [r.get(k) for r in rows]
+        if k in COORD_KEYS:
+            values = [round(v, COORD_DIGITS) if isinstance(v, float) else v for v in values]
+        first = values[0] if values else None
+        out[k] = first if values and not isinstance(first, (dict, list)) and all(v == first for v in values) else values
+    return out
+
+
+def compact(payload):
+    """Every non-empty list of dicts in the payload (and in nested dicts,
+    e.g. a delta's added/changed) turned columnar; empty lists stay []."""
+    out = {}
+    for k, v in payload.items():
+        if isinstance(v, list) and v and all(isinstance(r, dict) for r in v):
+            out[k] = columnar(v)
+        elif isinstance(v, dict):
+            out[k] = compact(v)
+        else:
+            out[k] = v
+    return out
+
+
+def negotiate_format(request):
+    fmt = request.query_params.get("format")
+    if fmt:
+        return fmt
+    if "application/msgpack" in request.headers.get("Accept", ""):
+        return "msgpack"
+    return "json"
+
+
+def encode(payload, fmt):
+    """(body, media_type) for 'json', 'compact' (columnar JSON) or 'msgpack'
+    (columnar MessagePack); None if the format isn't available."""
+    if fmt == "json":
+        return dumps(payload), "application/json"
+    if fmt == "compact":
+        return dumps(compact(payload)), "application/json"
+    if fmt == "msgpack" and msgpack is not None:
+        return msgpack.packb(compact(payload)), "application/msgpack"
+    return None
+
+
+def compress(body, accept_encoding):
+    """(body, content-encoding or None); brotli when both sides have it."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = {e.split(";")[0].strip() for e in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=4), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=5), "gzip"
+    return body, None
+
+
+def etag_for(raw, fmt):
+    """Digest of the snapshot's content: identical worlds give identical
+    tags on every instance, whatever store is behind them."""
+    return f'W/"{fmt}-{hashlib.sha1(raw).hexdigest()[:20]}"'
+
+
+def respond(request, payload, version_of=None):
+    """Serve `payload` in the format and encoding the client asked for,
+    or 304 if its If-None-Match matches. version_of is the part of the
+    payload that decides whether it changed (default: all of it)."""
+    fmt = negotiate_format(request)
+    encoded = encode(payload, fmt)
+    if encoded is None:
+        return Response(status_code=406, content=f"Unsupported format: {fmt}")
+    body, media_type = encoded
+    raw = body if version_of is None else dumps(version_of)
+    etag = etag_for(raw, fmt)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept, Accept-Encoding, Authorization"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+    body, encoding = compress(body, request.headers.get("Accept-Encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=media_type, headers=headers)
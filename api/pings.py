@@ -0,0 +1,93 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+PING_TTL_S = 30
+
+
+def parse_ts(value):
+    """Postgres timestamp (ISO string, maybe without zone) -> epoch seconds."""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def format_ts(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+class PingSync:
+    """Tails the pings table by a created_at high-water mark so each
+    instance reads every ping once, whatever the number of polling clients.
+
+    fetch(since_iso, limit) returns rows with created_at >= since ordered by
+    created_at; await on_ping(ping) stores one. Each read re-covers the last
+    OVERLAP_S before the cursor, because created_at is stamped at insert but
+    rows can commit out of order; ids already seen in that window are
+    skipped."""
+
+    OVERLAP_S = 2
+
+    def __init__(self, fetch, on_ping, interval_s=2, batch=500):
+        self.fetch = fetch
+        self.on_ping = on_ping
+        self.interval_s = interval_s
+        self.batch = batch
+        self.cursor = time.time() - PING_TTL_S
+        self._seen = {}  # ping id -> sent_at, for ids inside the overlap window
+        self.last_run = 0.0
+        self.synced = 0
+        self._lock = asyncio.Lock()
+
+    def to_ping(self, row):
+        sent_at = parse_ts(row["created_at"])
+        return {
+            "id": row["id"],
+            "user_id": row["user_id"],
+            "username": row.get("username", "Hunter"),
+            "ping_id": row.get("ping_type", "ping_default"),
+            "emoji": row.get("emoji", "📡"),
+            "name": row.get("name", "Ping"),
+            "sound": "beep",
+            "haptic": "light",
+            "priority": row.get("priority", 1),
+            "lat": row.get("lat", 0),
+            "lng": row.get("lng", 0),
+            "is_premium": row.get("is_premium", False),
+            "sent_at": sent_at,
+            "expires_at": sent_at + PING_TTL_S,
+        }
+
+    async def run(self):
+        async with self._lock:
+            now = time.time()
+            since = self.cursor - self.OVERLAP_S
+            while True:
+                rows = await self.fetch(format_ts(since), self.batch)
+                fresh = 0
+                for row in rows:
+                    if row["id"] in self._seen:
+                        continue
+                    ping = self.to_ping(row)
+                    self._seen[row["id"]] = ping["sent_at"]
+                    self.cursor = max(self.cursor, ping["sent_at"])
+                    fresh += 1
+                    if ping["expires_at"] >= now:
+                        await self.on_ping(ping)
+                        self.synced += 1
+                if len(rows) < self.batch or not fresh:
+                    break
+                since = parse_ts(rows[-1]["created_at"])
+            horizon = self.cursor - self.OVERLAP_S
+            self._seen = {k: t for k, t in self._seen.items() if t >= horizon}
+            self.last_run = time.monotonic()
+
+    async def ensure_fresh(self):
+        """Catch up inline if the background loop hasn't run lately
+        (e.g. a frozen serverless instance)."""
+        if time.monotonic() - self.last_run > self.interval_s * 3 and not self._lock.locked():
+            await self.run()
+
+    def stats(self):
+        return {"cursor": format_ts(self.cursor), "synced": self.synced, "interval_s": self.interval_s}
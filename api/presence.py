@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+from api.geo import GridIndex
+
+PRESENCE_TTL_S = 300  # the "online in the last 5 minutes" window
+
+
+class Presence:
+    """Who is online and where, kept in memory from location heartbeats.
+
+    Entries sit in an OrderedDict in heartbeat order (a beat moves its user
+    to the end), so expire() only ever looks at the front. Positions are
+    mirrored into a GridIndex for radius queries. Users who expire are
+    remembered until take_offline() hands them to whoever persists the
+    online=false transition.
+
+    beat(..., local=False) merges a heartbeat seen by another instance
+    (read back from the users table); only local users are reported
+    offline, and a merged beat older than the one held is ignored. Those
+    merged beats can land a few seconds out of order, so such a user may
+    expire up to that much late."""
+
+    def __init__(self, ttl_s=PRESENCE_TTL_S, cell_m=2000):
+        self.ttl_s = ttl_s
+        self._seen = OrderedDict()  # user_id -> (seen_at, local)
+        self._info = {}  # user_id -> public fields of the last heartbeat
+        self._index = GridIndex(cell_m=cell_m)
+        self._offline = set()
+        self._lock = threading.Lock()
+        self.beats = 0
+        self.expired = 0
+
+    def beat(self, user_id, lat, lng, info, seen_at=None, local=True):
+        """Returns True if the user just came online."""
+        seen_at = time.time() if seen_at is None else seen_at
+        with self._lock:
+            prev = self._seen.get(user_id)
+            if prev is not None and seen_at <= prev[0]:
+                return False
+            self._seen[user_id] = (seen_at, local or bool(prev and prev[1]))
+            self._seen.move_to_end(user_id)
+            self._info[user_id] = info
+            self._index.insert(user_id, lat, lng)
+            if local:
+                self._offline.discard(user_id)
+            self.beats += 1
+        return prev is None
+
+    def _drop(self, user_id):
+        entry = self._seen.pop(user_id, None)
+        if entry is None:
+            return False
+        self._info.pop(user_id, None)
+        self._index.remove(user_id)
+        return entry[1]
+
+    def expire(self, now=None):
+        """Drop everyone whose last heartbeat is older than ttl_s."""
+        cutoff = (time.time() if now is None else now) - self.ttl_s
+        dropped = []
+        with self._lock:
+            while self._seen:
+                user_id, (seen_at, _) = next(iter(self._seen.items()))
+                if seen_at >= cutoff:
+                    break
+                if self._drop(user_id):
+                    self._offline.add(user_id)
+                dropped.append(user_id)
+            self.expired += len(dropped)
+        return dropped
+
+    def take_offline(self):
+        """Local users who went offline since the last call."""
+        with self._lock:
+            out, self._offline = list(self._offline), set()
+        return out
+
+    def restore_offline(self, user_ids):
+        """A failed persist: hand them out again unless they came back."""
+        with self._lock:
+            self._offline.update(u for u in user_ids if u not in self._seen)
+
+    def near(self, lat, lng, radius_m, exclude=None):
+        """[(info, lat, lng, distance_m)] for online users within radius_m."""
+        self.expire()
+        with self._lock:
+            hits = self._index.query(lat, lng, radius_m)
+            out = []
+            for user_id, d in hits:
+                if user_id == exclude:
+                    continue
+                plat, plng = self._index.points.get(user_id)
+                out.append((self._info[user_id], float(plat), float(plng), d))
+        return out
+
+    def online(self, exclude=None):
+        """[(info, lat, lng)] for every online user."""
+        self.expire()
+        with self._lock:
+            return [(self._info[k], *map(float, self._index.points.get(k)))
+                    for k in self._seen if k != exclude]
+
+    def __contains__(self, user_id):
+        return user_id in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def stats(self):
+        return {
+            "online": len(self._seen),
+            "local": sum(1 for _, local in self._seen.values() if local),
+            "pending_offline": len(self._offline),
+            "beats": self.beats,
+            "expired": self.expired,
+            "ttl_s": self.ttl_s,
+        }
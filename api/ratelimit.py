@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+
+from api.db import SqliteFile
+
+
+class Limit:
+    """`rate` tokens per second refilling a bucket of `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    @classmethod
+    def per_minute(cls, n, burst=None):
+        return cls(n / 60, burst or max(1, n))
+
+
+class BucketStore:
+    """Token-bucket state. take() refills by elapsed time and spends `cost`
+    in one step; it returns None on success or the seconds until enough
+    tokens will be there."""
+
+    async def take(self, key, limit, cost=1): raise NotImplementedError
+
+
+class MemoryBucketStore(BucketStore):
+    """Per-process buckets, least recently used dropped past maxsize (a
+    dropped bucket just starts full again)."""
+
+    def __init__(self, maxsize=100_000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    async def take(self, key, limit, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+            ok = tokens >= cost
+            self._buckets[key] = (tokens - cost if ok else tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return None if ok else (cost - tokens) / limit.rate
+
+
+class SqliteBucketStore(BucketStore):
+    """Buckets in a SQLite file shared by every worker on the host, queried
+    on a BlockingPool; the refill-and-spend is a single upsert so concurrent
+    workers can't both spend the last token."""
+
+    SCHEMA = "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+
+    def __init__(self, path, pool=None):
+        self.path = path
+        self._db = SqliteFile(path, self.SCHEMA, pool)
+
+    async def take(self, key, limit, cost=1):
+        now = time.time()
+        refilled = "min(?, tokens + (? - updated) * ?)"
+        rows = await self._db.query(
+            "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+            f"ON CONFLICT (key) DO UPDATE SET tokens = {refilled} - ?, updated = ? "
+            f"WHERE {refilled} >= ? RETURNING tokens",
+            (key, limit.burst - cost, now,
+             limit.burst, now, limit.rate, cost, now,
+             limit.burst, now, limit.rate, cost),
+        )
+        if rows:
+            return None
+        (tokens, updated), = await self._db.query("SELECT tokens, updated FROM buckets WHERE key = ?", (key,))
+        tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+        return max(0.0, (cost - tokens) / limit.rate)
+
+
+def open_bucket_store(url, pool=None):
+    """'memory' (default) or 'sqlite:/path/to/buckets.db' (queried on `pool`)."""
+    if not url or url == "memory":
+        return MemoryBucketStore()
+    if url.startswith("sqlite:"):
+        return SqliteBucketStore(url[len("sqlite:"):], pool)
+    raise ValueError(f"Unknown rate limit store: {url}")
+
+
+class RateLimiter:
+    """Named limits per route, each with an optional premium tier:
+
+        limiter = RateLimiter(store, {"ping": (Limit.per_minute(6, 3), Limit.per_minute(20, 5))})
+        retry_after = await limiter.check("ping", user_id, premium)  # None = allowed
+    """
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+        self.allowed = {name: 0 for name in limits}
+        self.throttled = {name: 0 for name in limits}
+
+    async def check(self, name, key, premium=False):
+        basic, premium_limit = self.limits[name]
+        limit = premium_limit if premium and premium_limit else basic
+        retry_after = await self.store.take(f"{name}:{key}", limit)
+        if retry_after is None:
+            self.allowed[name] += 1
+        else:
+            self.throttled[name] += 1
+        return retry_after
+
+    def stats(self):
+        return {
+            name: {
+                "allowed": self.allowed[name],
+                "throttled": self.throttled[name],
+                "rate_per_min": round(basic.rate * 60, 2), "burst": basic.burst,
+                "premium_rate_per_min": round(premium.rate * 60, 2) if premium else None,
+                "premium_burst": premium.burst if premium else None,
+            }
+            for name, (basic, premium) in self.limits.items()
+        }
@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import time
+from api.geo import GridIndex
+from api.presence import Presence
+
+PING_RADIUS_M = 1000
+NEARBY_RADIUS_M = 2000
+PRUNE_EVERY_S = 30  # publish_user prunes at most this often
+
+
+def user_event(info, lat, lng):
+    return {**info, "lat": lat, "lng": lng}
+
+
+class Subscriber:
+    """One open stream. Events queue up to `maxsize`; past that the oldest
+    are dropped and the client is told to resync from /api/nearby instead
+    of the hub blocking on a slow reader."""
+
+    def __init__(self, sub_id, user_id, lat, lng, maxsize):
+        self.id = sub_id
+        self.user_id = user_id
+        self.lat = lat
+        self.lng = lng
+        self.queue = asyncio.Queue(maxsize)
+        self.users_in_range = set()
+        self.wisps_in_range = set()  # wisp ids this client has been told about
+        self.dropped = 0
+        self._resync_pending = False
+
+    def offer(self, event, data):
+        if self.queue.full():
+            self.dropped += 1
+            self._resync_pending = True
+            self.queue.get_nowait()
+        self.queue.put_nowait((event, data))
+
+    async def next(self, timeout):
+        if self._resync_pending:
+            self._resync_pending = False
+            return "resync", {"dropped": self.dropped}
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class StreamHub:
+    """Fan-out for server-push. Subscribers are kept in a grid index, so one
+    publish only touches the subscribers in range and no DB read happens
+    per recipient. Who is online and where comes from `presence`, the same
+    index the map endpoints answer from; view(info, lat, lng) shapes a
+    presence entry into a user_entered payload."""
+
+    def __init__(self, presence=None, queue_size=100, view=user_event):
+        self.presence = presence if presence is not None else Presence()
+        self.queue_size = queue_size
+        self.view = view
+        self._subs = {}
+        self._subs_by_user = {}  # user_id -> that user's own open streams
+        self._sub_index = GridIndex(cell_m=NEARBY_RADIUS_M)
+        self._watchers = {}  # user_id -> sub ids that currently have them in range (never empty)
+        self._pruned_at = time.monotonic()
+        self._ids = itertools.count(1)
+
+    def subscribe(self, user_id, lat, lng):
+        self.prune_users()
+        sub = Subscriber(next(self._ids), user_id, lat, lng, self.queue_size)
+        self._subs[sub.id] = sub
+        self._subs_by_user.setdefault(user_id, set()).add(sub.id)
+        self._sub_index.insert(sub.id, lat, lng)
+        self._refresh_range(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subs.pop(sub.id, None)
+        own = self._subs_by_user.get(sub.user_id)
+        if own is not None:
+            own.discard(sub.id)
+            if not own:
+                del self._subs_by_user[sub.user_id]
+        self._sub_index.remove(sub.id)
+        for user_id in sub.users_in_range:
+            self._unwatch(user_id, sub.id)
+
+    def subscribers(self):
+        return list(self._subs.values())
+
+    def __len__(self):
+        return len(self._subs)
+
+    def _near(self, lat, lng, radius_m):
+        return [self._subs[k] for k, _ in self._sub_index.query(lat, lng, radius_m)]
+
+    def publish(self, event, data, lat, lng, radius_m=NEARBY_RADIUS_M, exclude_user=None):
+        for sub in self._near(lat, lng, radius_m):
+            if sub.user_id != exclude_user:
+                sub.offer(event, data)
+
+    def sync_wisps(self, sub, wisps):
+        """Bring one stream up to date with the wisps now in its range (views
+        with id/lat/lng): wisp_spawned for new ones, wisp_removed for gone
+        ones and one batched wisps_moved for the rest. The world may be
+        shared with other workers, so this diff, not the local calls that
+        changed it, is what tells clients about spawns and expiries."""
+        ids = {w["id"] for w in wisps}
+        moved = []
+        for w in wisps:
+            if w["id"] in sub.wisps_in_range:
+                moved.append([w["id"], w["lat"], w["lng"]])
+            else:
+                sub.offer("wisp_spawned", w)
+        for wisp_id in sub.wisps_in_range - ids:
+            sub.offer("wisp_removed", {"id": wisp_id})
+        if moved:
+            sub.offer("wisps_moved", {"wisps": moved})
+        sub.wisps_in_range = ids
+
+    def remove_wisp(self, wisp_id, lat, lng):
+        """A wisp was collected here: tell the streams that know it right away."""
+        for sub in self._near(lat, lng, NEARBY_RADIUS_M):
+            if wisp_id in sub.wisps_in_range:
+                sub.wisps_in_range.discard(wisp_id)
+                sub.offer("wisp_removed", {"id": wisp_id})
+
+    def publish_ping(self, ping):
+        self.publish("ping", ping, ping.get("lat", 0), ping.get("lng", 0), PING_RADIUS_M, exclude_user=ping.get("user_id"))
+
+    def publish_user(self, user):
+        """A user moved (after their presence heartbeat): entered/moved/left
+        events for every subscriber whose 2km circle they are in now or were
+        in before. Also re-centres that user's own streams."""
+        user_id = user["id"]
+        if time.monotonic() - self._pruned_at >= PRUNE_EVERY_S:
+            self.prune_users()
+
+        in_range = set()
+        for sub in self._near(user["lat"], user["lng"], NEARBY_RADIUS_M):
+            if sub.user_id == user_id:
+                continue
+            in_range.add(sub.id)
+            if user_id in sub.users_in_range:
+                sub.offer("user_moved", user)
+            else:
+                sub.users_in_range.add(user_id)
+                sub.offer("user_entered", user)
+        for sub_id in self._watchers.get(user_id, set()) - in_range:
+            sub = self._subs.get(sub_id)
+            if sub:
+                sub.users_in_range.discard(user_id)
+                sub.offer("user_left", {"id": user_id})
+        if in_range:
+            self._watchers[user_id] = in_range
+        else:
+            self._watchers.pop(user_id, None)
+
+        for sub_id in list(self._subs_by_user.get(user_id, ())):
+            self.move(self._subs[sub_id], user["lat"], user["lng"])
+
+    def move(self, sub, lat, lng):
+        sub.lat, sub.lng = lat, lng
+        self._sub_index.insert(sub.id, lat, lng)
+        self._refresh_range(sub)
+
+    def prune_users(self):
+        """user_left for watched users who have dropped out of presence."""
+        self._pruned_at = time.monotonic()
+        self.presence.expire()
+        for user_id in [k for k in self._watchers if k not in self.presence]:
+            for sub_id in self._watchers.pop(user_id):
+                sub = self._subs.get(sub_id)
+                if sub:
+                    sub.users_in_range.discard(user_id)
+                    sub.offer("user_left", {"id": user_id})
+
+    def _refresh_range(self, sub):
+        near = {info["id"]: self.view(info, lat, lng)
+                for info, lat, lng, _ in self.presence.near(sub.lat, sub.lng, NEARBY_RADIUS_M, exclude=sub.user_id)}
+        for user_id in near.keys() - sub.users_in_range:
+            self._watchers.setdefault(user_id, set()).add(sub.id)
+            sub.offer("user_entered", near[user_id])
+        for user_id in sub.users_in_range - near.keys():
+            self._unwatch(user_id, sub.id)
+            sub.offer("user_left", {"id": user_id})
+        sub.users_in_range = set(near)
+
+    def _unwatch(self, user_id, sub_id):
+        watchers = self._watchers.get(user_id)
+        if watchers is not None:
+            watchers.discard(sub_id)
+            if not watchers:
+                del self._watchers[user_id]
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subs),
+            "watched_users": len(self._watchers),
+            "dropped_events": sum(s.dropped for s in self._subs.values()),
+        }
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+log = logging.getLogger("spazz.tasks")
+
+
+class Periodic:
+    """Fixed-cadence background jobs tied to the app's lifespan.
+
+        @periodic.every(2)
+        async def sync(): ...
+
+    Jobs registered with final=True run once more on shutdown so buffered
+    state gets flushed."""
+
+    def __init__(self):
+        self._jobs = []
+        self._tasks = []
+
+    def every(self, seconds, final=False):
+        def register(fn):
+            self._jobs.append((fn, seconds, final))
+            return fn
+        return register
+
+    async def _loop(self, fn, seconds):
+        while True:
+            await asyncio.sleep(seconds)
+            try:
+                await fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("background job %s failed", fn.__name__)
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._loop(fn, s)) for fn, s, _ in self._jobs]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for fn, _, final in self._jobs:
+            if final:
+                try:
+                    await fn()
+                except Exception:
+                    log.exception("final run of %s failed", fn.__name__)
+
+    @asynccontextmanager
+    async def lifespan(self, app):
+        await self.start()
+        try:
+            yield
+        finally:
+            await self.stop()
@@ -0,0 +1,256 @@
+import json
+import random
+import time
+import numpy as np
+from api.db import SqliteFile
+from api.geo import GridIndex, bbox, within_many
+
+
+class WorldStore:
+    """Where live wisps and pings are kept. Handlers only talk to this
+    interface, so a deployment with several workers can swap the
+    per-process dicts for a store they all share. Every method is a
+    coroutine, so a store backed by a file or server never blocks the loop.
+
+    Wisps are dicts with at least id/lat/lon; pings have id/lat/lng and an
+    expires_at after which they are never returned."""
+
+    async def add_wisp(self, wisp): raise NotImplementedError
+    async def get_wisp(self, wisp_id): raise NotImplementedError
+    async def take_wisp(self, wisp_id):
+        """Atomically remove and return a wisp; None if someone beat us to it."""
+        raise NotImplementedError
+    async def all_wisps(self): raise NotImplementedError
+    async def wisps_near(self, lat, lng, radius_m): raise NotImplementedError
+    async def move_wisps(self, max_step): raise NotImplementedError
+    async def expire_wisps(self, spawned_before):
+        """Remove and return wisps whose spawned_at is older than the cutoff."""
+        raise NotImplementedError
+    async def wisp_count(self): raise NotImplementedError
+
+    async def add_ping(self, ping):
+        """Store a ping; False if a ping with that id is already live."""
+        raise NotImplementedError
+    async def pings_near(self, lat, lng, radius_m): raise NotImplementedError
+    async def expire_pings(self, now=None): raise NotImplementedError
+    async def ping_count(self): raise NotImplementedError
+
+    async def note_hunter(self, user_id, lat, lng, seen_at):
+        """Where a hunter was last seen, for the tick to stock wisps around."""
+        raise NotImplementedError
+    async def hunters(self, seen_after):
+        """[(lat, lng)] of hunters seen after the cutoff; older ones are dropped."""
+        raise NotImplementedError
+
+    async def try_lease(self, name, holder, ttl_s):
+        """True if `holder` owns lease `name` for the next ttl_s seconds, so
+        jobs that mutate the shared world run on one worker at a time."""
+        raise NotImplementedError
+
+
+class MemoryWorldStore(WorldStore):
+    """Per-process dicts + grid indexes. Fastest, but every worker has its
+    own world."""
+
+    def __init__(self):
+        self._wisps = {}
+        self._wisp_index = GridIndex()
+        self._pings = {}
+        self._ping_index = GridIndex()
+        self._hunters = {}  # user_id -> (lat, lng, seen_at)
+
+    async def add_wisp(self, wisp):
+        self._wisps[wisp["id"]] = wisp
+        self._wisp_index.insert(wisp["id"], wisp["lat"], wisp["lon"])
+
+    async def get_wisp(self, wisp_id):
+        return self._wisps.get(wisp_id)
+
+    async def take_wisp(self, wisp_id):
+        # handlers all run on the event loop thread, so pop is already atomic
+        wisp = self._wisps.pop(wisp_id, None)
+        self._wisp_index.remove(wisp_id)
+        return wisp
+
+    async def all_wisps(self):
+        return list(self._wisps.values())
+
+    async def wisps_near(self, lat, lng, radius_m):
+        return [(self._wisps[k], d) for k, d in self._wisp_index.query(lat, lng, radius_m)]
+
+    async def move_wisps(self, max_step):
+        for w in self._wisps.values():
+            w["lat"] += random.uniform(-max_step, max_step)
+            w["lon"] += random.uniform(-max_step, max_step)
+            self._wisp_index.move(w["id"], w["lat"], w["lon"])
+
+    async def expire_wisps(self, spawned_before):
+        old = [w for w in self._wisps.values() if w.get("spawned_at", spawned_before) < spawned_before]
+        for w in old:
+            await self.take_wisp(w["id"])
+        return old
+
+    async def wisp_count(self):
+        return len(self._wisps)
+
+    async def add_ping(self, ping):
+        if ping["id"] in self._pings:
+            return False
+        self._pings[ping["id"]] = ping
+        self._ping_index.insert(ping["id"], ping.get("lat", 0), ping.get("lng", 0))
+        return True
+
+    async def pings_near(self, lat, lng, radius_m):
+        now = time.time()
+        return [
+            (self._pings[k], d) for k, d in self._ping_index.query(lat, lng, radius_m)
+            if self._pings[k].get("expires_at", 0) >= now
+        ]
+
+    async def expire_pings(self, now=None):
+        now = now or time.time()
+        expired = [k for k, v in self._pings.items() if v.get("expires_at", 0) < now]
+        for k in expired:
+            del self._pings[k]
+            self._ping_index.remove(k)
+        return len(expired)
+
+    async def ping_count(self):
+        return len(self._pings)
+
+    async def note_hunter(self, user_id, lat, lng, seen_at):
+        self._hunters[user_id] = (lat, lng, seen_at)
+
+    async def hunters(self, seen_after):
+        for user_id in [k for k, v in self._hunters.items() if v[2] <= seen_after]:
+            del self._hunters[user_id]
+        return [(lat, lng) for lat, lng, _ in self._hunters.values()]
+
+    async def try_lease(self, name, holder, ttl_s):
+        return True  # nobody else can see this world
+
+
+class SqliteWorldStore(WorldStore):
+    """One SQLite file (WAL mode) shared by every worker on the host, queried
+    on a BlockingPool so the ticking worker's writes never stall another
+    worker's event loop. Collect is a single DELETE ... RETURNING so exactly
+    one worker wins; radius queries are a bounding-box range scan on
+    (lat, lon) followed by the vectorized haversine."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS wisps (id TEXT PRIMARY KEY, lat REAL NOT NULL, lon REAL NOT NULL, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS wisps_lat_lon ON wisps (lat, lon);
+    CREATE TABLE IF NOT EXISTS pings (id TEXT PRIMARY KEY, lat REAL NOT NULL, lng REAL NOT NULL, expires_at REAL NOT NULL, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS pings_lat_lng ON pings (lat, lng);
+    CREATE INDEX IF NOT EXISTS pings_expires ON pings (expires_at);
+    CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL);
+    CREATE TABLE IF NOT EXISTS hunters (user_id TEXT PRIMARY KEY, lat REAL NOT NULL, lng REAL NOT NULL, seen_at REAL NOT NULL);
+    """
+
+    def __init__(self, path, pool=None):
+        self.path = path
+        self._db = SqliteFile(path, self.SCHEMA, pool)
+
+    @staticmethod
+    def _bbox(lat, lng, radius_m, lon_col):
+        """SQL condition and params for the bounding box; the lon range is
+        two ORed ranges when it crosses the antimeridian."""
+        lat0, lat1, spans = bbox(lat, lng, radius_m)
+        lon_sql = " OR ".join(f"{lon_col} BETWEEN ? AND ?" for _ in spans)
+        return f"lat BETWEEN ? AND ? AND ({lon_sql})", [lat0, lat1, *(x for span in spans for x in span)]
+
+    @staticmethod
+    def _wisp(row):
+        wisp = json.loads(row[3])
+        wisp["id"], wisp["lat"], wisp["lon"] = row[0], row[1], row[2]
+        return wisp
+
+    async def add_wisp(self, wisp):
+        data = {k: v for k, v in wisp.items() if k not in ("id", "lat", "lon")}
+        await self._db.query(
+            "INSERT OR REPLACE INTO wisps (id, lat, lon, data) VALUES (?, ?, ?, ?)",
+            (wisp["id"], wisp["lat"], wisp["lon"], json.dumps(data)),
+        )
+
+    async def get_wisp(self, wisp_id):
+        rows = await self._db.query("SELECT id, lat, lon, data FROM wisps WHERE id = ?", (wisp_id,))
+        return self._wisp(rows[0]) if rows else None
+
+    async def take_wisp(self, wisp_id):
+        rows = await self._db.query("DELETE FROM wisps WHERE id = ? RETURNING id, lat, lon, data", (wisp_id,))
+        return self._wisp(rows[0]) if rows else None
+
+    async def all_wisps(self):
+        return [self._wisp(r) for r in await self._db.query("SELECT id, lat, lon, data FROM wisps")]
+
+    async def wisps_near(self, lat, lng, radius_m):
+        where, params = self._bbox(lat, lng, radius_m, "lon")
+        rows = await self._db.query(f"SELECT id, lat, lon, data FROM wisps WHERE {where}", params)
+        if not rows:
+            return []
+        mask, d = within_many(lat, lng, [r[1] for r in rows], [r[2] for r in rows], radius_m)
+        return [(self._wisp(rows[i]), float(d[i])) for i in np.flatnonzero(mask)]
+
+    async def move_wisps(self, max_step):
+        # random() is a signed 64-bit int; scale it to [-max_step, max_step]
+        step = max_step / 9.223372036854775807e18
+        await self._db.query("UPDATE wisps SET lat = lat + random() * ?, lon = lon + random() * ?", (step, step))
+
+    async def expire_wisps(self, spawned_before):
+        rows = await self._db.query(
+            "DELETE FROM wisps WHERE json_extract(data, '$.spawned_at') < ? RETURNING id, lat, lon, data",
+            (spawned_before,),
+        )
+        return [self._wisp(r) for r in rows]
+
+    async def wisp_count(self):
+        return (await self._db.query("SELECT count(*) FROM wisps"))[0][0]
+
+    async def add_ping(self, ping):
+        rows = await self._db.query(
+            "INSERT OR IGNORE INTO pings (id, lat, lng, expires_at, data) VALUES (?, ?, ?, ?, ?) RETURNING id",
+            (ping["id"], ping.get("lat", 0), ping.get("lng", 0), ping.get("expires_at", 0), json.dumps(ping)),
+        )
+        return bool(rows)
+
+    async def pings_near(self, lat, lng, radius_m):
+        where, params = self._bbox(lat, lng, radius_m, "lng")
+        rows = await self._db.query(f"SELECT lat, lng, data FROM pings WHERE {where} AND expires_at >= ?", [*params, time.time()])
+        if not rows:
+            return []
+        mask, d = within_many(lat, lng, [r[0] for r in rows], [r[1] for r in rows], radius_m)
+        return [(json.loads(rows[i][2]), float(d[i])) for i in np.flatnonzero(mask)]
+
+    async def expire_pings(self, now=None):
+        rows = await self._db.query("DELETE FROM pings WHERE expires_at < ? RETURNING id", (now or time.time(),))
+        return len(rows)
+
+    async def ping_count(self):
+        return (await self._db.query("SELECT count(*) FROM pings"))[0][0]
+
+    async def note_hunter(self, user_id, lat, lng, seen_at):
+        await self._db.query("INSERT OR REPLACE INTO hunters (user_id, lat, lng, seen_at) VALUES (?, ?, ?, ?)",
+                    (user_id, lat, lng, seen_at))
+
+    async def hunters(self, seen_after):
+        await self._db.query("DELETE FROM hunters WHERE seen_at <= ?", (seen_after,))
+        return [tuple(r) for r in await self._db.query("SELECT lat, lng FROM hunters")]
+
+    async def try_lease(self, name, holder, ttl_s):
+        now = time.time()
+        rows = await self._db.query(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE leases.holder = excluded.holder OR leases.expires_at < ? RETURNING holder",
+            (name, holder, now + ttl_s, now),
+        )
+        return bool(rows)
+
+
+def open_world_store(url, pool=None):
+    """'memory' (default) or 'sqlite:/path/to/world.db' (queried on `pool`)."""
+    if not url or url == "memory":
+        return MemoryWorldStore()
+    if url.startswith("sqlite:"):
+        return SqliteWorldStore(url[len("sqlite:"):], pool)
+    raise ValueError(f"Unknown world store: {url}")
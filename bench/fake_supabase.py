@@ -0,0 +1,266 @@
+"""
+In-memory stand-in for the supabase client, for benchmarks and load tests.
+
+Covers the query-builder surface api/index.py uses (table().select /
+insert / upsert / update / delete, the eq / neq / gt / gte / lt / in_ /
+is_ / filter("match") filters, order, limit, execute) and the RPCs from
+supabase/migrations, re-implemented in Python. Every execute() sleeps `latency_s` (plus up to
+`jitter_s`) on the calling thread, the way the real blocking client does,
+and is counted per table/RPC.
+
+    from bench.fake_supabase import FakeSupabase
+    index.supabase = FakeSupabase(latency_s=0.02)
+"""
+import copy
+import itertools
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+
+class Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class Query:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.op = "select"
+        self.columns = "*"
+        self.payload = None
+        self.on_conflict = None
+        self.filters = []
+        self.ordering = None
+        self.max_rows = None
+
+    def select(self, columns="*", **_):
+        self.op, self.columns = "select", columns
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict="id", **_):
+        self.op, self.payload, self.on_conflict = "upsert", payload, on_conflict
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def _where(self, test):
+        self.filters.append(test)
+        return self
+
+    def eq(self, col, value): return self._where(lambda r: r.get(col) == value)
+    def neq(self, col, value): return self._where(lambda r: r.get(col) != value)
+    def gt(self, col, value): return self._where(lambda r: r.get(col) is not None and r[col] > value)
+    def gte(self, col, value): return self._where(lambda r: r.get(col) is not None and r[col] >= value)
+    def lt(self, col, value): return self._where(lambda r: r.get(col) is not None and r[col] < value)
+    def in_(self, col, values):
+        values = set(values)
+        return self._where(lambda r: r.get(col) in values)
+
+    def filter(self, col, op, value):
+        if op == "match":
+            pattern = re.compile(value)
+            return self._where(lambda r: r.get(col) is not None and pattern.search(r[col]) is not None)
+        raise NotImplementedError(op)
+
+    def is_(self, col, value): return self._where(lambda r: r.get(col) is None if value in (None, "null") else r.get(col) is value)
+
+    def order(self, col, desc=False):
+        self.ordering = (col, desc)
+        return self
+
+    def limit(self, n):
+        self.max_rows = n
+        return self
+
+    def execute(self):
+        self.client.wait(self.table)
+        with self.client.lock:
+            return Result(copy.deepcopy(self._run(self.client.tables.setdefault(self.table, []))))
+
+    def _run(self, rows):
+        hits = [r for r in rows if all(f(r) for f in self.filters)]
+        if self.op == "select":
+            if self.ordering:
+                col, desc = self.ordering
+                hits.sort(key=lambda r: (r.get(col) is None, r.get(col)), reverse=desc)
+            if self.max_rows is not None:
+                hits = hits[:self.max_rows]
+            if self.columns != "*":
+                cols = [c.strip() for c in self.columns.split(",")]
+                hits = [{c: r.get(c) for c in cols} for r in hits]
+            return hits
+        if self.op == "update":
+            for r in hits:
+                r.update(self.payload)
+            return hits
+        if self.op == "delete":
+            self.client.tables[self.table] = [r for r in rows if r not in hits]
+            return hits
+        out = []
+        for row in self.payload if isinstance(self.payload, list) else [self.payload]:
+            if self.op == "upsert":
+                keys = self.on_conflict.split(",")
+                existing = next((r for r in rows if all(r.get(k) == row.get(k) for k in keys)), None)
+                if existing is not None:
+                    existing.update(row)
+                    out.append(existing)
+                    continue
+            row = {"id": next(self.client.ids), "created_at": datetime.now(timezone.utc).isoformat(), **row}
+            rows.append(row)
+            out.append(row)
+        return out
+
+
+class RPC:
+    def __init__(self, client, fn, params):
+        self.client = client
+        self.fn = fn
+        self.params = params
+
+    def execute(self):
+        self.client.wait(f"rpc:{self.fn}")
+        with self.client.lock:
+            return Result(copy.deepcopy(RPCS[self.fn](self.client.tables, **self.params)))
+
+
+class FakeSupabase:
+    def __init__(self, latency_s=0.0, jitter_s=0.0, seed=None):
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.tables = {}
+        self.calls = Counter()  # table or "rpc:<name>" -> executes
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def wait(self, name):
+        self.calls[name] += 1
+        delay = self.latency_s + (self._rng.uniform(0, self.jitter_s) if self.jitter_s else 0)
+        if delay:
+            time.sleep(delay)
+
+    def table(self, name):
+        return Query(self, name)
+
+    def rpc(self, fn, params=None):
+        return RPC(self, fn, params or {})
+
+
+# ── RPCs (see supabase/migrations) ──────────────────────────
+def increment_hotspot_visits(tables, visits):
+    for v in visits:
+        for h in tables.get("hotspots", []):
+            if str(h["id"]) == v["id"]:
+                h["visit_count"] = (h.get("visit_count") or 0) + v["n"]
+
+
+def apply_location_batch(tables, updates):
+    by_id = {u["id"]: u for u in tables.get("users", [])}
+    for v in updates:
+        if v["id"] in by_id:
+            by_id[v["id"]].update({k: x for k, x in v.items() if x is not None})
+
+
+def _conversations(tables, user_id):
+    by_partner = {}
+    mine = [m for m in tables.get("chat_messages", []) if user_id in (m["user_id"], m["to_user_id"])]
+    for m in sorted(mine, key=lambda m: (m["created_at"], m["id"]), reverse=True):
+        partner = m["to_user_id"] if m["user_id"] == user_id else m["user_id"]
+        by_partner.setdefault(partner, []).append(m)
+    return by_partner
+
+
+def _unread(messages, user_id):
+    return sum(1 for m in messages if m["to_user_id"] == user_id and not m.get("read_at"))
+
+
+def chat_inbox(tables, p_user_id, p_per_partner, p_partners):
+    out = []
+    for messages in list(_conversations(tables, p_user_id).values())[:p_partners]:
+        unread = _unread(messages, p_user_id)
+        for rn, m in enumerate(messages[:p_per_partner], 1):
+            out.append({**m, "rn": rn, "total": len(messages), "unread": unread,
+                        "last_message_at": messages[0]["created_at"]})
+    return out
+
+
+def chat_history(tables, p_user_id, p_partner_id, p_before, p_before_id, p_limit):
+    messages = _conversations(tables, p_user_id).get(p_partner_id, [])
+    if p_before:
+        messages = [m for m in messages if (m["created_at"], m["id"]) < (p_before, p_before_id)]
+    return messages[:p_limit]
+
+
+def chat_summary(tables, p_user_id):
+    return [{"partner_id": partner, "last_message_at": messages[0]["created_at"], "total": len(messages),
+             "unread": _unread(messages, p_user_id)}
+            for partner, messages in _conversations(tables, p_user_id).items()]
+
+
+def ledger_apply(tables, p_user_id, p_kind, p_key=None, p_coins=0, p_xp=0, p_xp_per_level=None, p_item_id=None,
+                 p_premium_required=False, p_set_premium=False, p_extra=None):
+    user = next((u for u in tables.get("users", []) if u["id"] == p_user_id), None)
+    if user is None:
+        return {"ok": False, "error": "no_user"}
+    ledger = tables.setdefault("ledger", [])
+    prior = None if p_key is None else next(
+        (e for e in ledger if e["user_id"] == p_user_id and e["idempotency_key"] == p_key), None)
+    coins = user.get("wisp_coins") or 0
+    if prior is not None:
+        if prior["kind"] != p_kind:
+            return {"ok": False, "error": "key_reused", "wisp_coins": coins}
+        return {**prior["result"], "replayed": True}
+    if p_premium_required and not user.get("is_premium"):
+        return {"ok": False, "error": "premium_required", "wisp_coins": coins}
+    inventory = tables.setdefault("inventory", [])
+    if p_item_id is not None and any(r["user_id"] == p_user_id and r["item_name"] == p_item_id
+                                     and r.get("item_type") == "owned" for r in inventory):
+        return {"ok": False, "error": "already_owned", "wisp_coins": coins}
+    if coins + p_coins < 0:
+        return {"ok": False, "error": "insufficient_funds", "wisp_coins": coins}
+    user["wisp_coins"] = coins + p_coins
+    user["xp"] = (user.get("xp") or 0) + p_xp
+    if p_xp_per_level:
+        user["level"] = max(1, user["xp"] // p_xp_per_level + 1)
+    user["is_premium"] = bool(user.get("is_premium")) or p_set_premium
+    if p_item_id is not None:
+        inventory.append({"id": len(inventory) + 1, "user_id": p_user_id, "item_name": p_item_id, "item_type": "owned"})
+    result = {**(p_extra or {}), "ok": True, "wisp_coins": user["wisp_coins"], "xp": user["xp"],
+              "level": user.get("level"), "is_premium": user["is_premium"]}
+    ledger.append({"user_id": p_user_id, "idempotency_key": p_key, "kind": p_kind,
+                   "coins_delta": p_coins, "xp_delta": p_xp, "item_id": p_item_id, "result": result})
+    return result
+
+
+def bump_token_version(tables, p_user_id):
+    for u in tables.get("users", []):
+        if u["id"] == p_user_id:
+            u["token_version"] = (u.get("token_version") or 0) + 1
+            u["token"] = None
+            return u["token_version"]
+
+
+RPCS = {
+    "increment_hotspot_visits": increment_hotspot_visits,
+    "apply_location_batch": apply_location_batch,
+    "chat_inbox": chat_inbox,
+    "chat_history": chat_history,
+    "chat_summary": chat_summary,
+    "ledger_apply": ledger_apply,
+    "bump_token_version": bump_token_version,
+}
@@ -0,0 +1,107 @@
+"""
+Concurrent collects: read-modify-write vs the atomic ledger (python -m bench.ledger).
+
+Drives POST /api/collect/{id} in-process (httpx's ASGI transport) against
+bench.fake_supabase, whose ledger_apply RPC mirrors the migration: the
+client lock plays the part of the row lock, and every call sleeps
+--latency-ms on a db pool thread. The "read-modify-write" run swaps
+index.ledger_apply for the old flow, which reads the balance and then
+writes back an absolute value (two round trips). A share of requests is
+retried with the same Idempotency-Key, as a client would after a timeout.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import httpx
+
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "bench")  # client is built at import, replaced below
+os.environ.setdefault("SPAZZ_DEV", "1")  # local token secret
+from api import index  # noqa: E402
+from api.ratelimit import Limit, MemoryBucketStore, RateLimiter  # noqa: E402
+from api.world import MemoryWorldStore  # noqa: E402
+from bench.fake_supabase import FakeSupabase  # noqa: E402
+
+CENTER = (39.333, -82.982)
+LEDGER_APPLY = index.ledger_apply
+
+
+async def rmw_ledger_apply(user_id, kind, key=None, coins=0, xp=0, xp_per_level=None, extra=None, **_):
+    """The old handlers: read the row, then write absolutes back."""
+    row = (await index.db(index.supabase.table("users").select("*").eq("id", user_id).limit(1))).data[0]
+    fields = {"wisp_coins": (row.get("wisp_coins") or 0) + coins, "xp": (row.get("xp") or 0) + xp}
+    fields["level"] = max(1, fields["xp"] // xp_per_level + 1) if xp_per_level else row.get("level")
+    await index.db(index.supabase.table("users").update(fields).eq("id", user_id))
+    return {**(extra or {}), "ok": True, **fields, "is_premium": row.get("is_premium")}
+
+
+async def run(name, ledger_apply, args):
+    fake = FakeSupabase(latency_s=args.latency_ms / 1000)
+    index.supabase = fake
+    index.ledger_apply = ledger_apply
+    index._world = MemoryWorldStore()
+    index._limiter = RateLimiter(MemoryBucketStore(), {"collect": (Limit(1e9, 1e9), None)})
+    index._sessions.clear()
+
+    rng = random.Random(1)
+    transport = httpx.ASGITransport(app=index.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        headers = {}
+        for i in range(args.users):
+            creds = {"username": f"hunter{i}", "password": "bench"}
+            await client.post("/api/register", json=creds)
+            token = (await client.post("/api/login", json=creds)).json()["token"]
+            headers[f"hunter{i}"] = {"Authorization": f"Bearer {token}"}
+
+        ops = []
+        expected = dict.fromkeys(headers, 0)
+        for i in range(args.collects):
+            user, reward = rng.choice(list(headers)), rng.randint(3, 10)
+            await index.add_wisp({"id": f"w{i}", "lat": CENTER[0], "lon": CENTER[1], "wisp_reward": reward})
+            expected[user] += reward
+            op = (user, f"w{i}", f"k{i}")
+            ops.append(op)
+            if rng.random() < args.retry:
+                ops.append(op)  # client retry with the same Idempotency-Key
+        rng.shuffle(ops)
+
+        gate = asyncio.Semaphore(args.concurrency)
+
+        async def collect(user, wisp_id, key):
+            async with gate:
+                await client.post(f"/api/collect/{wisp_id}", headers={**headers[user], "Idempotency-Key": key})
+
+        fake.calls.clear()
+        start = time.perf_counter()
+        await asyncio.gather(*(collect(*op) for op in ops))
+        elapsed = time.perf_counter() - start
+
+    actual = {u["username"]: u.get("wisp_coins") or 0 for u in fake.tables["users"]}
+    lost = sum(max(0, expected[u] - actual[u]) for u in expected)
+    extra = sum(max(0, actual[u] - expected[u]) for u in expected)
+    print(f"  {name:<18} {len(ops) / elapsed:>8,.0f} req/s   coins expected {sum(expected.values()):,}, "
+          f"got {sum(actual.values()):,} (lost {lost:,}, double-credited {extra:,}), "
+          f"{sum(fake.calls.values()) / len(ops):.2f} db calls/req")
+
+
+async def main_async(args):
+    print(f"{args.collects} collects over {args.users} users, {args.concurrency} concurrent, "
+          f"{args.retry:.0%} retried, {args.latency_ms}ms per db call:")
+    await run("read-modify-write", rmw_ledger_apply, args)
+    await run("ledger", LEDGER_APPLY, args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collects", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=20, help="few users = hot rows")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--retry", type=float, default=0.05, help="share of requests sent twice")
+    parser.add_argument("--latency-ms", type=float, default=1.0)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
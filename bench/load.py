@@ -0,0 +1,201 @@
+"""
+Load test of the API against an in-memory Supabase (python -m bench.load).
+
+N simulated hunters walk around one town on the Flutter app's timers:
+location every 30s, /api/nearby every 15s, ping polling every 5s, a ping
+sent every 2 minutes, and a collect whenever a wisp is close enough. The
+app runs in-process behind httpx's ASGI transport, with its background
+jobs, and every Supabase call goes to bench.fake_supabase with the
+injected latency. --speed compresses the timers (the rate limits are
+real time, so high speeds show up as 429s).
+
+Prints p50/p95/p99 latency, requests/s and DB calls per request for each
+endpoint. DB calls made outside any request (flushes, syncs) are reported
+as "background". Client and app share one event loop, so if the timers
+start firing late (see "timer lag") the numbers measure this process
+being saturated, not the handlers.
+"""
+import argparse
+import asyncio
+import contextvars
+import math
+import os
+import random
+import time
+from collections import defaultdict
+
+import httpx
+
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "bench")  # client is built at import, replaced below
+os.environ.setdefault("SPAZZ_DEV", "1")  # local token secret
+from api import index  # noqa: E402
+from bench.fake_supabase import FakeSupabase  # noqa: E402
+
+CENTER = (39.333, -82.982)
+COLLECT_RANGE_M = 50
+TIMERS = {"location": 30, "nearby": 15, "pings": 5, "send_ping": 120}
+
+_request_db_calls = contextvars.ContextVar("request_db_calls", default=None)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.db_calls = defaultdict(int)
+        self.background_db_calls = 0
+        self.lag = []  # how late each timer fired
+
+    def record(self, name, seconds, status, db_calls):
+        self.latencies[name].append(seconds)
+        self.db_calls[name] += db_calls
+        if status >= 400:
+            self.errors[name] += 1
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def count_db_calls(stats):
+    """Wrap index.db so each call is charged to the request it ran in."""
+    real_db = index.db
+
+    async def counted(query):
+        calls = _request_db_calls.get()
+        if calls is None:
+            stats.background_db_calls += 1
+        else:
+            calls[0] += 1
+        return await real_db(query)
+
+    index.db = counted
+
+
+class Hunter:
+    def __init__(self, client, stats, n, rng):
+        self.client = client
+        self.stats = stats
+        self.name = f"hunter{n}"
+        self.rng = rng
+        self.lat = CENTER[0] + rng.uniform(-0.01, 0.01)
+        self.lng = CENTER[1] + rng.uniform(-0.01, 0.01)
+        self.headers = {}
+        self.wisps = []
+
+    async def call(self, name, method, url, **kwargs):
+        calls = [0]
+        token = _request_db_calls.set(calls)
+        started = time.perf_counter()
+        try:
+            res = await self.client.request(method, url, headers=self.headers, **kwargs)
+        finally:
+            _request_db_calls.reset(token)
+        self.stats.record(name, time.perf_counter() - started, res.status_code, calls[0])
+        return res
+
+    async def sign_up(self):
+        """Not measured: every hunter does it once before the clock starts."""
+        creds = {"username": self.name, "password": "bench"}
+        await self.client.post("/api/register", json=creds)
+        res = await self.client.post("/api/login", json=creds)
+        self.headers = {"Authorization": f"Bearer {res.json()['token']}"}
+
+    def walk(self):
+        # ~1.4 m/s for 30s in a random direction
+        heading = self.rng.uniform(0, 2 * math.pi)
+        self.lat += 42 * math.cos(heading) / index.M_PER_DEG
+        self.lng += 42 * math.sin(heading) / (index.M_PER_DEG * math.cos(math.radians(self.lat)))
+
+    async def location(self):
+        self.walk()
+        await self.call("POST /api/location/update", "POST", "/api/location/update", json={"lat": self.lat, "lng": self.lng})
+
+    async def nearby(self):
+        res = await self.call("GET /api/nearby", "GET", "/api/nearby",
+                              params={"lat": self.lat, "lng": self.lng, "user_id": self.name})
+        if res.status_code == 200:
+            self.wisps = res.json().get("wisps", [])
+            for w in self.wisps:
+                if index.haversine(self.lat, self.lng, w["lat"], w["lng"]) <= COLLECT_RANGE_M:
+                    await self.call("POST /api/wisp/collect", "POST", "/api/wisp/collect", json={"wisp_id": w["id"]})
+                    break
+
+    async def pings(self):
+        await self.call("GET /api/ping/nearby", "GET", "/api/ping/nearby", params={"lat": self.lat, "lng": self.lng})
+
+    async def send_ping(self):
+        await self.call("POST /api/ping/send", "POST", "/api/ping/send", json={"lat": self.lat, "lng": self.lng})
+
+    async def run(self, speed, until):
+        # stagger the timers so hunters don't fire in lockstep
+        due = {name: time.monotonic() + self.rng.uniform(0, every / speed) for name, every in TIMERS.items()}
+        while True:
+            name = min(due, key=due.get)
+            if due[name] >= until:
+                return
+            await asyncio.sleep(max(0.0, due[name] - time.monotonic()))
+            self.stats.lag.append(time.monotonic() - due[name])
+            await getattr(self, name)()
+            due[name] += TIMERS[name] / speed
+
+
+def report(stats, elapsed):
+    print(f"{'endpoint':<28} {'n':>7} {'err':>5} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'db/req':>7}")
+    total = total_db = 0
+    for name in sorted(stats.latencies):
+        lat = sorted(stats.latencies[name])
+        n = len(lat)
+        total += n
+        total_db += stats.db_calls[name]
+        p50, p95, p99 = (percentile(lat, p) * 1000 for p in (50, 95, 99))
+        print(f"{name:<28} {n:>7,} {stats.errors[name]:>5} {p50:>6.1f}ms {p95:>6.1f}ms {p99:>6.1f}ms "
+              f"{n / elapsed:>8.1f} {stats.db_calls[name] / n:>7.2f}")
+    print(f"{'total':<28} {total:>7,} {sum(stats.errors.values()):>5} {'':>8} {'':>8} {'':>8} "
+          f"{total / elapsed:>8.1f} {total_db / max(total, 1):>7.2f}")
+    print(f"background db calls: {stats.background_db_calls:,} ({stats.background_db_calls / elapsed:.1f}/s)")
+    lag = sorted(stats.lag)
+    if lag:
+        print(f"timer lag p50 {percentile(lag, 50) * 1000:.1f}ms, p95 {percentile(lag, 95) * 1000:.1f}ms"
+              + ("  <- the event loop is saturated; latencies include queueing in this process"
+                 if percentile(lag, 95) > 0.05 else ""))
+
+
+async def main_async(args):
+    fake = FakeSupabase(latency_s=args.latency_ms / 1000, jitter_s=args.jitter_ms / 1000, seed=args.seed)
+    index.supabase = fake
+    stats = Stats()
+    count_db_calls(stats)
+    rng = random.Random(args.seed)
+
+    transport = httpx.ASGITransport(app=index.app)
+    async with index._periodic.lifespan(index.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            hunters = [Hunter(client, stats, n, rng) for n in range(args.hunters)]
+            await asyncio.gather(*(h.sign_up() for h in hunters))
+            stats.background_db_calls = 0
+            fake.calls.clear()
+            started = time.monotonic()
+            await asyncio.gather(*(h.run(args.speed, started + args.duration) for h in hunters))
+            elapsed = time.monotonic() - started
+
+    print(f"{args.hunters} hunters, {args.duration:g}s at {args.speed:g}x, "
+          f"db latency {args.latency_ms:g}ms (+{args.jitter_ms:g}ms jitter)")
+    report(stats, elapsed)
+    print("db calls by table:", dict(fake.calls.most_common()))
+    print("db pool:", index._db_pool.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hunters", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of wall time")
+    parser.add_argument("--speed", type=float, default=10, help="timer compression (10 = 30s location every 3s)")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Size of a /api/nearby snapshot per format and encoding (python -m bench.payload_size).
+
+Builds 100 / 1k / 10k synthetic entities (a 1:4:0.1 mix of users, wisps
+and hotspots) through the same user_view/wisp_view shapes the handler
+uses, then prints bytes for json / compact / msgpack, raw, gzip and brotli
+(where the optional packages are installed), and the encode time.
+"""
+import argparse
+import gzip
+import random
+import time
+import uuid
+
+from api.payload import brotli, encode, msgpack
+
+CENTER = (39.333, -82.982)
+
+
+def snapshot(n):
+    rng = random.Random(n)
+    point = lambda: (CENTER[0] + rng.uniform(-0.02, 0.02), CENTER[1] + rng.uniform(-0.02, 0.02))
+    n_users, n_hotspots = max(1, n // 5), max(1, n // 50)
+    n_wisps = n - n_users - n_hotspots
+    users = []
+    for _ in range(n_users):
+        lat, lng = point()
+        users.append({"id": f"user_{uuid.UUID(int=rng.getrandbits(128)).hex[:8]}", "username": f"hunter{rng.randint(1, 99999)}",
+                      "lat": lat, "lng": lng, "is_premium": rng.random() < 0.1})
+    wisps = []
+    for _ in range(n_wisps):
+        lat, lng = point()
+        wisps.append({"id": f"wisp_{uuid.UUID(int=rng.getrandbits(128)).hex[:6]}", "lat": lat, "lng": lng, "xp": rng.choice([5, 10, 15])})
+    hotspots = []
+    for i in range(n_hotspots):
+        lat, lng = point()
+        hotspots.append({"id": i, "lat": lat, "lng": lng, "visit_count": rng.randint(1, 500), "name": "Hotspot"})
+    return {"users": users, "wisps": wisps, "hotspots": hotspots}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100,1000,10000")
+    args = parser.parse_args()
+
+    formats = ["json", "compact"] + (["msgpack"] if msgpack else [])
+    if not msgpack:
+        print("(msgpack not installed, skipping)")
+    if not brotli:
+        print("(brotli not installed, skipping br)")
+    header = f"{'entities':>8} {'format':<8} {'raw':>10} {'gzip':>10}" + (f" {'br':>10}" if brotli else "") + f" {'encode':>9}"
+    print(header)
+    for n in map(int, args.sizes.split(",")):
+        payload = snapshot(n)
+        for fmt in formats:
+            start = time.perf_counter()
+            body, _ = encode(payload, fmt)
+            elapsed = time.perf_counter() - start
+            row = f"{n:>8} {fmt:<8} {len(body):>10,} {len(gzip.compress(body, 5)):>10,}"
+            if brotli:
+                row += f" {len(brotli.compress(body, quality=4)):>10,}"
+            print(row + f" {elapsed * 1000:>7.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Serialization cost per endpoint, before/after (python -m bench.serialization).
+
+"before" is what FastAPI did for a plain dict return: jsonable_encoder,
+then stdlib json in JSONResponse.render. "after" is what the handlers do
+now: orjson via respond()/FastJSONResponse for the map payloads, and the
+fragments serialized at import for /api/shop and /api/premium/tips. Only
+serialization is timed; no request is made.
+"""
+import argparse
+import os
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "bench")  # client is built at import, never called
+os.environ.setdefault("SPAZZ_DEV", "1")  # local token secret
+from api import index  # noqa: E402
+from api.payload import dumps, encode, orjson  # noqa: E402
+from bench.payload_size import snapshot  # noqa: E402
+
+
+def per_call(fn, n):
+    fn()
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def before(payload):
+    return JSONResponse(jsonable_encoder(payload)).body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    if orjson is None:
+        print("(orjson not installed: 'after' falls back to stdlib json)")
+
+    world = snapshot(args.entities)
+    users_payload = {
+        "entities": world["users"] + [{**w, "username": "Wisp", "type": "wisp", "wisp_class": "whisp-cyan"} for w in world["wisps"]],
+        "me": {"id": "user_1", "username": "ben", "steps": 1200, "calories": 55.2, "distance_m": 914.4,
+               "credits": 300, "wisps_collected": 42, "level": 5, "is_premium": False},
+        "coach_tip": index.COACH_TIPS_GENERAL[0],
+        "is_admin": False,
+    }
+    inv = {"owned": {"bg_void", "ping_zap", "flash_fire"}, "equipped": {"background": "bg_void"}}
+    shop_dict = {
+        "items": [{**i, "owned": i["id"] in inv["owned"], "equipped": inv["equipped"].get(i["type"]) == i["id"]}
+                  for i in index.SHOP_ITEMS],
+        "equipped": inv["equipped"], "owned": sorted(inv["owned"]), "is_premium": False,
+    }
+    cases = [
+        (f"/api/users ({args.entities})", lambda: before(users_payload), lambda: encode(users_payload, "json")),
+        (f"/api/nearby ({args.entities})", lambda: before(world), lambda: encode(world, "json")),
+        ("/api/shop", lambda: before(shop_dict), lambda: index.shop_body(inv, False)),
+        ("/api/premium/tips", lambda: before({"tips": index.PREMIUM_COACH_TIPS}), lambda: index._premium_tips_body),
+        ("/api/me", lambda: before(users_payload["me"]), lambda: dumps(users_payload["me"])),
+    ]
+    print(f"{'endpoint':<22} {'before':>11} {'after':>11} {'speedup':>8}")
+    for name, old, new in cases:
+        t_old, t_new = per_call(old, args.iterations), per_call(new, args.iterations)
+        print(f"{name:<22} {t_old:>9,.1f}us {t_new:>9,.1f}us {t_old / t_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
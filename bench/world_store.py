@@ -0,0 +1,109 @@
+"""
+Throughput of the world-state backends (python -m bench.world_store).
+
+Runs the same mix against each store: spawn wisps, 2km radius queries,
+atomic collects, a move tick, ping inserts and 1km ping queries. The
+sqlite store is also hit from several processes at once to check that
+every wisp is collected exactly once.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from api.world import MemoryWorldStore, SqliteWorldStore
+
+CENTER = (39.333, -82.982)
+
+
+def rand_point(spread=0.05):
+    return CENTER[0] + random.uniform(-spread, spread), CENTER[1] + random.uniform(-spread, spread)
+
+
+async def timed(label, n, fn):
+    start = time.perf_counter()
+    for i in range(n):
+        await fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<22} {n / elapsed:>12,.0f} ops/s  ({elapsed * 1e6 / n:,.1f} us/op)")
+
+
+async def run(store, n_wisps, n_queries):
+    ids = [f"wisp_{uuid.uuid4().hex[:6]}" for _ in range(n_wisps)]
+
+    def spawn(i):
+        lat, lon = rand_point()
+        return store.add_wisp({"id": ids[i], "username": "Wisp", "type": "wisp", "lat": lat, "lon": lon, "wisp_reward": 5})
+
+    def near(_):
+        return store.wisps_near(*rand_point(), 2000)
+
+    def add_ping(_):
+        lat, lng = rand_point()
+        return store.add_ping({"id": uuid.uuid4().hex, "user_id": "u", "lat": lat, "lng": lng, "priority": 1, "expires_at": time.time() + 30})
+
+    def pings_near(_):
+        return store.pings_near(*rand_point(), 1000)
+
+    await timed("add_wisp", n_wisps, spawn)
+    await timed("wisps_near 2km", n_queries, near)
+    await timed("move_wisps (all)", 20, lambda _: store.move_wisps(0.0001))
+    await timed("take_wisp", n_wisps // 2, lambda i: store.take_wisp(ids[i]))
+    await timed("add_ping", n_wisps, add_ping)
+    await timed("pings_near 1km", n_queries, pings_near)
+    await timed("expire_pings", 20, lambda _: store.expire_pings())
+
+
+def _collector(path, ids, out):
+    async def collect():
+        store = SqliteWorldStore(path)
+        return sum([1 for wisp_id in ids if await store.take_wisp(wisp_id)])
+
+    out.put(asyncio.run(collect()))
+
+
+def race(path, n_wisps, workers):
+    store = SqliteWorldStore(path)
+    ids = [f"race_{i}" for i in range(n_wisps)]
+
+    async def seed():
+        for wisp_id in ids:
+            lat, lon = rand_point()
+            await store.add_wisp({"id": wisp_id, "lat": lat, "lon": lon})
+
+    asyncio.run(seed())
+    out = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_collector, args=(path, random.sample(ids, len(ids)), out)) for _ in range(workers)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    won = sum(out.get() for _ in procs)
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+    attempts = n_wisps * workers
+    print(f"  {workers} workers racing: {attempts / elapsed:,.0f} collect attempts/s, "
+          f"{won} of {n_wisps} wisps collected ({'OK' if won == n_wisps else 'DOUBLE/LOST COLLECTS'})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wisps", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, store in [("memory", MemoryWorldStore()), ("sqlite", SqliteWorldStore(os.path.join(tmp, "world.db")))]:
+            print(f"{name}:")
+            asyncio.run(run(store, args.wisps, args.queries))
+        print("sqlite, shared between processes:")
+        race(os.path.join(tmp, "race.db"), 2000, args.workers)
+
+
+if __name__ == "__main__":
+    main()
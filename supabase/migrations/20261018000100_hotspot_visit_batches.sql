@@ -0,0 +1,12 @@
+-- Batched hotspot visit counting (api/index.py flush_hotspot_visits).
+-- visits: [{"id": "<hotspot id>", "n": <visits to add>}, ...]
+-- One atomic increment per hotspot, so concurrent flushes never lose counts.
+create or replace function increment_hotspot_visits(visits jsonb)
+returns void
+language sql
+as $$
+  update hotspots h
+     set visit_count = coalesce(h.visit_count, 0) + v.n
+    from jsonb_to_recordset(visits) as v(id text, n integer)
+   where h.id::text = v.id;
+$$;
@@ -0,0 +1,68 @@
+-- Inbox served by one round trip per screen instead of two unbounded selects.
+-- Every function returns setof json so the API passes rows straight through.
+
+alter table chat_messages add column if not exists read_at timestamptz;
+
+create index if not exists chat_messages_sender_idx
+    on chat_messages (user_id, to_user_id, created_at desc, id desc);
+create index if not exists chat_messages_recipient_idx
+    on chat_messages (to_user_id, user_id, created_at desc, id desc);
+create index if not exists chat_messages_unread_idx
+    on chat_messages (to_user_id, user_id) where read_at is null;
+
+-- Last p_per_partner messages of the p_partners most recent conversations,
+-- newest conversation first, each row tagged with its conversation totals.
+create or replace function chat_inbox(p_user_id text, p_per_partner integer, p_partners integer)
+returns setof json
+language sql stable
+as $$
+  with m as (
+    select c.*, case when c.user_id = p_user_id then c.to_user_id else c.user_id end as partner_id
+      from chat_messages c
+     where c.user_id = p_user_id or c.to_user_id = p_user_id
+  ), ranked as (
+    select m.*,
+           row_number() over w as rn,
+           count(*) over p as total,
+           count(*) filter (where m.to_user_id = p_user_id and m.read_at is null) over p as unread,
+           max(m.created_at) over p as last_message_at
+      from m
+    window p as (partition by m.partner_id),
+           w as (partition by m.partner_id order by m.created_at desc, m.id desc)
+  ), recent as (
+    select partner_id from ranked where rn = 1 order by created_at desc, id desc limit p_partners
+  )
+  select to_json(r) from ranked r join recent using (partner_id)
+   where r.rn <= p_per_partner
+   order by r.last_message_at desc, r.partner_id, r.created_at desc, r.id desc;
+$$;
+
+-- One conversation, newest first, keyset-paginated on (created_at, id).
+create or replace function chat_history(p_user_id text, p_partner_id text, p_before timestamptz, p_before_id bigint, p_limit integer)
+returns setof json
+language sql stable
+as $$
+  select to_json(c) from chat_messages c
+   where ((c.user_id = p_user_id and c.to_user_id = p_partner_id)
+       or (c.user_id = p_partner_id and c.to_user_id = p_user_id))
+     and (p_before is null or (c.created_at, c.id) < (p_before, p_before_id))
+   order by c.created_at desc, c.id desc
+   limit p_limit;
+$$;
+
+-- Per-conversation counts and timestamps only, no message bodies.
+create or replace function chat_summary(p_user_id text)
+returns setof json
+language sql stable
+as $$
+  select json_build_object(
+           'partner_id', partner_id,
+           'last_message_at', max(created_at),
+           'unread', count(*) filter (where to_user_id = p_user_id and read_at is null),
+           'total', count(*))
+    from (select case when user_id = p_user_id then to_user_id else user_id end as partner_id, created_at, to_user_id, read_at
+            from chat_messages
+           where user_id = p_user_id or to_user_id = p_user_id) m
+   group by partner_id
+   order by max(created_at) desc;
+$$;
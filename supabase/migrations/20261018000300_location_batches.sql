@@ -0,0 +1,25 @@
+-- Bulk write of buffered location columns: one call per flush instead of
+-- one UPDATE per location ping. A plain upsert would try to INSERT partial
+-- rows first, so this updates existing users only. Keys left out of an
+-- element keep their current value.
+create or replace function apply_location_batch(updates jsonb)
+returns void
+language sql
+as $$
+  update users u
+     set lat        = coalesce(v.lat, u.lat),
+         lon        = coalesce(v.lon, u.lon),
+         last_lat   = coalesce(v.last_lat, u.last_lat),
+         last_lon   = coalesce(v.last_lon, u.last_lon),
+         distance_m = coalesce(v.distance_m, u.distance_m),
+         steps      = coalesce(v.steps, u.steps),
+         calories   = coalesce(v.calories, u.calories),
+         online     = coalesce(v.online, u.online),
+         last_seen  = coalesce(v.last_seen, u.last_seen)
+    from jsonb_to_recordset(updates) as v(
+           id text, lat double precision, lon double precision,
+           last_lat double precision, last_lon double precision,
+           distance_m double precision, steps integer, calories double precision,
+           online boolean, last_seen double precision)
+   where u.id = v.id;
+$$;
@@ -0,0 +1,89 @@
+-- Coin/xp/premium changes as single atomic calls. Each call locks the
+-- user's row, checks, applies deltas (never absolute values computed from a
+-- stale read) and records a ledger entry. A repeated idempotency key gets the
+-- first call's result back instead of being applied twice; reusing a key for a
+-- different kind of change is refused (key_reused) rather than replayed.
+
+create table if not exists ledger (
+    id bigint generated by default as identity primary key,
+    user_id text not null,
+    idempotency_key text,
+    kind text not null,
+    coins_delta integer not null default 0,
+    xp_delta integer not null default 0,
+    item_id text,
+    result jsonb not null,
+    created_at timestamptz not null default now()
+);
+create unique index if not exists ledger_idempotency
+    on ledger (user_id, idempotency_key) where idempotency_key is not null;
+create index if not exists ledger_user_created on ledger (user_id, created_at desc);
+
+create or replace function ledger_apply(
+    p_user_id text,
+    p_kind text,
+    p_key text default null,
+    p_coins integer default 0,
+    p_xp integer default 0,
+    p_xp_per_level integer default null,
+    p_item_id text default null,
+    p_premium_required boolean default false,
+    p_set_premium boolean default false,
+    p_extra jsonb default '{}'
+) returns jsonb
+language plpgsql
+as $$
+declare
+    u users%rowtype;
+    prior ledger%rowtype;
+    res jsonb;
+begin
+    -- one writer per user at a time; everything below sees a settled row
+    select * into u from users where id = p_user_id for update;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'no_user');
+    end if;
+
+    if p_key is not null then
+        select * into prior from ledger where user_id = p_user_id and idempotency_key = p_key;
+        if found then
+            if prior.kind <> p_kind then
+                return jsonb_build_object('ok', false, 'error', 'key_reused', 'wisp_coins', u.wisp_coins);
+            end if;
+            return prior.result || jsonb_build_object('replayed', true);
+        end if;
+    end if;
+
+    if p_premium_required and not coalesce(u.is_premium, false) then
+        return jsonb_build_object('ok', false, 'error', 'premium_required', 'wisp_coins', u.wisp_coins);
+    end if;
+    if p_item_id is not null and exists (
+        select 1 from inventory
+         where user_id = p_user_id and item_name = p_item_id and item_type = 'owned'
+    ) then
+        return jsonb_build_object('ok', false, 'error', 'already_owned', 'wisp_coins', u.wisp_coins);
+    end if;
+    if coalesce(u.wisp_coins, 0) + p_coins < 0 then
+        return jsonb_build_object('ok', false, 'error', 'insufficient_funds', 'wisp_coins', coalesce(u.wisp_coins, 0));
+    end if;
+
+    update users
+       set wisp_coins = coalesce(wisp_coins, 0) + p_coins,
+           xp = coalesce(xp, 0) + p_xp,
+           level = case when p_xp_per_level is null then level
+                        else greatest(1, (coalesce(xp, 0) + p_xp) / p_xp_per_level + 1) end,
+           is_premium = coalesce(is_premium, false) or p_set_premium
+     where id = p_user_id
+    returning * into u;
+
+    if p_item_id is not null then
+        insert into inventory (user_id, item_name, item_type) values (p_user_id, p_item_id, 'owned');
+    end if;
+
+    res := p_extra || jsonb_build_object(
+        'ok', true, 'wisp_coins', u.wisp_coins, 'xp', u.xp, 'level', u.level, 'is_premium', u.is_premium);
+    insert into ledger (user_id, idempotency_key, kind, coins_delta, xp_delta, item_id, result)
+    values (p_user_id, p_key, p_kind, p_coins, p_xp, p_item_id, res);
+    return res;
+end;
+$$;
@@ -0,0 +1,17 @@
+-- Equip is a single upsert on (user_id, item_type, item_category) instead of
+-- delete + insert. Owned rows have a null item_category, so they never
+-- collide with each other under this index.
+
+-- keep only the newest equipped row per category before adding the index
+delete from inventory i
+ using inventory newer
+ where i.item_type = 'equipped'
+   and newer.item_type = 'equipped'
+   and newer.user_id = i.user_id
+   and newer.item_category = i.item_category
+   and newer.id > i.id;
+
+create unique index if not exists inventory_user_type_category
+    on inventory (user_id, item_type, item_category);
+
+create index if not exists inventory_user on inventory (user_id);
@@ -0,0 +1,11 @@
+-- Presence is tracked in memory now. Each instance tails users by
+-- last_seen to pick up heartbeats from the others, and writes
+-- online = false in bulk when its users expire.
+create index if not exists users_last_seen_idx on users (last_seen);
+
+-- Nothing used to clear the flag, so every user who ever sent a location
+-- is still marked online.
+update users
+   set online = false
+ where online
+   and (last_seen is null or last_seen < extract(epoch from now()) - 300);
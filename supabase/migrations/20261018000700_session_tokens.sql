@@ -0,0 +1,15 @@
+-- Session tokens are signed and carry the token_version they were issued
+-- under; bumping it revokes all of a user's tokens (logout, bans). The
+-- legacy token column is cleared on the way, retiring any pre-signed token.
+alter table users add column if not exists token_version integer not null default 0;
+
+create or replace function bump_token_version(p_user_id text)
+returns integer
+language sql
+as $$
+  update users
+     set token_version = token_version + 1,
+         token = null
+   where id = p_user_id
+  returning token_version;
+$$;
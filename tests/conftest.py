@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+# api.index builds its Supabase client and token signer at import
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "test")
+os.environ.setdefault("SPAZZ_DEV", "1")
+
+
+@pytest.fixture
+def fake_supabase(monkeypatch):
+    from api import index
+    from bench.fake_supabase import FakeSupabase
+
+    fake = FakeSupabase()
+    monkeypatch.setattr(index, "supabase", fake)
+    index._sessions.clear()
+    return fake
+
+
+@pytest.fixture
+def client(fake_supabase):
+    """TestClient on the app against an in-memory Supabase; the background
+    jobs don't run (no lifespan)."""
+    from fastapi.testclient import TestClient
+
+    from api import index
+
+    return TestClient(index.app)
+
+
+@pytest.fixture
+def sign_up(client):
+    """sign_up(username) -> auth headers for a freshly registered user."""
+
+    def sign_up(username, password="pw"):
+        client.post("/api/register", json={"username": username, "password": password})
+        res = client.post("/api/login", json={"username": username, "password": password})
+        return {"Authorization": f"Bearer {res.json()['token']}"}
+
+    return sign_up
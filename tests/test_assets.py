@@ -0,0 +1,40 @@
+import gzip
+
+import pytest
+from starlette.requests import Request
+
+from api.assets import AssetCache
+
+BODY = "<p>spazz</p>\n" * 100  # big enough to get compressed variants
+
+
+def request(**headers):
+    return Request({"type": "http", "headers": [(k.replace("_", "-").lower().encode(), v.encode())
+                                                for k, v in headers.items()]})
+
+
+@pytest.fixture
+def assets(tmp_path):
+    (tmp_path / "index.html").write_text(BODY)
+    return AssetCache(str(tmp_path), files=["index.html"])
+
+
+def test_etag_differs_per_encoding(assets):
+    plain = assets.respond(request(), "index.html", "no-cache")
+    zipped = assets.respond(request(accept_encoding="gzip, deflate"), "index.html", "no-cache")
+    assert plain.body == BODY.encode() and "content-encoding" not in plain.headers
+    assert zipped.headers["content-encoding"] == "gzip" and gzip.decompress(zipped.body) == BODY.encode()
+    assert plain.headers["etag"] != zipped.headers["etag"]
+    assert zipped.headers["etag"].endswith('-gz"')
+
+
+def test_not_modified_only_for_same_representation(assets):
+    plain_etag = assets.respond(request(), "index.html", "no-cache").headers["etag"]
+    zipped_etag = assets.respond(request(accept_encoding="gzip"), "index.html", "no-cache").headers["etag"]
+    assert assets.respond(request(if_none_match=plain_etag), "index.html", "no-cache").status_code == 304
+    assert assets.respond(request(accept_encoding="gzip", if_none_match=zipped_etag),
+                          "index.html", "no-cache").status_code == 304
+    # a cached identity body doesn't validate a gzip response, or the reverse
+    res = assets.respond(request(accept_encoding="gzip", if_none_match=plain_etag), "index.html", "no-cache")
+    assert res.status_code == 200 and res.headers["content-encoding"] == "gzip"
+    assert assets.respond(request(if_none_match=zipped_etag), "index.html", "no-cache").status_code == 200
@@ -0,0 +1,95 @@
+import asyncio
+import math
+import random
+import time
+
+import numpy as np
+import pytest
+
+from api.geo import GridIndex, haversine, haversine_many, within_many
+from api.world import SqliteWorldStore
+
+
+def random_points(rng, n):
+    return [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(n)]
+
+
+def test_haversine_many_matches_scalar():
+    rng = random.Random(1)
+    origin = (rng.uniform(-90, 90), rng.uniform(-180, 180))
+    points = random_points(rng, 500)
+    points += [origin, (-origin[0], origin[1] - 180 if origin[1] > 0 else origin[1] + 180)]  # same point, antipode
+    lats, lons = np.array(points).T
+
+    many = haversine_many(*origin, lats, lons)
+    scalar = [haversine(*origin, lat, lon) for lat, lon in points]
+    np.testing.assert_allclose(many, scalar, rtol=1e-9, atol=1e-6)
+    assert many[-2] == pytest.approx(0, abs=1e-6)
+    assert many[-1] == pytest.approx(math.pi * 6371e3, rel=1e-9)
+
+
+def test_within_many_matches_scalar():
+    rng = random.Random(2)
+    points = [(39.333 + rng.uniform(-0.05, 0.05), -82.982 + rng.uniform(-0.05, 0.05)) for _ in range(500)]
+    lats, lons = np.array(points).T
+
+    mask, d = within_many(39.333, -82.982, lats, lons, 2000)
+    assert list(mask) == [haversine(39.333, -82.982, lat, lon) <= 2000 for lat, lon in points]
+    assert 0 < mask.sum() < len(points)
+
+
+def brute_force(points, lat, lon, radius_m):
+    return {k for k, (plat, plon) in points.items() if haversine(lat, lon, plat, plon) <= radius_m}
+
+
+@pytest.mark.parametrize("lat,lon,spread_lat,spread_lon", [
+    (39.333, -82.982, 0.05, 0.05),  # a town
+    (90.0, 0.0, 0.05, 180),  # north pole
+    (89.9999, 45.0, 0.05, 180),
+    (-90.0, 0.0, 0.05, 180),  # south pole
+    (10.0, 179.999, 0.02, 0.03),  # either side of the antimeridian
+    (10.0, -179.999, 0.02, 0.03),
+    (-33.0, 180.0, 0.02, 0.03),
+])
+def test_grid_query_matches_brute_force(lat, lon, spread_lat, spread_lon):
+    rng = random.Random(3)
+    index, points = GridIndex(), {}
+    for key in range(2000):
+        plat = max(-90.0, min(90.0, lat + rng.uniform(-spread_lat, spread_lat)))
+        plon = (lon + rng.uniform(-spread_lon, spread_lon) + 180) % 360 - 180
+        points[key] = (plat, plon)
+        index.insert(key, plat, plon)
+
+    for radius_m in (50, 1000, 2000):
+        hits = index.query(lat, lon, radius_m)
+        assert {k for k, _ in hits} == brute_force(points, lat, lon, radius_m)
+        for key, d in hits:
+            assert d == pytest.approx(haversine(lat, lon, *points[key]), abs=1e-6)
+
+
+def test_grid_query_at_pole_is_fast():
+    index = GridIndex()
+    index.insert("a", 89.99, 10.0)
+    started = time.perf_counter()
+    assert [k for k, _ in index.query(90.0, 0.0, 2000)] == ["a"]
+    assert time.perf_counter() - started < 0.1
+
+
+@pytest.mark.parametrize("lat,lon", [(math.nan, 0.0), (0.0, math.inf), (-math.inf, 0.0)])
+def test_grid_query_non_finite(lat, lon):
+    index = GridIndex()
+    index.insert("a", 0.0, 0.0)
+    assert index.query(lat, lon, 2000) == []
+
+
+def test_sqlite_world_store_wraps_antimeridian(tmp_path):
+    store = SqliteWorldStore(str(tmp_path / "world.db"))
+
+    async def run():
+        await store.add_wisp({"id": "east", "lat": 10.0, "lon": 179.9995, "spawned_at": 0})
+        await store.add_wisp({"id": "west", "lat": 10.0, "lon": -179.9995, "spawned_at": 0})
+        await store.add_wisp({"id": "pole", "lat": 89.999, "lon": -120.0, "spawned_at": 0})
+        assert {w["id"] for w, _ in await store.wisps_near(10.0, -179.9999, 500)} == {"east", "west"}
+        assert {w["id"] for w, _ in await store.wisps_near(90.0, 0.0, 500)} == {"pole"}
+
+    asyncio.run(run())
@@ -0,0 +1,141 @@
+import asyncio
+import base64
+import json
+import time
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from api import index
+from api.google import GoogleKeys, verify_id_token
+
+AUDIENCE = "spazz-test.apps.googleusercontent.com"
+KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+OTHER_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64int(n):
+    return _b64(n.to_bytes((n.bit_length() + 7) // 8, "big"))
+
+
+def jwks(kid="k1", key=KEY):
+    numbers = key.public_key().public_numbers()
+    return {"keys": [{"kty": "RSA", "kid": kid, "alg": "RS256", "n": _b64int(numbers.n), "e": _b64int(numbers.e)}]}
+
+
+def id_token(kid="k1", key=KEY, **claims):
+    now = int(time.time())
+    claims = {"iss": "https://accounts.google.com", "aud": AUDIENCE, "sub": "1234", "email": "john.doe@gmail.com",
+              "email_verified": True, "iat": now, "exp": now + 3600, **claims}
+    header_part = _b64(json.dumps({"alg": "RS256", "kid": kid}).encode())
+    claims_part = _b64(json.dumps(claims).encode())
+    signature = key.sign(f"{header_part}.{claims_part}".encode(), padding.PKCS1v15(), hashes.SHA256())
+    return f"{header_part}.{claims_part}.{_b64(signature)}"
+
+
+class Certs:
+    """fetch for GoogleKeys that serves whatever jwks the test sets."""
+
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.fetches = 0
+
+    async def __call__(self):
+        self.fetches += 1
+        return self.jwks, None
+
+
+def verify(token, certs):
+    keys = GoogleKeys(certs, min_refresh_s=0)
+    return asyncio.run(verify_id_token(token, keys, audiences=(AUDIENCE,)))
+
+
+def test_valid_token():
+    certs = Certs(jwks())
+    claims = verify(id_token(), certs)
+    assert claims["email"] == "john.doe@gmail.com"
+    assert certs.fetches == 1
+
+
+def test_bad_signature():
+    with pytest.raises(ValueError, match="bad signature"):
+        verify(id_token(key=OTHER_KEY), Certs(jwks()))
+
+
+def test_unknown_kid_refreshes_once():
+    certs = Certs(jwks("old"))
+    with pytest.raises(ValueError, match="unknown signing key"):
+        verify(id_token(kid="k1"), certs)
+    assert certs.fetches == 2  # the initial load plus one early refresh, not a loop
+
+
+def test_unknown_kid_found_after_rotation():
+    certs = Certs(jwks("old"))
+    keys = GoogleKeys(certs, min_refresh_s=0)
+
+    async def run():
+        await keys.refresh()
+        certs.jwks = jwks("k1")  # Google rotated
+        return await verify_id_token(id_token(kid="k1"), keys, audiences=(AUDIENCE,))
+
+    assert asyncio.run(run())["sub"] == "1234"
+    assert certs.fetches == 2
+
+
+@pytest.mark.parametrize("claims,error", [
+    ({"exp": int(time.time()) - 3600}, "token expired"),
+    ({"iss": "https://evil.example.com"}, "wrong issuer"),
+    ({"aud": "someone-else.apps.googleusercontent.com"}, "wrong audience"),
+    ({"email_verified": False}, "email not verified"),
+])
+def test_rejected_claims(claims, error):
+    with pytest.raises(ValueError, match=error):
+        verify(id_token(**claims), Certs(jwks()))
+
+
+def test_malformed_token():
+    with pytest.raises(ValueError, match="malformed token"):
+        verify("not-a-jwt", Certs(jwks()))
+
+
+@pytest.mark.parametrize("taken,expected", [
+    ([], "john_doe"),
+    (["john_doe"], "john_doe1"),
+    (["john_doe", "john_doe1", "john_doe3"], "john_doe2"),
+    (["john_doe", "john_doe2", "john_doe10", "john_doex", "john_doe_1"], "john_doe1"),
+    (["john_doe1", "john_doe2"], "john_doe"),
+])
+def test_allocate_username(fake_supabase, taken, expected):
+    fake_supabase.tables["users"] = [{"id": f"u{i}", "username": name} for i, name in enumerate(taken)]
+    assert asyncio.run(index.allocate_username(index.username_base("john.doe@gmail.com"))) == expected
+    assert fake_supabase.calls["users"] == 1
+
+
+@pytest.fixture
+def google_client(client, monkeypatch):
+    monkeypatch.setattr(index, "_google_keys", GoogleKeys(Certs(jwks()), min_refresh_s=0))
+    return client
+
+
+def google_auth(client, token):
+    return client.post("/api/google-auth", json={"id_token": token, "email": "x", "display_name": "x"})
+
+
+def test_google_auth_refused_without_client_ids(google_client, monkeypatch):
+    monkeypatch.setattr(index, "GOOGLE_CLIENT_IDS", ())
+    monkeypatch.setattr(index, "GOOGLE_ANY_AUDIENCE", False)
+    assert google_auth(google_client, id_token()).status_code == 503
+
+
+def test_google_auth_pins_audience(google_client, monkeypatch):
+    monkeypatch.setattr(index, "GOOGLE_CLIENT_IDS", (AUDIENCE,))
+    monkeypatch.setattr(index, "GOOGLE_ANY_AUDIENCE", False)
+    res = google_auth(google_client, id_token(aud="another-app.apps.googleusercontent.com"))
+    assert res.status_code == 401 and "wrong audience" in res.json()["detail"]
+    res = google_auth(google_client, id_token())
+    assert res.status_code == 200 and res.json()["username"] == "john_doe"
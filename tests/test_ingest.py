@@ -0,0 +1,80 @@
+import asyncio
+
+from api import index, ingest
+from api.ingest import LocationBuffer
+
+
+def test_put_coalesces_per_user():
+    buf = LocationBuffer()
+    buf.put("a", {"lat": 1.0, "lon": 1.0, "steps": 10})
+    buf.put("a", {"lat": 2.0, "lon": 2.0})
+    buf.put("b", {"lat": 5.0, "lon": 5.0})
+    assert len(buf) == 2
+    assert buf.latest("a") == {"lat": 2.0, "lon": 2.0, "steps": 10}
+    rows = sorted(buf.take(), key=lambda r: r["id"])
+    assert rows == [{"id": "a", "lat": 2.0, "lon": 2.0, "steps": 10}, {"id": "b", "lat": 5.0, "lon": 5.0}]
+    assert len(buf) == 0
+    buf.done(rows, 0.01)
+    assert buf.stats()["writes_saved"] == 1
+
+
+def test_latest_sees_in_flight_rows_until_done():
+    buf = LocationBuffer()
+    buf.put("a", {"lat": 1.0, "steps": 10})
+    rows = buf.take()
+    assert buf.latest("a") == {"lat": 1.0, "steps": 10}
+    buf.put("a", {"lat": 2.0})
+    assert buf.latest("a") == {"lat": 2.0, "steps": 10}
+    buf.done(rows, 0.01)
+    assert buf.latest("a") == {"lat": 2.0}
+    assert buf.latest("nobody") == {}
+
+
+def test_take_respects_max_batch():
+    buf = LocationBuffer(max_batch=2)
+    for uid in "abc":
+        buf.put(uid, {"lat": 1.0})
+    assert len(buf.take()) == 2
+    assert len(buf) == 1
+
+
+def test_due_on_full_batch():
+    buf = LocationBuffer(max_batch=2, max_age_s=60)
+    buf.put("a", {"lat": 1.0})
+    assert not buf.due()
+    buf.put("b", {"lat": 1.0})
+    assert buf.due()
+
+
+def test_due_on_age(monkeypatch):
+    buf = LocationBuffer(max_age_s=10)
+    assert not buf.due()
+    now = ingest.time.monotonic()
+    buf.put("a", {"lat": 1.0})
+    monkeypatch.setattr(ingest.time, "monotonic", lambda: now + 11)
+    assert buf.due()
+
+
+def test_restore_keeps_newer_writes():
+    buf = LocationBuffer()
+    buf.put("a", {"lat": 1.0, "lon": 1.0, "steps": 10})
+    rows = buf.take()
+    buf.put("a", {"lat": 2.0, "lon": 2.0})  # arrives while the flush is in flight
+    buf.restore(rows)
+    assert buf.take() == [{"id": "a", "lat": 2.0, "lon": 2.0, "steps": 10}]
+    assert buf.stats()["failures"] == 1
+    assert buf.stats()["in_flight"] == 1
+
+
+def test_store_location_survives_failed_inline_flush(monkeypatch):
+    buf = LocationBuffer(max_batch=1)
+    monkeypatch.setattr(index, "_locations", buf)
+
+    async def failing_db(query):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(index, "db", failing_db)
+    user = {"id": "flush-fail", "username": "x"}
+    asyncio.run(index.store_location(user, index.location_fields(user, 39.333, -82.982)))
+    assert buf.latest("flush-fail")["lat"] == 39.333
+    assert len(buf) == 1 and buf.stats()["failures"] == 1
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from api import index
+from api.world import MemoryWorldStore
+
+ITEM = "bg_neon_city"  # 120 coins, not premium
+TOWN = (39.333, -82.982)
+
+
+@pytest.fixture
+def hunter(fake_supabase, sign_up):
+    """(headers, users row) for a signed-up user; set row["wisp_coins"] to fund them."""
+    headers = sign_up("hunter")
+    row = next(u for u in fake_supabase.tables["users"] if u["username"] == "hunter")
+    return headers, row
+
+
+def buy(client, headers, key=None):
+    return client.post(f"/api/shop/buy/{ITEM}", headers={**headers, **({"Idempotency-Key": key} if key else {})})
+
+
+def ledger(fake_supabase):
+    return fake_supabase.tables.get("ledger", [])
+
+
+def test_buy_insufficient_funds(client, fake_supabase, hunter):
+    headers, row = hunter
+    row["wisp_coins"] = 100
+    res = buy(client, headers)
+    assert res.status_code == 400 and res.json()["detail"] == "Need 120 coins, you have 100"
+    assert row["wisp_coins"] == 100 and ledger(fake_supabase) == []
+
+
+def test_buy_already_owned(client, fake_supabase, hunter):
+    headers, row = hunter
+    row["wisp_coins"] = 300
+    assert buy(client, headers).json()["new_balance"] == 180
+    assert buy(client, headers).json()["detail"] == "Already owned"  # cached inventory
+    res = buy(client, headers, key="fresh")  # past the cache, refused by the RPC
+    assert res.status_code == 400 and res.json()["detail"] == "Already owned"
+    assert row["wisp_coins"] == 180 and len(ledger(fake_supabase)) == 1
+
+
+def test_buy_replay_charges_once(client, fake_supabase, hunter):
+    headers, row = hunter
+    row["wisp_coins"] = 300
+    first, retry = buy(client, headers, key="k1"), buy(client, headers, key="k1")
+    assert first.status_code == retry.status_code == 200
+    assert first.json() == retry.json()
+    assert row["wisp_coins"] == 180 and len(ledger(fake_supabase)) == 1
+
+
+def test_key_reused_for_another_kind(client, fake_supabase, hunter):
+    headers, row = hunter
+    row["wisp_coins"] = 1000
+    assert buy(client, headers, key="k1").status_code == 200
+    res = client.post("/api/premium/subscribe", headers={**headers, "Idempotency-Key": "k1"})
+    assert res.status_code == 409
+    assert row["wisp_coins"] == 880 and not row.get("is_premium")
+    res = client.post("/api/premium/subscribe", headers={**headers, "Idempotency-Key": "k2"})
+    assert res.json() == {"status": "subscribed", "new_balance": 581}
+    assert row["is_premium"]
+
+
+def test_collect_replay_pays_once(client, fake_supabase, hunter, monkeypatch):
+    headers, row = hunter
+    world = MemoryWorldStore()
+    monkeypatch.setattr(index, "_world", world)
+    asyncio.run(world.add_wisp({"id": "w1", "lat": TOWN[0], "lon": TOWN[1], "wisp_reward": 7}))
+    collect = lambda key: client.post("/api/collect/w1", headers={**headers, "Idempotency-Key": key})
+    first, retry = collect("c1"), collect("c1")
+    assert first.json() == retry.json() and first.json()["new_balance"] == 7
+    assert collect("c2").status_code == 404  # a new key is a new collect of a wisp that's gone
+    assert row["wisp_coins"] == 7 and len(ledger(fake_supabase)) == 1
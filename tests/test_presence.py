@@ -0,0 +1,54 @@
+from api.presence import Presence
+
+TOWN = (39.333, -82.982)
+M_PER_DEG = 111_320
+
+
+def info(user_id):
+    return {"id": user_id}
+
+
+def test_expire_drops_oldest_heartbeats():
+    presence = Presence(ttl_s=300)
+    presence.beat("a", *TOWN, info("a"), seen_at=1000.0)
+    presence.beat("b", *TOWN, info("b"), seen_at=1100.0)
+    presence.beat("a", *TOWN, info("a"), seen_at=1200.0)  # back to the end
+    assert presence.expire(now=1450.0) == ["b"]
+    assert "b" not in presence and "a" in presence
+    assert presence.take_offline() == ["b"] and presence.take_offline() == []
+
+
+def test_remote_users_expire_without_going_offline():
+    presence = Presence(ttl_s=300)
+    presence.beat("remote", *TOWN, info("remote"), seen_at=1000.0, local=False)
+    presence.beat("remote", *TOWN, info("remote"), seen_at=900.0, local=False)  # older, ignored
+    assert presence.expire(now=1250.0) == []
+    assert presence.expire(now=1350.0) == ["remote"]
+    assert presence.take_offline() == []
+
+
+def test_beat_reports_coming_online():
+    presence = Presence()
+    assert presence.beat("a", *TOWN, info("a"))
+    assert not presence.beat("a", *TOWN, info("a"))
+
+
+def test_near_within_radius():
+    presence = Presence()
+    presence.beat("me", *TOWN, info("me"))
+    presence.beat("close", TOWN[0] + 500 / M_PER_DEG, TOWN[1], info("close"))
+    presence.beat("edge", TOWN[0] + 1900 / M_PER_DEG, TOWN[1], info("edge"))
+    presence.beat("far", TOWN[0] + 5000 / M_PER_DEG, TOWN[1], info("far"))
+    hits = {i["id"]: round(d) for i, _, _, d in presence.near(*TOWN, 2000, exclude="me")}
+    assert hits.keys() == {"close", "edge"}
+    assert abs(hits["close"] - 500) <= 2
+    assert {i["id"] for i, _, _ in presence.online(exclude="me")} == {"close", "edge", "far"}
+
+
+def test_near_skips_expired_and_follows_moves():
+    presence = Presence(ttl_s=300)
+    presence.beat("old", *TOWN, info("old"), seen_at=0.0)
+    presence.beat("mover", *TOWN, info("mover"))
+    presence.beat("mover", TOWN[0] + 5000 / M_PER_DEG, TOWN[1], info("mover"))
+    assert presence.near(*TOWN, 1000) == []
+    assert len(presence) == 1
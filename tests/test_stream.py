@@ -0,0 +1,83 @@
+import asyncio
+
+from api import stream
+from api.presence import Presence
+from api.stream import StreamHub
+
+
+def move(hub, user_id, lat, lng, seen_at=None):
+    """What the location endpoints do: heartbeat, then publish."""
+    hub.presence.beat(user_id, lat, lng, {"id": user_id}, seen_at=seen_at)
+    hub.publish_user({"id": user_id, "lat": lat, "lng": lng})
+
+
+def test_publish_user_drops_empty_watcher_sets():
+    async def run():
+        hub = StreamHub()
+        sub = hub.subscribe("watcher", 0.0, 0.0)
+        move(hub, "u1", 0.0, 0.0)
+        assert hub._watchers == {"u1": {sub.id}}
+        move(hub, "u1", 10.0, 10.0)  # out of range
+        move(hub, "u2", 50.0, 50.0)  # never in range
+        assert hub._watchers == {}
+        hub.unsubscribe(sub)
+        assert hub._watchers == {}
+
+    asyncio.run(run())
+
+
+def test_subscribe_sees_users_from_presence():
+    """Users merged into presence from other instances show up on a new
+    stream, in the shape the hub's view gives them."""
+
+    async def run():
+        presence = Presence()
+        presence.beat("remote", 0.001, 0.0, {"id": "remote", "username": "amy"}, local=False)
+        presence.beat("far", 1.0, 1.0, {"id": "far", "username": "bob"})
+        hub = StreamHub(presence, view=lambda info, lat, lng: {"name": info["username"], "lat": lat})
+        sub = hub.subscribe("watcher", 0.0, 0.0)
+        assert sub.queue.get_nowait() == ("user_entered", {"name": "amy", "lat": 0.001})
+        assert sub.queue.empty() and sub.users_in_range == {"remote"}
+
+    asyncio.run(run())
+
+
+def test_prune_users_follows_presence_expiry(monkeypatch):
+    async def run():
+        hub = StreamHub(Presence(ttl_s=300))
+        sub = hub.subscribe("watcher", 0.0, 0.0)
+        move(hub, "stale", 0.0, 0.0, seen_at=stream.time.time() - 301)
+        move(hub, "fresh", 0.0, 0.001)
+        clock = stream.time.monotonic() + stream.PRUNE_EVERY_S
+        monkeypatch.setattr(stream.time, "monotonic", lambda: clock)
+        move(hub, "fresh", 0.0, 0.002)
+        assert "stale" not in hub.presence and "stale" not in hub._watchers
+        assert sub.users_in_range == {"fresh"}
+        events = [sub.queue.get_nowait() for _ in range(sub.queue.qsize())]
+        assert ("user_left", {"id": "stale"}) in events
+
+    asyncio.run(run())
+
+
+def test_sync_wisps_diffs_against_what_the_client_knows():
+    async def run():
+        hub = StreamHub()
+        sub = hub.subscribe("watcher", 0.0, 0.0)
+        a, b = {"id": "a", "lat": 0.0, "lng": 0.0}, {"id": "b", "lat": 0.001, "lng": 0.0}
+        hub.sync_wisps(sub, [a])
+        hub.sync_wisps(sub, [{**a, "lat": 0.0001}, b])
+        hub.sync_wisps(sub, [b])
+        hub.remove_wisp("b", 0.001, 0.0)
+        hub.remove_wisp("b", 0.001, 0.0)  # already told
+        events = [sub.queue.get_nowait() for _ in range(sub.queue.qsize())]
+        assert events == [
+            ("wisp_spawned", a),
+            ("wisp_spawned", b),
+            ("wisps_moved", {"wisps": [["a", 0.0001, 0.0]]}),
+            ("wisp_removed", {"id": "a"}),
+            ("wisps_moved", {"wisps": [["b", 0.001, 0.0]]}),
+            ("wisp_removed", {"id": "b"}),
+        ]
+        assert sub.wisps_in_range == set()
+
+    asyncio.run(run())
@@ -0,0 +1,128 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from api import index
+from api.tokens import TokenSigner, _b64, _unb64
+
+
+def test_issue_and_verify():
+    signer = TokenSigner("secret", ttl_s=60)
+    claims = signer.verify(signer.issue("user_1", version=3, now=1000), now=1030)
+    assert claims == {"uid": "user_1", "iat": 1000, "exp": 1060, "ver": 3}
+
+
+def test_expired():
+    signer = TokenSigner("secret", ttl_s=60)
+    assert signer.verify(signer.issue("user_1", now=1000), now=1061) is None
+
+
+def test_other_secret():
+    token = TokenSigner("secret").issue("user_1")
+    assert TokenSigner("other").verify(token) is None
+
+
+def test_tampered_claims():
+    signer = TokenSigner("secret")
+    claims_part, signature = signer.issue("user_1").split(".")
+    forged = _unb64(claims_part).replace(b'"user_1"', b'"user_2"')
+    assert signer.verify(f"{_b64(forged)}.{signature}") is None
+
+
+def test_tampered_signature():
+    signer = TokenSigner("secret")
+    claims_part, signature = signer.issue("user_1").split(".")
+    flipped = signature[:-1] + ("A" if signature[-1] != "A" else "B")
+    assert signer.verify(f"{claims_part}.{flipped}") is None
+
+
+@pytest.mark.parametrize("token", ["", ".", "a.", ".b", "a.b", "a.é", "é.é", "no-dot", "a.b.c"])
+def test_garbage(token):
+    assert TokenSigner("secret").verify(token) is None
+
+
+def test_signed_non_object_claims():
+    signer = TokenSigner("secret")
+    claims_part = _b64(b"[1, 2]")
+    assert signer.verify(f"{claims_part}.{signer._sign(claims_part)}") is None
+
+
+def me(client, headers):
+    return client.get("/api/me", headers=headers)
+
+
+def test_login_token_works_without_db(client, fake_supabase, sign_up):
+    headers = sign_up("ben")
+    fake_supabase.calls.clear()
+    for _ in range(3):
+        assert me(client, headers).json()["username"] == "ben"
+    assert sum(fake_supabase.calls.values()) == 0
+
+
+@pytest.mark.parametrize("header", [b"Bearer garbage.token", b"Bearer a.\xc3\xa9", b"Bearer \xff\xfe", b"Bearer "])
+def test_bad_tokens_are_401(client, sign_up, header):
+    sign_up("ben")
+    assert client.get("/api/me", headers={"Authorization": header}).status_code == 401
+
+
+def test_expired_token_is_401(client, fake_supabase, sign_up, monkeypatch):
+    user_id = me(client, sign_up("ben")).json()["id"]
+    expired = index._tokens.issue(user_id, now=0)
+    assert me(client, {"Authorization": f"Bearer {expired}"}).status_code == 401
+
+
+def test_logout_revokes_every_device(client, sign_up):
+    phone = sign_up("ben")
+    laptop = sign_up("ben")  # second login, same account
+    assert client.post("/api/logout", headers=phone).status_code == 200
+    assert me(client, phone).status_code == 401
+    assert me(client, laptop).status_code == 401
+    fresh = sign_up("ben")
+    assert me(client, fresh).status_code == 200
+
+
+def test_revocation_seen_by_other_instance(client, fake_supabase, sign_up):
+    """A bump written by another instance, noticed once the cached row is
+    refreshed; a token issued after the bump forces that refresh."""
+    headers = sign_up("ben")
+    user_id = me(client, headers).json()["id"]
+    fake_supabase.rpc("bump_token_version", {"p_user_id": user_id}).execute()
+    newer = index._tokens.issue(user_id, version=1)
+    assert me(client, {"Authorization": f"Bearer {newer}"}).status_code == 200
+    assert me(client, headers).status_code == 401
+
+
+def test_admin_revoke(client, sign_up):
+    admin = sign_up("ben")
+    amy = sign_up("amy")
+    amy_id = me(client, amy).json()["id"]
+    assert client.post(f"/api/admin/revoke-sessions/{amy_id}", headers=amy).status_code == 403
+    assert client.post(f"/api/admin/revoke-sessions/{amy_id}", headers=admin).status_code == 200
+    assert me(client, amy).status_code == 401
+    assert me(client, admin).status_code == 200
+
+
+def test_legacy_token_still_works_until_next_login(client, fake_supabase, sign_up):
+    sign_up("ben")
+    fake_supabase.tables["users"][0]["token"] = "bGVnYWN5LXRva2Vu"
+    legacy = {"Authorization": "Bearer bGVnYWN5LXRva2Vu"}
+    assert me(client, legacy).json()["username"] == "ben"
+    sign_up("ben")  # logging in again retires it
+    assert fake_supabase.tables["users"][0]["token"] is None
+    assert me(client, legacy).status_code == 401
+
+
+def _import_index(**env):
+    env = {k: v for k, v in os.environ.items() if k not in ("SPAZZ_DEV", "SPAZZ_TOKEN_SECRET")} | env
+    return subprocess.run([sys.executable, "-c", "import api.index"], env=env, capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_token_secret_required_at_import():
+    res = _import_index()
+    assert res.returncode != 0 and "SPAZZ_TOKEN_SECRET" in res.stderr
+    assert _import_index(SPAZZ_TOKEN_SECRET="spazz-dev-token-secret").returncode != 0
+    assert _import_index(SPAZZ_TOKEN_SECRET="a-private-value").returncode == 0
+    assert _import_index(SPAZZ_DEV="1").returncode == 0
@@ -0,0 +1,130 @@
+import math
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from api import index
+from api.geo import decode_polyline, haversine
+from api.index import LocationTrace, trace_fields, trace_points
+
+# Google's documented example: (38.5, -120.2), (40.7, -120.95), (43.252, -126.453)
+EXAMPLE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+START = (39.333, -82.982)
+
+
+def step(lat, lng, north_m):
+    return lat + north_m / index.M_PER_DEG, lng
+
+
+def user(**fields):
+    return {"id": f"trace-{time.monotonic_ns()}", "age": 25, **fields}
+
+
+def walk(n, every_s=10, step_m=10, t0=None):
+    """n fixes walking north at step_m every every_s seconds, ending now."""
+    t0 = time.time() - n * every_s if t0 is None else t0
+    lat, lng = START
+    points = []
+    for i in range(n):
+        points.append((lat, lng, t0 + i * every_s))
+        lat, lng = step(lat, lng, step_m)
+    return points
+
+
+def test_decode_polyline():
+    points = decode_polyline(EXAMPLE)
+    assert points == [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    assert decode_polyline("") == []
+    with pytest.raises(ValueError):
+        decode_polyline(EXAMPLE[:-1])
+
+
+def test_trace_points_from_polyline():
+    points = trace_points(LocationTrace(polyline=EXAMPLE, t0=100.0, dt=[0, 5, 5]))
+    assert [p[2] for p in points] == [100.0, 105.0, 110.0]
+    with pytest.raises(HTTPException):
+        trace_points(LocationTrace(polyline=EXAMPLE, t0=100.0, dt=[0, 5]))
+
+
+@pytest.mark.parametrize("trace", [
+    LocationTrace(points=[[39.34, -82.98, math.nan]]),
+    LocationTrace(points=[[math.nan, -82.98, 100.0]]),
+    LocationTrace(points=[[39.34, math.inf, 100.0]]),
+    LocationTrace(polyline=EXAMPLE, t0=math.nan, dt=[0, 5, 5]),
+    LocationTrace(polyline=EXAMPLE, t0=100.0, dt=[0, math.inf, 5]),
+])
+def test_trace_points_rejects_non_finite(trace):
+    with pytest.raises(HTTPException) as err:
+        trace_points(trace)
+    assert err.value.status_code == 400
+
+
+def test_trace_fields_walk():
+    points = walk(10)
+    fields, accepted, rejected, added = trace_fields(user(), points)
+    assert (accepted, rejected) == (10, 0)
+    assert added == pytest.approx(90, rel=1e-3)
+    assert fields["last_seen"] == points[-1][2]
+    assert (fields["lat"], fields["lon"]) == points[-1][:2]
+
+
+def test_trace_fields_sorts_out_of_order_points():
+    points = walk(10)
+    fields, accepted, rejected, added = trace_fields(user(), points[::-1])
+    assert (accepted, rejected) == (10, 0)
+    assert added == pytest.approx(90, rel=1e-3)
+    assert fields["last_seen"] == points[-1][2]
+
+
+def test_trace_fields_drops_non_finite_points():
+    points = walk(5)
+    points.insert(2, (START[0], START[1], math.nan))
+    fields, accepted, rejected, added = trace_fields(user(), points)
+    assert (accepted, rejected) == (5, 1)
+    assert math.isfinite(fields["last_seen"])
+
+
+def test_trace_fields_rejects_single_spike():
+    points = walk(6)
+    lat, lng, t = points[3]
+    points[3] = (*step(lat, lng, 5000), t)  # 5km off in 10s
+    fields, accepted, rejected, added = trace_fields(user(), points)
+    assert (accepted, rejected) == (5, 1)
+    assert added == pytest.approx(50, rel=1e-3)  # the two hops around the spike count as one 20m hop
+
+
+def test_trace_fields_reanchors_after_real_move():
+    near = walk(3)
+    far_lat, far_lng = step(*START, 5000)
+    t = near[-1][2]
+    points = near + [(far_lat, far_lng, t + 10), (*step(far_lat, far_lng, 10), t + 20)]
+    fields, accepted, rejected, added = trace_fields(user(), points)
+    assert accepted == 5 and rejected == 0
+    assert fields["lat"] == pytest.approx(step(far_lat, far_lng, 10)[0])
+
+
+def test_trace_fields_skips_points_before_last_seen():
+    points = walk(10)
+    last_seen = points[4][2]
+    prior = user(last_lat=points[4][0], last_lon=points[4][1], last_seen=last_seen, distance_m=40.0)
+    fields, accepted, rejected, added = trace_fields(prior, points)
+    assert (accepted, rejected) == (5, 5)
+    assert added == pytest.approx(50, rel=1e-3)
+    assert fields["distance_m"] == pytest.approx(90, rel=1e-3)
+
+
+def test_trace_fields_ignores_poisoned_last_seen():
+    points = walk(3)
+    fields, accepted, rejected, added = trace_fields(user(last_seen=math.nan), points)
+    assert (accepted, rejected) == (3, 0)
+    assert fields["last_seen"] == points[-1][2]
+
+
+def test_trace_fields_rejects_future_and_out_of_range():
+    points = walk(3)
+    points.append((START[0], START[1], time.time() + 3600))
+    points.append((91.0, START[1], points[2][2] + 1))
+    fields, accepted, rejected, added = trace_fields(user(), points)
+    assert (accepted, rejected) == (3, 2)
+    assert added == pytest.approx(haversine(*points[0][:2], *points[2][:2]), rel=1e-6)
@@ -0,0 +1,109 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from api import index
+from api.db import BlockingPool
+from api.ratelimit import Limit, SqliteBucketStore
+from api.stream import StreamHub
+from api.world import MemoryWorldStore, SqliteWorldStore
+
+TOWN = (39.333, -82.982)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    return MemoryWorldStore() if request.param == "memory" else SqliteWorldStore(str(tmp_path / "world.db"))
+
+
+def test_hunters_expire(store):
+    async def run():
+        await store.note_hunter("a", *TOWN, 100.0)
+        await store.note_hunter("b", *TOWN, 200.0)
+        await store.note_hunter("a", TOWN[0] + 0.01, TOWN[1], 300.0)  # moved
+        assert sorted(await store.hunters(150.0)) == [TOWN, (TOWN[0] + 0.01, TOWN[1])]
+        assert await store.hunters(250.0) == [(TOWN[0] + 0.01, TOWN[1])]
+
+    asyncio.run(run())
+
+
+def test_take_wisp_once(store):
+    async def run():
+        await store.add_wisp({"id": "w", "lat": TOWN[0], "lon": TOWN[1], "spawned_at": 0})
+        assert [w["id"] for w, _ in await store.wisps_near(*TOWN, 100)] == ["w"]
+        assert (await store.take_wisp("w"))["id"] == "w"
+        assert await store.take_wisp("w") is None
+        assert await store.wisp_count() == 0
+
+    asyncio.run(run())
+
+
+def test_hunters_shared_between_workers(tmp_path):
+    path = str(tmp_path / "world.db")
+
+    async def run():
+        await SqliteWorldStore(path).note_hunter("a", *TOWN, 100.0)
+        assert await SqliteWorldStore(path).hunters(50.0) == [TOWN]
+
+    asyncio.run(run())
+
+
+def test_sqlite_lock_wait_does_not_block_the_loop(tmp_path):
+    """Another worker holding the write lock delays this worker's query,
+    but the event loop keeps serving other coroutines meanwhile."""
+    path = str(tmp_path / "world.db")
+    store = SqliteWorldStore(path)
+    buckets = SqliteBucketStore(str(tmp_path / "buckets.db"))
+    other = sqlite3.connect(path, isolation_level=None)
+
+    async def run():
+        other.execute("BEGIN IMMEDIATE")  # another worker mid-write
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        write = asyncio.create_task(store.add_wisp({"id": "w", "lat": TOWN[0], "lon": TOWN[1]}))
+        await asyncio.sleep(0.3)
+        assert not write.done() and ticks >= 10
+        other.execute("COMMIT")
+        await write
+        assert await buckets.take("k", Limit(1, 1)) is None
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_lease_holder_spawns_for_other_workers_hunters(tmp_path, monkeypatch):
+    """A hunter whose requests land on worker A gets wisps from worker B's
+    tick, and A's stream hears about them although A spawned nothing."""
+    path = str(tmp_path / "world.db")
+    pool = BlockingPool(size=2, name="sqlite")
+    worker_a, worker_b = SqliteWorldStore(path, pool), SqliteWorldStore(path, pool)
+    hub_a = StreamHub()
+    monkeypatch.setattr(index, "_hub", hub_a)
+    monkeypatch.setattr(index, "_world", worker_a)
+    monkeypatch.setattr(index, "_hunters_noted", {})
+
+    async def tick(world, instance_id):
+        monkeypatch.setattr(index, "_world", world)
+        monkeypatch.setattr(index, "_instance_id", instance_id)
+        monkeypatch.setattr(index, "_hub", hub_a if world is worker_a else StreamHub())
+        await index.world_tick()
+
+    async def run():
+        sub = hub_a.subscribe("hunter", *TOWN)
+        await index.note_hunter("hunter", *TOWN)
+        await tick(worker_b, "b")  # b takes the lease and spawns
+        assert await worker_a.wisp_count() == index.WISPS_PER_HUNTER
+        await tick(worker_a, "a")  # a only diffs the world into its streams
+        assert await worker_a.wisp_count() == index.WISPS_PER_HUNTER
+        return [sub.queue.get_nowait() for _ in range(sub.queue.qsize())]
+
+    events = asyncio.run(run())
+    assert [e for e, _ in events].count("wisp_spawned") == index.WISPS_PER_HUNTER